@@ -0,0 +1,120 @@
+#################################################################
+####---------Semantic cache of LLM answers---------------------####
+#################################################################
+import os
+import threading
+from collections import OrderedDict
+import numpy as np
+
+from vector_index import SparseVector, to_float32_vector
+
+ANSWER_CACHE_SIZE = int(os.environ.get("ANSWER_CACHE_SIZE", 256))
+ANSWER_CACHE_MAX_BYTES = int(os.environ.get("ANSWER_CACHE_MAX_BYTES", 16 * 1024 * 1024))
+ANSWER_CACHE_THRESHOLD = float(os.environ.get("ANSWER_CACHE_THRESHOLD", 0.97))
+
+
+def _normalize(embedding):
+    if isinstance(embedding, SparseVector):
+        norm = np.linalg.norm(embedding.data)
+        order = np.argsort(embedding.indices)
+        return SparseVector(embedding.indices[order], embedding.data[order] / (norm or 1.0), embedding.dimension)
+    vector = to_float32_vector(embedding)
+    norm = np.linalg.norm(vector)
+    return vector / norm if norm > 0 else vector
+
+def _cosine(a, b):
+    # Both vectors are normalized by _normalize
+    if isinstance(a, SparseVector) or isinstance(b, SparseVector):
+        if not (isinstance(a, SparseVector) and isinstance(b, SparseVector)):
+            return 0.0
+        _, ia, ib = np.intersect1d(a.indices, b.indices, assume_unique=True, return_indices=True)
+        return float(np.dot(a.data[ia], b.data[ib]))
+    if a.shape != b.shape:
+        return 0.0
+    return float(np.dot(a, b))
+
+
+class SemanticAnswerCache:
+    """
+    LRU cache of LLM answers. An entry is reused when the corpus version, the retrieved
+    chunk ids and the generation parameters (llm_choice, temperature, max_tokens) are
+    identical and the question embedding is at least `threshold` cosine-similar to the
+    cached one. Keying on the corpus version means a changed corpus never serves answers
+    built from the old one.
+    """
+
+    def __init__(self, max_entries=ANSWER_CACHE_SIZE, max_bytes=ANSWER_CACHE_MAX_BYTES,
+                 threshold=ANSWER_CACHE_THRESHOLD):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.threshold = threshold
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()  # entry id -> (bucket key, query embedding, answer)
+        self._buckets = {}  # bucket key -> set of entry ids
+        self._bytes = 0
+        self._next_id = 0
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def make_bucket_key(corpus_version, chunk_ids, llm_choice, temperature, max_tokens):
+        return (corpus_version, tuple(int(i) for i in chunk_ids), llm_choice, float(temperature), int(max_tokens))
+
+    def lookup(self, query_embedding, corpus_version, chunk_ids, llm_choice, temperature, max_tokens):
+        """
+        Returns the cached answer of the most similar question above the threshold, or None.
+        """
+        bucket_key = self.make_bucket_key(corpus_version, chunk_ids, llm_choice, temperature, max_tokens)
+        query = _normalize(query_embedding)
+        with self._lock:
+            best_id, best_score = None, self.threshold
+            for entry_id in self._buckets.get(bucket_key, ()):
+                score = _cosine(query, self._entries[entry_id][1])
+                if score >= best_score:
+                    best_id, best_score = entry_id, score
+            if best_id is None:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(best_id)
+            self.hits += 1
+            return self._entries[best_id][2]
+
+    def store(self, query_embedding, corpus_version, chunk_ids, llm_choice, temperature, max_tokens, answer):
+        bucket_key = self.make_bucket_key(corpus_version, chunk_ids, llm_choice, temperature, max_tokens)
+        query = _normalize(query_embedding)
+        with self._lock:
+            entry_id = self._next_id
+            self._next_id += 1
+            self._entries[entry_id] = (bucket_key, query, answer)
+            self._buckets.setdefault(bucket_key, set()).add(entry_id)
+            self._bytes += len(answer.encode("utf-8"))
+            while self._entries and (len(self._entries) > self.max_entries or self._bytes > self.max_bytes):
+                self._evict(next(iter(self._entries)))
+
+    def invalidate(self, corpus_version=None):
+        """
+        Drops every entry, or only the entries of one corpus version.
+        """
+        with self._lock:
+            for entry_id in [e for e, (key, _, _) in self._entries.items()
+                             if corpus_version is None or key[0] == corpus_version]:
+                self._evict(entry_id)
+
+    def stats(self):
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "entries": len(self._entries),
+                "bytes": self._bytes,
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": self.hits / lookups if lookups else 0.0,
+            }
+
+    def _evict(self, entry_id):
+        bucket_key, _, answer = self._entries.pop(entry_id)
+        self._bytes -= len(answer.encode("utf-8"))
+        bucket = self._buckets[bucket_key]
+        bucket.discard(entry_id)
+        if not bucket:
+            del self._buckets[bucket_key]
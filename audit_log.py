@@ -0,0 +1,186 @@
+#################################################################
+####---------Background audit log of answered queries---------####
+#################################################################
+# search_docs hands a compact record to the log and returns immediately; a single
+# background thread appends the records in batches to a columnar HDF5 file.
+import atexit
+import os
+import queue
+import random
+import threading
+import time
+import h5py
+import numpy as np
+import pandas as pd
+
+AUDIT_LOG_PATH = os.environ.get("AUDIT_LOG_PATH", "audit_log.hdf5")
+AUDIT_SAMPLE_RATE = float(os.environ.get("AUDIT_SAMPLE_RATE", 1.0))
+AUDIT_MAX_BYTES = int(os.environ.get("AUDIT_MAX_BYTES", 64 * 1024 * 1024))
+AUDIT_BACKUP_COUNT = int(os.environ.get("AUDIT_BACKUP_COUNT", 5))
+AUDIT_TOP_K = int(os.environ.get("AUDIT_TOP_K", 20))  # ids and scores kept per query
+
+TIMING_COLUMNS = ("embed_ms", "search_ms", "total_ms")
+_STOP = object()
+
+
+class AuditLog:
+    """
+    Non-blocking, sampled audit log with size-based rotation.
+
+    Each record holds the query, embedding model, LLM, top-k chunk ids and scores, and the
+    timings in TIMING_COLUMNS. Chunk ids are rows of one corpus version, so the record also
+    keeps that corpus_version and the pdf_link (file and page) of every id, which stay
+    meaningful after later set-ups. When the file grows past max_bytes it is renamed to
+    <path>.1 (older files shift up to <path>.<backup_count>) and a new file is started.
+    """
+
+    def __init__(self, path=AUDIT_LOG_PATH, sample_rate=AUDIT_SAMPLE_RATE, max_bytes=AUDIT_MAX_BYTES,
+                 backup_count=AUDIT_BACKUP_COUNT, max_queue=10000, batch_size=256, flush_interval=1.0):
+        self.path = path
+        self.sample_rate = sample_rate
+        self.max_bytes = max_bytes
+        self.backup_count = backup_count
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.dropped = 0
+        self.written = 0
+        self._queue = queue.Queue(maxsize=max_queue)
+        self._thread = threading.Thread(target=self._run, name="audit-log", daemon=True)
+        self._thread.start()
+        atexit.register(self.close)
+
+    def record(self, query, model, top_ids, scores, llm="", timings=None, corpus_version="", sources=None):
+        """
+        Queues one query record. Never blocks: records are dropped when sampled out or
+        when the writer falls behind.
+
+        Returns:
+            bool: True if the record was queued.
+        """
+        if self.sample_rate < 1.0 and random.random() >= self.sample_rate:
+            return False
+        timings = timings or {}
+        entry = {
+            "timestamp": time.time(),
+            "query": query,
+            "model": model,
+            "llm": llm or "",
+            "top_ids": np.asarray(top_ids, dtype=np.int64),
+            "scores": np.asarray(scores, dtype=np.float32),
+            "corpus_version": corpus_version or "",
+            "sources": list(sources or []),
+        }
+        for column in TIMING_COLUMNS:
+            entry[column] = float(timings.get(column, np.nan))
+        try:
+            self._queue.put_nowait(entry)
+        except queue.Full:
+            self.dropped += 1
+            return False
+        return True
+
+    def close(self, timeout=5.0):
+        # Flushes queued records and stops the writer thread
+        if self._thread.is_alive():
+            self._queue.put(_STOP)
+            self._thread.join(timeout)
+
+    def _run(self):
+        pending = []
+        while True:
+            try:
+                entry = self._queue.get(timeout=self.flush_interval)
+            except queue.Empty:
+                entry = None
+            if entry is not None and entry is not _STOP:
+                pending.append(entry)
+            if pending and (entry is None or entry is _STOP or len(pending) >= self.batch_size):
+                try:
+                    self._write(pending)
+                    self.written += len(pending)
+                except Exception as e:
+                    print(f"Audit log error, {len(pending)} records lost: {str(e)}")
+                pending = []
+            if entry is _STOP:
+                return
+
+    def _rotate(self):
+        if not os.path.exists(self.path) or os.path.getsize(self.path) < self.max_bytes:
+            return
+        for i in range(self.backup_count - 1, 0, -1):
+            if os.path.exists(f"{self.path}.{i}"):
+                os.replace(f"{self.path}.{i}", f"{self.path}.{i + 1}")
+        if self.backup_count > 0:
+            os.replace(self.path, f"{self.path}.1")
+        else:
+            os.remove(self.path)
+
+    def _write(self, entries):
+        self._rotate()
+        str_dtype = h5py.string_dtype(encoding="utf-8")
+        columns = {
+            "timestamp": (np.asarray([e["timestamp"] for e in entries], dtype=np.float64), np.float64),
+            "query": ([e["query"] for e in entries], str_dtype),
+            "model": ([e["model"] for e in entries], str_dtype),
+            "llm": ([e["llm"] for e in entries], str_dtype),
+            "corpus_version": ([e["corpus_version"] for e in entries], str_dtype),
+            # pdf_link of every top id, one per line
+            "sources": (["\n".join(e["sources"]) for e in entries], str_dtype),
+            "top_ids": ([e["top_ids"] for e in entries], h5py.vlen_dtype(np.int64)),
+            "scores": ([e["scores"] for e in entries], h5py.vlen_dtype(np.float32)),
+        }
+        for column in TIMING_COLUMNS:
+            columns[column] = (np.asarray([e[column] for e in entries], dtype=np.float32), np.float32)
+        for name, (values, dtype) in columns.items():
+            if not isinstance(values, np.ndarray):
+                values_array = np.empty(len(values), dtype=object)
+                for i, value in enumerate(values):
+                    values_array[i] = value
+                columns[name] = (values_array, dtype)
+
+        with h5py.File(self.path, "a") as hdf5_file:
+            # Columns added since the file was started are padded with empty values
+            rows = hdf5_file["timestamp"].shape[0] if "timestamp" in hdf5_file else 0
+            for name, (values, dtype) in columns.items():
+                if name not in hdf5_file:
+                    hdf5_file.create_dataset(name, shape=(rows,), maxshape=(None,), dtype=dtype, chunks=(1024,))
+                dataset = hdf5_file[name]
+                start = dataset.shape[0]
+                dataset.resize(start + len(entries), axis=0)
+                if h5py.check_vlen_dtype(dataset.dtype) and not h5py.check_string_dtype(dataset.dtype):
+                    # h5py stacks equal-length arrays, so ragged columns are written row by row
+                    for offset, value in enumerate(values):
+                        dataset[start + offset] = value
+                else:
+                    dataset[start:] = values
+
+
+def read_audit_log(path=AUDIT_LOG_PATH):
+    """
+    Loads an audit log file into a DataFrame, one row per recorded query.
+    """
+    with h5py.File(path, "r") as hdf5_file:
+        data = {}
+        for name, dataset in hdf5_file.items():
+            if h5py.check_string_dtype(dataset.dtype):
+                data[name] = dataset.asstr()[()]
+            else:
+                data[name] = list(dataset[()]) if h5py.check_vlen_dtype(dataset.dtype) else dataset[()]
+    df = pd.DataFrame(data)
+    if "sources" in df:
+        df["sources"] = [sources.split("\n") if sources else [] for sources in df["sources"]]
+    if "timestamp" in df:
+        df["timestamp"] = pd.to_datetime(df["timestamp"], unit="s")
+    return df
+
+
+_audit_log = None
+_audit_log_lock = threading.Lock()
+
+def get_audit_log():
+    # The writer thread is started on the first recorded query
+    global _audit_log
+    with _audit_log_lock:
+        if _audit_log is None:
+            _audit_log = AuditLog()
+        return _audit_log
@@ -1,5 +1,17 @@
-from openai import AzureOpenAI,OpenAI
 import os
+import time
+
+from model_registry import get_azure_chat_client, get_openai_client, get_or_create
+from answer_cache import SemanticAnswerCache
+from token_chunker import count_tokens, truncate_tokens
+from metrics import get_metrics, incr, metrics_enabled, timed
+
+# Tokens kept free in the context window besides the answer (message framing, estimate errors)
+PROMPT_TOKEN_MARGIN = int(os.environ.get("PROMPT_TOKEN_MARGIN", 256))
+# Tokens of retrieved context the prompt always keeps; a longer answer is cut down instead
+MIN_CONTEXT_TOKENS = int(os.environ.get("MIN_CONTEXT_TOKENS", 512))
+# Paragraphs tokenized per count_tokens call while the context is packed
+PACK_TOKENIZE_BATCH = 16
 
 
 
@@ -31,17 +43,69 @@ Remember to:
 """
 
 
-import pandas as pd
+def pack_context(df, token_budget=None):
+    """
+    Selects the context of the prompt from the search results, best first. Chunks cut from
+    the same paragraph share one quote and one citation line. Paragraphs are added in order
+    until the next one does not fit in token_budget, and only the paragraphs considered are
+    tokenized. The best paragraph is always included, cut to the budget if it does not fit whole.
+
+    Args:
+        df (pd.DataFrame): Search results ordered by relevance (see search_docs).
+        token_budget (int): Tokens available for context and citations, None for no limit.
+
+    Returns:
+        tuple: (context, citations, chunk ids used)
+    """
+    paragraphs, links, pages, chunk_ids = (df["source_paragraph"].tolist(), df["pdf_link"].tolist(),
+                                           df["page"].tolist(), df.index.tolist())
+    # Positions of the chunks of every paragraph, paragraphs in order of their best chunk
+    groups = {}
+    for position, key in enumerate(zip(links, paragraphs)):
+        groups.setdefault(key, []).append(position)
+    groups = list(groups.items())
+
+    quotes, citation_lines, packed_ids, used = [], [], [], 0
+    full = False
+    for start in range(0, len(groups), PACK_TOKENIZE_BATCH):
+        if full:
+            break
+        batch = []
+        for (link, paragraph), positions in groups[start:start + PACK_TOKENIZE_BATCH]:
+            ids = ", ".join(str(chunk_ids[p]) for p in positions)
+            batch.append((paragraph, positions, f"> {paragraph}\n\n",
+                          f"- Chunk {ids}, Page {pages[positions[0]]}: [{link}]({link})\n"))
+        costs = count_tokens([q + c for _, _, q, c in batch]) if token_budget is not None else [0] * len(batch)
+        for (paragraph, positions, quote, citation), cost in zip(batch, costs):
+            if token_budget is not None and used + cost > token_budget:
+                if quotes:
+                    # The budget is full, the remaining paragraphs are never tokenized
+                    full = True
+                    break
+                # The best paragraph fills the budget, the model never answers without context
+                paragraph_tokens = max(1, token_budget - count_tokens([citation])[0] - 4)
+                quote = f"> {truncate_tokens(paragraph, paragraph_tokens)} ...\n\n"
+                cost = token_budget
+            quotes.append(quote)
+            citation_lines.append(citation)
+            packed_ids.extend(chunk_ids[p] for p in positions)
+            used += cost
 
-def make_cited_rag_prompt(query, df):
-    # Generate context and citations
-    context = ""
-    citations = ""
-    
-    for _, row in df.iterrows():
-        context += f"> {row['source_paragraph']}\n\n"
-        citations += f"- Chunk {row['chunk']}, Page {row['page']}: [{row['pdf_link']}]({row['pdf_link']})\n"
+    incr("chunks_in_prompt", len(packed_ids))
+    return "".join(quotes), "".join(citation_lines), packed_ids
 
+@timed("prompt_build")
+def make_cited_rag_prompt(query, df, token_budget=None):
+    """
+    Builds the user prompt. token_budget bounds the whole prompt in tokens: the context is
+    packed (see pack_context) into what the instructions and the query leave free.
+    """
+    if token_budget is not None:
+        token_budget -= count_tokens([_format_prompt(query, "", "")])[0]
+    context, citations, _ = pack_context(df, token_budget)
+    return _format_prompt(query, context, citations)
+
+def _format_prompt(query, context, citations):
     # Construct final prompt
     prompt =f"""
     ### Instructions:
@@ -93,50 +157,122 @@ def make_cited_rag_prompt(query, df):
 
 
 
-def get_cited_RAG_completion(query, search_results,llm_choice, n_results=3, temp_def=0.5, max_tokens=300,system_prompt=system_prompt, ):
-    formatted_query = make_cited_rag_prompt(query, search_results)
+def get_answer_cache():
+    return get_or_create(("answer_cache",), SemanticAnswerCache)
+
+get_metrics().register_collector("answer_cache", lambda: get_answer_cache().stats())
+
+def _count_prompt_tokens(system_prompt, formatted_query):
+    # Tokenizing the prompt has a cost, so it is only counted when metrics are enabled
+    if metrics_enabled():
+        incr("prompt_tokens", sum(count_tokens([system_prompt, formatted_query])))
+
+def _answer_cache_key(search_results, llm_choice, temp_def, max_tokens):
+    # Chunk ids are the corpus row labels; the corpus version is set by setup_process
+    return (search_results.attrs.get("corpus_version"), search_results.index, llm_choice, temp_def, max_tokens)
+
+def prompt_token_budget(context_tokens, max_tokens, system_prompt=system_prompt):
+    # Tokens left for the user prompt once the system prompt and the answer are reserved
+    if not context_tokens:
+        return None
+    return max(0, context_tokens - max_tokens - count_tokens([system_prompt])[0] - PROMPT_TOKEN_MARGIN)
+
+def fit_answer_tokens(query, context_tokens, max_tokens, system_prompt=system_prompt):
+    """
+    Returns max_tokens, lowered when reserving that many answer tokens would leave less
+    than MIN_CONTEXT_TOKENS of the context window for the retrieved context.
+    """
+    if not context_tokens:
+        return max_tokens
+    fixed = count_tokens([system_prompt, _format_prompt(query, "", "")])
+    return max(1, min(max_tokens, context_tokens - sum(fixed) - PROMPT_TOKEN_MARGIN - MIN_CONTEXT_TOKENS))
+
+def get_cited_RAG_completion(query, search_results,llm_choice, n_results=3, temp_def=0.5, max_tokens=300,system_prompt=system_prompt, query_embedding=None,
+                             context_tokens=None):
+    """
+    Returns the LLM answer for the query and its search results. When query_embedding is
+    given, answers to the same (or a near-identical) question over the same chunks and
+    generation parameters are served from the semantic answer cache. context_tokens is the
+    model's context window (context_window of LLM_CONFIGS); the prompt is packed to fit in
+    it. The answer is collected from stream_cited_RAG_completion.
+    """
+    return "".join(stream_cited_RAG_completion(query, search_results, llm_choice, n_results, temp_def=temp_def,
+                                               max_tokens=max_tokens, system_prompt=system_prompt,
+                                               query_embedding=query_embedding, context_tokens=context_tokens))
+
+
+def stream_cited_RAG_completion(query, search_results,llm_choice, n_results=3, temp_def=0.5, max_tokens=300,system_prompt=system_prompt, query_embedding=None,
+                                context_tokens=None):
+    """
+    Streaming variant of get_cited_RAG_completion: yields pieces of the answer text as the
+    model generates them, so the first tokens can be shown before generation finishes.
+    A cached answer is yielded in one piece, an error as one "Error: ..." piece. When
+    max_tokens leaves too little of the context window for the context, it is lowered
+    and a note saying so is yielded first.
+    """
+    answer_tokens = fit_answer_tokens(query, context_tokens, max_tokens, system_prompt)
+    if answer_tokens < max_tokens:
+        note = (f"> Note: Max Tokens lowered from {max_tokens} to {answer_tokens} to leave room for the "
+                f"retrieved context in the {context_tokens}-token context window of {llm_choice}.\n\n")
+        print(note)
+        yield note
+        max_tokens = answer_tokens
+
+    cache_key = _answer_cache_key(search_results, llm_choice, temp_def, max_tokens)
+    use_cache = query_embedding is not None and cache_key[0] is not None
+    if use_cache:
+        cached = get_answer_cache().lookup(query_embedding, *cache_key)
+        if cached is not None:
+            yield cached
+            return
+
+    formatted_query = make_cited_rag_prompt(query, search_results,
+                                            prompt_token_budget(context_tokens, max_tokens, system_prompt))
     print("\n********This is the cited RAG prompt********\n")
     print(formatted_query)
     print("\n*********************************\n")
-    
+    _count_prompt_tokens(system_prompt, formatted_query)
+
     if llm_choice == 'AzureGPT':
-        try:
-            client = AzureOpenAI(
-                azure_endpoint=os.environ.get("AZURE_OPENAI_ENDPOINT"),
-                api_key=os.environ.get("AZURE_OPENAI_KEY"),
-                api_version=os.environ.get("AZURE_VERSION")
-            )
-            completion = client.chat.completions.create(
-                model="gpt4-testing-app",  # Your Azure deployment name
-                messages=[
-                    {"role": "system", "content": system_prompt},
-                    {"role": "user", "content": formatted_query}
-                ],
-                max_tokens=max_tokens,
-                temperature=temp_def
-            )
-            ans = completion.choices[0].message.content
-        except Exception as e:
-            print(f"Azure OpenAI Error: {str(e)}")
-            ans = f"Error: {str(e)}"
+        provider = "Azure OpenAI"
+        model = "gpt4-testing-app"  # Your Azure deployment name
     else:
-        try:
-            client = OpenAI(api_key=os.environ.get("OPENAI_API_KEY"))
-            completion = client.chat.completions.create(
-                model=llm_choice,  # Use the selected model directly
-                messages=[
-                    {"role": "system", "content": system_prompt},
-                    {"role": "user", "content": formatted_query}
-                ],
-                max_tokens=max_tokens,
-                temperature=temp_def
-            )
-            ans = completion.choices[0].message.content
-        except Exception as e:
-            print(f"OpenAI Error: {str(e)}")
-            ans = f"Error: {str(e)}"
-    
-    return ans
+        provider = "OpenAI"
+        model = llm_choice  # Use the selected model directly
+
+    start_time = time.perf_counter()
+    incr("llm_api_calls")
+    try:
+        client = get_azure_chat_client() if llm_choice == 'AzureGPT' else get_openai_client()
+        stream = client.chat.completions.create(
+            model=model,
+            messages=[
+                {"role": "system", "content": system_prompt},
+                {"role": "user", "content": formatted_query}
+            ],
+            max_tokens=max_tokens,
+            temperature=temp_def,
+            stream=True
+        )
+        ans = ""
+        for chunk in stream:
+            # Azure sends content-filter chunks without choices
+            if chunk.choices and chunk.choices[0].delta.content:
+                if not ans:
+                    get_metrics().observe("llm_first_token", time.perf_counter() - start_time)
+                ans += chunk.choices[0].delta.content
+                yield chunk.choices[0].delta.content
+    except Exception as e:
+        print(f"{provider} Error: {str(e)}")
+        incr("llm_api_errors")
+        get_metrics().observe("llm_completion", time.perf_counter() - start_time, error=True)
+        yield f"Error: {str(e)}"
+        return
+    get_metrics().observe("llm_completion", time.perf_counter() - start_time)
+
+    # An empty (e.g. content-filtered) answer is not cached
+    if use_cache and ans.strip():
+        get_answer_cache().store(query_embedding, *cache_key, ans)
 
 
 
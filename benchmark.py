@@ -0,0 +1,497 @@
+#################################################################
+####---------End-to-end pipeline benchmark---------------------####
+#################################################################
+# Runs ingest (PDF extraction, chunking, checkpointed embedding and storing, indexing) and query (search,
+# prompt packing, completion) on a synthetic corpus, against a local HTTP stand-in for the
+# OpenAI and Azure OpenAI endpoints, and writes per-stage throughput, p50/p99 latency and
+# peak RSS as JSON. Every corpus size runs in its own process, in a scratch directory,
+# so peak RSS is not carried over from one size to the next.
+#
+#   python benchmark.py --chunks 1000 10000 100000 --output bench.json
+#   python benchmark.py --chunks 1000 10000 100000 --output new.json --compare bench.json
+import argparse
+import base64
+import contextlib
+import hashlib
+import json
+import os
+import platform
+import resource
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import urllib.request
+import zlib
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import numpy as np
+import h5py
+
+BENCH_VOCABULARY = (
+    "reactor coolant system pressure vessel containment isolation valve emergency core cooling "
+    "injection pump accumulator steam generator tube rupture feedwater turbine trip scram rod "
+    "control boron dilution decay heat removal residual loop break loss of offsite power diesel "
+    "generator battery instrumentation setpoint surveillance technical specification limiting "
+    "condition operation fuel cladding temperature peak oxidation hydrogen recombiner spray "
+    "sump recirculation seismic category design basis accident analysis single failure "
+    "criterion redundancy separation channel logic actuation signal operator action license "
+    "amendment inspection finding licensee event report safety evaluation"
+).split()
+BENCH_REFERENCES = ("GDC 55", "GDC 17", "10 CFR 50.46", "10 CFR 50.59", "Section 3.1-2", "Appendix K")
+# Options passed on from the main process to every worker
+WORKER_OPTIONS = ("model", "llm", "chunk_size", "overlap", "paragraph_words", "pdfs", "queries", "batch_size",
+                  "mode", "top_n", "max_tokens", "context_tokens")
+# Answer returned by the stub chat endpoint, with a citation as the system prompt asks
+STUB_ANSWER = "The emergency core cooling system must keep the peak cladding temperature below 2200 F [1]."
+
+
+########################################################################################
+#########------Local stand-in for the OpenAI / Azure OpenAI endpoints -------###########
+########################################################################################
+def stub_embedding(text, dimension):
+    """
+    Deterministic embedding of a text: hashed, signed bag of words, so texts sharing
+    words are similar and retrieval over the stub vectors is meaningful.
+    """
+    hashes = np.fromiter((zlib.crc32(w.encode("utf-8")) for w in text.lower().split()), dtype=np.int64)
+    signs = np.where(hashes & 1, 1.0, -1.0)
+    vector = np.bincount((hashes >> 1) % dimension, weights=signs, minlength=dimension).astype(np.float32)
+    norm = np.linalg.norm(vector)
+    return vector / norm if norm else vector
+
+
+class _StubHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, *args):
+        pass
+
+    def _send_json(self, payload, status=200, headers=None):
+        data = json.dumps(payload).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        for key, value in (headers or {}).items():
+            self.send_header(key, value)
+        self.end_headers()
+        self.wfile.write(data)
+
+    def do_GET(self):
+        if self.path.startswith("/stats"):
+            self._send_json(self.server.stats())
+        else:
+            self._send_json({"error": {"message": "not found"}}, status=404)
+
+    def do_POST(self):
+        body = json.loads(self.rfile.read(int(self.headers.get("Content-Length", 0))) or b"{}")
+        path = self.path.split("?")[0]
+        kind = "embeddings" if path.endswith("/embeddings") else "chat" if path.endswith("/chat/completions") else None
+        if kind is None:
+            self._send_json({"error": {"message": "not found"}}, status=404)
+            return
+        if self.server.count(kind):
+            # Simulated rate limit, exercises the client's retry and backoff
+            self._send_json({"error": {"message": "stub rate limit", "type": "rate_limit_error"}}, status=429,
+                            headers={"Retry-After": "0"})
+            return
+        if self.server.latency:
+            time.sleep(self.server.latency)
+        if kind == "embeddings":
+            self._embeddings(body)
+        elif body.get("stream"):
+            self._stream_chat(body)
+        else:
+            self._send_json({
+                "id": "stub", "object": "chat.completion", "created": int(time.time()), "model": body.get("model"),
+                "choices": [{"index": 0, "message": {"role": "assistant", "content": STUB_ANSWER}, "finish_reason": "stop"}],
+                "usage": {"prompt_tokens": 0, "completion_tokens": 0, "total_tokens": 0},
+            })
+
+    def _embeddings(self, body):
+        inputs = body.get("input", [])
+        inputs = [inputs] if isinstance(inputs, str) else inputs
+        as_base64 = body.get("encoding_format") == "base64"
+        data = []
+        for i, text in enumerate(inputs):
+            vector = stub_embedding(text, self.server.dimension)
+            embedding = base64.b64encode(vector.tobytes()).decode("ascii") if as_base64 else vector.tolist()
+            data.append({"object": "embedding", "index": i, "embedding": embedding})
+        n_tokens = sum(len(text.split()) for text in inputs)
+        self._send_json({"object": "list", "data": data, "model": body.get("model"),
+                         "usage": {"prompt_tokens": n_tokens, "total_tokens": n_tokens}})
+
+    def _stream_chat(self, body):
+        self.send_response(200)
+        self.send_header("Content-Type", "text/event-stream")
+        self.send_header("Connection", "close")
+        self.end_headers()
+        self.close_connection = True
+        for word in STUB_ANSWER.split(" "):
+            chunk = {"id": "stub", "object": "chat.completion.chunk", "created": int(time.time()),
+                     "model": body.get("model"),
+                     "choices": [{"index": 0, "delta": {"content": word + " "}, "finish_reason": None}]}
+            self.wfile.write(f"data: {json.dumps(chunk)}\n\n".encode("utf-8"))
+        self.wfile.write(b"data: [DONE]\n\n")
+
+
+class StubOpenAIServer(ThreadingHTTPServer):
+    """
+    Local HTTP server answering /embeddings and /chat/completions requests in the
+    OpenAI and Azure OpenAI formats (see stub_env for the client settings).
+
+    Args:
+        dimension (int): Size of the returned embeddings.
+        latency_ms (float): Delay added to every request.
+        error_rate (float): Fraction of requests answered with a 429 rate-limit error.
+    """
+    daemon_threads = True
+
+    def __init__(self, dimension=1536, latency_ms=0.0, error_rate=0.0, port=0):
+        super().__init__(("127.0.0.1", port), _StubHandler)
+        self.dimension = dimension
+        self.latency = latency_ms / 1000
+        self.error_rate = error_rate
+        self._counts = {"embeddings": 0, "chat": 0, "rate_limited": 0}
+        self._lock = threading.Lock()
+        self._random = np.random.default_rng(0)
+
+    @property
+    def url(self):
+        return f"http://127.0.0.1:{self.server_address[1]}"
+
+    def count(self, kind):
+        # Counts a request; returns True when it should be rejected with a rate limit
+        with self._lock:
+            self._counts[kind] += 1
+            limited = self.error_rate > 0 and self._random.random() < self.error_rate
+            if limited:
+                self._counts["rate_limited"] += 1
+        return limited
+
+    def stats(self):
+        with self._lock:
+            return dict(self._counts)
+
+    def start(self):
+        threading.Thread(target=self.serve_forever, daemon=True).start()
+        return self
+
+def stub_env(url):
+    # Client settings read by model_registry: both OpenAI and Azure clients hit the stub
+    return {
+        "OPENAI_BASE_URL": f"{url}/v1", "OPENAI_API_KEY": "stub",
+        "AZURE_EMB_ENDPOINT": url, "AZURE_EMB_API_KEY": "stub",
+        "AZURE_OPENAI_ENDPOINT": url, "AZURE_OPENAI_KEY": "stub",
+        "AZURE_VERSION": "2024-02-01",
+    }
+
+def _stub_stats(url):
+    with urllib.request.urlopen(f"{url}/stats") as response:
+        return json.loads(response.read())
+
+
+########################################################################################
+#########------Synthetic corpus -------#################################################
+########################################################################################
+def _synthetic_paragraphs(rng, n_paragraphs, paragraph_words):
+    words = np.asarray(BENCH_VOCABULARY, dtype=object)[rng.integers(len(BENCH_VOCABULARY), size=(n_paragraphs, paragraph_words))]
+    references = rng.choice(BENCH_REFERENCES, size=n_paragraphs)
+    return [f"{' '.join(row)} per {reference}." for row, reference in zip(words, references)]
+
+def write_synthetic_corpus(hdf5_filename, n_paragraphs, paragraph_words=128, paragraphs_per_doc=200,
+                           paragraphs_per_page=10, seed=0):
+    """
+    Writes synthetic documents to an HDF5 file in the layout of update_pdfs_in_hdf5, as if
+    their PDFs had been extracted, one document at a time.
+
+    Returns:
+        dict: Content hash of every document, keyed by filename.
+    """
+    rng = np.random.default_rng(seed)
+    doc_hashes = {}
+    with h5py.File(hdf5_filename, "w") as hdf5_file:
+        for start in range(0, n_paragraphs, paragraphs_per_doc):
+            paragraphs = _synthetic_paragraphs(rng, min(paragraphs_per_doc, n_paragraphs - start), paragraph_words)
+            filename = f"synthetic_{start // paragraphs_per_doc:06d}.pdf"
+            pdf_json = json.dumps({
+                "filename": filename,
+                "link": f"file:///synthetic/{filename}",
+                "pages": {p // paragraphs_per_page + 1: paragraphs[p:p + paragraphs_per_page]
+                          for p in range(0, len(paragraphs), paragraphs_per_page)},
+            })
+            dataset = hdf5_file.create_dataset(filename, data=pdf_json)
+            dataset.attrs["content_hash"] = doc_hashes[filename] = hashlib.sha256(pdf_json.encode("utf-8")).hexdigest()
+            dataset.attrs["deleted"] = False
+    return doc_hashes
+
+def write_synthetic_pdfs(directory, n_docs, pages_per_doc=5, paragraphs_per_page=6, paragraph_words=60, seed=0):
+    """
+    Writes small real PDFs of synthetic paragraphs, to time the PDF extraction stage.
+
+    Returns:
+        list: Paths of the PDFs.
+    """
+    import fitz
+    rng = np.random.default_rng(seed)
+    os.makedirs(directory, exist_ok=True)
+    paths = []
+    for d in range(n_docs):
+        doc = fitz.open()
+        for _ in range(pages_per_doc):
+            page = doc.new_page()
+            text = "\n\n".join(_synthetic_paragraphs(rng, paragraphs_per_page, paragraph_words))
+            page.insert_textbox(fitz.Rect(36, 36, page.rect.width - 36, page.rect.height - 36), text, fontsize=8)
+        path = os.path.join(directory, f"synthetic_{d:04d}.pdf")
+        doc.save(path)
+        doc.close()
+        paths.append(path)
+    return paths
+
+def synthetic_queries(n_queries, query_words=8, seed=1):
+    return [f"What does {text}" for text in _synthetic_paragraphs(np.random.default_rng(seed), n_queries, query_words)]
+
+
+########################################################################################
+#########------Benchmark run (one corpus size, in a worker process) -------#############
+########################################################################################
+def peak_rss_mb():
+    # Peak resident set size of this process so far (ru_maxrss is in KB on Linux, bytes on macOS)
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak / (1 << 20) if sys.platform == "darwin" else peak / 1024
+
+def stage_result(seconds, items, latencies=None, requests=None):
+    result = {"items": items, "seconds": round(seconds, 6),
+              "throughput": round(items / seconds, 3) if seconds > 0 else None,
+              "peak_rss_mb": round(peak_rss_mb(), 1)}
+    if latencies:
+        latencies_ms = np.asarray(latencies) * 1000
+        result["p50_ms"] = round(float(np.percentile(latencies_ms, 50)), 3)
+        result["p99_ms"] = round(float(np.percentile(latencies_ms, 99)), 3)
+    if requests is not None:
+        result["api_requests"] = requests
+    return result
+
+def _timed_calls(fn, args_list):
+    latencies = []
+    start = time.perf_counter()
+    for args in args_list:
+        call_start = time.perf_counter()
+        fn(*args)
+        latencies.append(time.perf_counter() - call_start)
+    return time.perf_counter() - start, latencies
+
+def run_benchmark(n_chunks, args):
+    """
+    Runs every stage on a synthetic corpus of about n_chunks chunks in the current
+    directory and returns the per-stage results.
+    """
+    # Pipeline modules are imported here, after the stub endpoints were put in the environment
+    from hdf5_file_constructor import update_pdfs_in_hdf5, EMBEDDINGS_HDF5
+    from embeddings import (create_rag_chunks_from_hdf5, embed_and_store, embedding_model_key, load_search_corpus,
+                            search_docs, search_docs_batch, ANSWER_TOP_K)
+    from azure_gpt import make_cited_rag_prompt, get_cited_RAG_completion
+    from vector_store import register_corpus
+    from metrics import get_metrics, metrics_enabled
+
+    stub_url = os.environ["OPENAI_BASE_URL"].rsplit("/v1", 1)[0]
+    quiet = contextlib.redirect_stdout(open(os.devnull, "w")) if not args.verbose else contextlib.nullcontext()
+    stages = {}
+    model_key = embedding_model_key(args.model, args.llm)
+    paragraph_words = args.paragraph_words or max(8, args.chunk_size // 2)
+
+    with quiet:
+        if args.pdfs:
+            paths = write_synthetic_pdfs("pdfs", args.pdfs)
+            start = time.perf_counter()
+            update_pdfs_in_hdf5(paths, "extracted_pdfs.hdf5")
+            stages["pdf_extract"] = stage_result(time.perf_counter() - start, len(paths))
+
+        start = time.perf_counter()
+        doc_hashes = write_synthetic_corpus("pdfs_chunks.hdf5", n_chunks, paragraph_words)
+        generate_seconds = time.perf_counter() - start
+
+        start = time.perf_counter()
+        rag_chunks = create_rag_chunks_from_hdf5("pdfs_chunks.hdf5", args.chunk_size, args.overlap, model_name=args.model)
+        stages["chunk"] = stage_result(time.perf_counter() - start, len(rag_chunks))
+
+        # The Set Up path: checkpoints of EMBEDDING_CHECKPOINT_CHUNKS chunks are embedded and
+        # appended to the store one at a time, so only one checkpoint of vectors is in memory
+        requests_before = _stub_stats(stub_url)
+        start = time.perf_counter()
+        stored = embed_and_store(rag_chunks, args.model, args.llm, EMBEDDINGS_HDF5, args.chunk_size, args.overlap,
+                                 doc_hashes)
+        seconds = time.perf_counter() - start
+        if not stored:
+            raise RuntimeError(f"Embedding with {args.model} failed, rerun with --verbose for the error")
+        stages["embed_store"] = stage_result(seconds, len(rag_chunks),
+                                             requests=_stub_stats(stub_url)["embeddings"] - requests_before["embeddings"])
+        del rag_chunks
+
+        start = time.perf_counter()
+        corpus = load_search_corpus(EMBEDDINGS_HDF5, model_key, args.chunk_size, args.overlap)
+        handle = register_corpus(corpus)
+        stages["index"] = stage_result(time.perf_counter() - start, len(corpus))
+
+        queries = synthetic_queries(args.queries)
+        results = {}
+
+        def search(query):
+            # Capped as in the UI, so the prompt stage packs what answer_question would
+            results[query] = search_docs(handle, query, args.model, args.llm, args.top_n, to_print=True,
+                                         top_k=ANSWER_TOP_K, mode=args.mode)
+        seconds, latencies = _timed_calls(search, [(q,) for q in queries])
+        stages["search"] = stage_result(seconds, len(queries), latencies)
+
+        seconds, latencies = _timed_calls(lambda q: make_cited_rag_prompt(q, results[q], args.context_tokens),
+                                          [(q,) for q in queries])
+        stages["prompt"] = stage_result(seconds, len(queries), latencies)
+
+        seconds, latencies = _timed_calls(
+            lambda q: get_cited_RAG_completion(q, results[q], args.llm, max_tokens=args.max_tokens,
+                                               context_tokens=args.context_tokens),
+            [(q,) for q in queries])
+        stages["completion"] = stage_result(seconds, len(queries), latencies)
+
+        # Fresh queries, so none of them is served from the query embedding cache
+        batch_queries = synthetic_queries(args.queries, seed=2)
+        batches = [(batch_queries[i:i + args.batch_size],) for i in range(0, len(batch_queries), args.batch_size)]
+        seconds, latencies = _timed_calls(
+            lambda batch: search_docs_batch(handle, batch, args.model, args.llm, args.top_n, top_k=ANSWER_TOP_K,
+                                            mode=args.mode), batches)
+        stages["search_batch"] = stage_result(seconds, len(batch_queries), latencies)
+
+    result = {"target_chunks": n_chunks, "n_chunks": len(corpus), "n_documents": len(doc_hashes),
+              "generate_seconds": round(generate_seconds, 3), "stages": stages}
+    if metrics_enabled():
+        # Spans and counters of the pipeline itself (METRICS_ENABLED=1)
+        result["metrics"] = get_metrics().snapshot()
+    return result
+
+
+def _run_size(n_chunks, args, env):
+    workdir = tempfile.mkdtemp(prefix=f"rag_bench_{n_chunks}_", dir=args.workdir)
+    result_path = os.path.join(workdir, "result.json")
+    command = [sys.executable, os.path.abspath(__file__), "--worker", "--result", result_path,
+               "--chunks", str(n_chunks)] + args.worker_args
+    try:
+        subprocess.run(command, cwd=workdir, env=env, check=True)
+        with open(result_path) as f:
+            return json.load(f)
+    finally:
+        if not args.keep:
+            shutil.rmtree(workdir, ignore_errors=True)
+
+def _git_commit():
+    try:
+        return subprocess.run(["git", "rev-parse", "HEAD"], cwd=os.path.dirname(os.path.abspath(__file__)),
+                              capture_output=True, text=True, check=True).stdout.strip()
+    except Exception:
+        return None
+
+def compare_results(baseline, current, tolerance=0.1):
+    """
+    Compares the stage throughputs of two benchmark results (matched by corpus size).
+
+    Returns:
+        list: (target_chunks, stage, baseline throughput, current throughput) of the
+        stages more than tolerance slower than the baseline.
+    """
+    regressions = []
+    baseline_runs = {run["target_chunks"]: run for run in baseline["runs"]}
+    for run in current["runs"]:
+        base = baseline_runs.get(run["target_chunks"])
+        if base is None:
+            continue
+        for stage, result in run["stages"].items():
+            old = base["stages"].get(stage, {}).get("throughput")
+            new = result.get("throughput")
+            if old and new is not None:
+                flag = "  REGRESSION" if new < old * (1 - tolerance) else ""
+                print(f"{run['target_chunks']:>9} {stage:<13} {old:>12.1f} -> {new:>12.1f} /s ({new / old - 1:+.1%}){flag}")
+                if flag:
+                    regressions.append((run["target_chunks"], stage, old, new))
+    return regressions
+
+def _print_summary(results):
+    for run in results["runs"]:
+        print(f"\n{run['n_chunks']} chunks in {run['n_documents']} documents")
+        for stage, result in run["stages"].items():
+            latency = f"  p50 {result['p50_ms']:.2f} ms  p99 {result['p99_ms']:.2f} ms" if "p50_ms" in result else ""
+            print(f"  {stage:<13} {result['throughput'] or 0:>12.1f} /s{latency}  peak RSS {result['peak_rss_mb']:.0f} MB")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark ingest and query on a synthetic corpus.")
+    parser.add_argument("--chunks", type=int, nargs="+", default=[1000, 10000], help="corpus sizes, in chunks")
+    parser.add_argument("--model", default="text-embedding-ada-002")
+    parser.add_argument("--llm", default="gpt-4o-mini")
+    parser.add_argument("--chunk-size", type=int, default=256)
+    parser.add_argument("--overlap", type=int, default=50)
+    parser.add_argument("--paragraph-words", type=int, default=0, help="words per synthetic paragraph (0: chunk size / 2)")
+    parser.add_argument("--pdfs", type=int, default=10, help="synthetic PDFs for the extraction stage (0: skip)")
+    parser.add_argument("--queries", type=int, default=200)
+    parser.add_argument("--batch-size", type=int, default=32, help="queries per search_docs_batch call")
+    parser.add_argument("--mode", default="dense", choices=["dense", "lexical", "hybrid"])
+    parser.add_argument("--top-n", type=int, default=20)
+    parser.add_argument("--max-tokens", type=int, default=300)
+    parser.add_argument("--context-tokens", type=int, default=4096)
+    parser.add_argument("--dimension", type=int, default=1536, help="size of the stub embeddings")
+    parser.add_argument("--latency-ms", type=float, default=0.0, help="delay added to every stub request")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="fraction of stub requests rate-limited")
+    parser.add_argument("--output", default="benchmark_results.json")
+    parser.add_argument("--compare", help="earlier results to compare against")
+    parser.add_argument("--tolerance", type=float, default=0.1, help="throughput drop reported as a regression")
+    parser.add_argument("--workdir", help="parent of the scratch directories (default: system temp)")
+    parser.add_argument("--keep", action="store_true", help="keep the scratch directories")
+    parser.add_argument("--verbose", action="store_true", help="show the pipeline's own output")
+    parser.add_argument("--worker", action="store_true", help=argparse.SUPPRESS)
+    parser.add_argument("--result", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.worker:
+        result = run_benchmark(args.chunks[0], args)
+        with open(args.result, "w") as f:
+            json.dump(result, f)
+        return 0
+
+    args.worker_args = [f"--{name.replace('_', '-')}={getattr(args, name)}" for name in WORKER_OPTIONS]
+    if args.verbose:
+        args.worker_args.append("--verbose")
+
+    # The stub runs in this process, so it does not count towards the workers' peak RSS
+    server = StubOpenAIServer(args.dimension, args.latency_ms, args.error_rate).start()
+    env = {**os.environ, **stub_env(server.url),
+           "PYTHONPATH": os.pathsep.join(filter(None, [os.path.dirname(os.path.abspath(__file__)),
+                                                        os.environ.get("PYTHONPATH")]))}
+    results = {
+        "meta": {"timestamp": time.strftime("%Y-%m-%dT%H:%M:%S%z"), "git_commit": _git_commit(),
+                 "python": platform.python_version(), "platform": platform.platform(),
+                 "cpu_count": os.cpu_count(),
+                 "args": {k: v for k, v in vars(args).items() if k not in ("worker", "result", "worker_args")}},
+        "runs": [],
+    }
+    try:
+        for n_chunks in args.chunks:
+            print(f"Benchmarking {n_chunks} chunks")
+            results["runs"].append(_run_size(n_chunks, args, env))
+    finally:
+        server.shutdown()
+        results["meta"]["stub_requests"] = server.stats()
+
+    with open(args.output, "w") as f:
+        json.dump(results, f, indent=2)
+    _print_summary(results)
+    print(f"\nResults written to {args.output}")
+
+    if args.compare:
+        with open(args.compare) as f:
+            regressions = compare_results(json.load(f), results, args.tolerance)
+        if regressions:
+            print(f"{len(regressions)} stages regressed by more than {args.tolerance:.0%}")
+            return 1
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,183 @@
+#################################################################
+####---------Compact, normalized table of RAG chunks-----------####
+#################################################################
+# A chunk is three integers: the paragraph it was cut from and its character span in
+# that paragraph. Paragraph texts are stored once in a paragraph table and file names
+# and links once in a document table, so overlapping chunks no longer copy the full
+# paragraph (and a formatted link) each. Texts are resolved on demand, e.g. only for
+# the top-k hits of a query (see to_frame).
+from array import array
+import numpy as np
+import pandas as pd
+
+# Columns resolved by to_frame / __getitem__, in the order of the former chunk dictionaries
+TEXT_COLUMNS = ("chunk", "source_paragraph", "page", "pdf_link", "filename")
+
+
+class ChunkTable:
+    """
+    Array-backed chunk table.
+
+    Documents: doc_filenames, doc_links. Paragraphs: paragraphs (texts), paragraph_doc,
+    paragraph_page. Chunks: chunk_paragraph, chunk_start, chunk_end (character offsets in the
+    paragraph). Optional per-chunk columns: embeddings (list of vectors), terms (CSR
+    (indptr, indices, data) lexical term counts, see lexical_index.py) and store_rows (rows
+    in the HDF5 embedding group). attrs holds metadata such as the corpus_version, like
+    DataFrame.attrs.
+    """
+
+    def __init__(self, doc_filenames=None, doc_links=None, paragraphs=None, paragraph_doc=None,
+                 paragraph_page=None, chunk_paragraph=None, chunk_start=None, chunk_end=None,
+                 embeddings=None, terms=None, store_rows=None):
+        self.doc_filenames = list(doc_filenames or [])
+        self.doc_links = list(doc_links or [])
+        self.paragraphs = list(paragraphs or [])
+        self.paragraph_doc = array("i", [] if paragraph_doc is None else paragraph_doc)
+        self.paragraph_page = array("i", [] if paragraph_page is None else paragraph_page)
+        self.chunk_paragraph = array("i", [] if chunk_paragraph is None else chunk_paragraph)
+        self.chunk_start = array("i", [] if chunk_start is None else chunk_start)
+        self.chunk_end = array("i", [] if chunk_end is None else chunk_end)
+        self.embeddings = embeddings
+        self.terms = terms
+        self.store_rows = None if store_rows is None else np.asarray(store_rows, dtype=np.int64)
+        self.attrs = {}
+
+    def add_document(self, filename, link):
+        self.doc_filenames.append(filename)
+        self.doc_links.append(link)
+        return len(self.doc_filenames) - 1
+
+    def add_paragraph(self, doc_id, page, text):
+        self.paragraphs.append(text)
+        self.paragraph_doc.append(doc_id)
+        self.paragraph_page.append(int(page))
+        return len(self.paragraphs) - 1
+
+    def add_chunk(self, paragraph_id, start, end):
+        self.chunk_paragraph.append(paragraph_id)
+        self.chunk_start.append(start)
+        self.chunk_end.append(end)
+
+    def __len__(self):
+        return len(self.chunk_paragraph)
+
+    def __repr__(self):
+        return (f"ChunkTable({len(self)} chunks, {len(self.paragraphs)} paragraphs, "
+                f"{len(self.doc_filenames)} documents)")
+
+    def chunk_text(self, i):
+        paragraph = self.paragraphs[self.chunk_paragraph[i]]
+        # Whitespace is collapsed, as when chunks were built by joining words
+        return " ".join(paragraph[self.chunk_start[i]:self.chunk_end[i]].split())
+
+    def pdf_link(self, i):
+        paragraph_id = self.chunk_paragraph[i]
+        return f"{self.doc_links[self.paragraph_doc[paragraph_id]]}#page={self.paragraph_page[paragraph_id]}"
+
+    def _ids(self, ids):
+        return range(len(self)) if ids is None else [int(i) for i in ids]
+
+    def texts(self, ids=None):
+        return [self.chunk_text(i) for i in self._ids(ids)]
+
+    def pdf_links(self, ids=None):
+        return [self.pdf_link(i) for i in self._ids(ids)]
+
+    def select(self, ids):
+        """
+        Returns a new ChunkTable holding the given chunks, with only the paragraphs and
+        documents they reference (renumbered). embeddings, terms and store_rows are selected too.
+        """
+        ids = np.asarray(ids, dtype=np.int64)
+        paragraph_ids, chunk_paragraph = np.unique(np.asarray(self.chunk_paragraph, dtype=np.int32)[ids],
+                                                   return_inverse=True)
+        doc_ids, paragraph_doc = np.unique(np.asarray(self.paragraph_doc, dtype=np.int32)[paragraph_ids],
+                                           return_inverse=True)
+        table = ChunkTable(
+            doc_filenames=[self.doc_filenames[d] for d in doc_ids],
+            doc_links=[self.doc_links[d] for d in doc_ids],
+            paragraphs=[self.paragraphs[p] for p in paragraph_ids],
+            paragraph_doc=paragraph_doc.astype(np.int32).reshape(-1).tolist(),
+            paragraph_page=np.asarray(self.paragraph_page, dtype=np.int32)[paragraph_ids].tolist(),
+            chunk_paragraph=chunk_paragraph.astype(np.int32).reshape(-1).tolist(),
+            chunk_start=np.asarray(self.chunk_start, dtype=np.int32)[ids].tolist(),
+            chunk_end=np.asarray(self.chunk_end, dtype=np.int32)[ids].tolist(),
+            store_rows=None if self.store_rows is None else self.store_rows[ids],
+        )
+        if self.embeddings is not None:
+            table.embeddings = [self.embeddings[i] for i in ids]
+        if self.terms is not None:
+            from vector_index import select_csr_rows
+            table.terms = select_csr_rows(*self.terms, ids)
+        return table
+
+    def chunk_docs(self):
+        # Document id of every chunk
+        return np.asarray(self.paragraph_doc, dtype=np.int32)[np.asarray(self.chunk_paragraph, dtype=np.int32)]
+
+    def chunk_filenames(self):
+        return np.asarray(self.doc_filenames, dtype=object)[self.chunk_docs()]
+
+    def __contains__(self, column):
+        if column == "embedded":
+            return self.embeddings is not None
+        if column == "store_row":
+            return self.store_rows is not None
+        return column in TEXT_COLUMNS
+
+    def __getitem__(self, column):
+        """
+        Returns one column for every chunk. Text columns are resolved on each call.
+        """
+        if column == "embedded" and self.embeddings is not None:
+            return self.embeddings
+        if column == "store_row" and self.store_rows is not None:
+            return self.store_rows
+        if column == "chunk":
+            return self.texts()
+        if column == "source_paragraph":
+            return [self.paragraphs[p] for p in self.chunk_paragraph]
+        if column == "page":
+            return np.asarray(self.paragraph_page, dtype=np.int32)[np.asarray(self.chunk_paragraph, dtype=np.int32)]
+        if column == "pdf_link":
+            return self.pdf_links()
+        if column == "filename":
+            return list(self.chunk_filenames())
+        raise KeyError(column)
+
+    def to_frame(self, ids=None):
+        """
+        Resolves the text columns of the given chunks (all chunks when None) into a DataFrame
+        indexed by chunk id, the layout make_cited_rag_prompt reads.
+        """
+        ids = list(self._ids(ids))
+        paragraph_ids = [self.chunk_paragraph[i] for i in ids]
+        df = pd.DataFrame({
+            "chunk": [self.chunk_text(i) for i in ids],
+            "source_paragraph": [self.paragraphs[p] for p in paragraph_ids],
+            "page": [self.paragraph_page[p] for p in paragraph_ids],
+            "pdf_link": [self.pdf_link(i) for i in ids],
+            "filename": [self.doc_filenames[self.paragraph_doc[p]] for p in paragraph_ids],
+        }, index=pd.Index(ids, dtype=np.int64))
+        df.attrs.update(self.attrs)
+        return df
+
+    def to_csv(self, chunks_path, paragraphs_path):
+        """
+        Writes the chunks (with a paragraph_id instead of the paragraph text) and the
+        paragraphs to two CSV files.
+        """
+        chunk_paragraph = np.asarray(self.chunk_paragraph, dtype=np.int32)
+        pd.DataFrame({
+            "chunk": self.texts(),
+            "paragraph_id": chunk_paragraph,
+            "page": self["page"],
+            "pdf_link": self.pdf_links(),
+            "filename": self.chunk_filenames(),
+        }).to_csv(chunks_path)
+        pd.DataFrame({
+            "paragraph": self.paragraphs,
+            "page": np.asarray(self.paragraph_page, dtype=np.int32),
+            "filename": np.asarray(self.doc_filenames, dtype=object)[np.asarray(self.paragraph_doc, dtype=np.int32)]
+            if self.paragraphs else [],
+        }).to_csv(paragraphs_path, index_label="paragraph_id")
@@ -1,20 +1,16 @@
 import pandas as pd
-from langchain.text_splitter import CharacterTextSplitter
 import os
 from pdf_2_text import *
+from token_chunker import split_text
 
-def chunkits(text, max_length=500, overlap=50, metadata=None):
+def chunkits(text, max_length=500, overlap=50, metadata=None, model_name=None):
+    # max_length and overlap are counted in tokens of model_name (words when None),
+    # with the same chunker as create_rag_chunks_from_hdf5
     try:
         if metadata is None:
             metadata = {}
             
-        text_splitter = CharacterTextSplitter(
-            separator="\n",
-            chunk_size=max_length,
-            chunk_overlap=overlap
-        )
-        
-        chunks = text_splitter.split_text(text)
+        chunks = split_text(text, max_length, overlap, model_name)
         
         df = pd.DataFrame({
             'content': chunks,
@@ -3,20 +3,48 @@
 ####---------Fermi 1024 model embedding implementation--------####
 #################################################################
 
+# This module is imported only when the Fermi model is selected, and the model itself is
+# loaded on the first embedding call, so torch and transformers stay out of app startup.
 import itertools
+import os
 import torch
-from transformers import AutoModelForMaskedLM, AutoTokenizer
 
-# Load model ONCE at module level
-model = AutoModelForMaskedLM.from_pretrained("atomic-canyon/fermi-1024")
-tokenizer = AutoTokenizer.from_pretrained("atomic-canyon/fermi-1024")
+from vector_index import SparseVector
+from model_registry import get_or_create
 
-# Tokenize input
-# set the special tokens and id_to_token transform for post-process
-special_token_ids = [tokenizer.vocab[token] for token in tokenizer.special_tokens_map.values()]
-id_to_token = [""] * tokenizer.vocab_size
-for token, _id in tokenizer.vocab.items():
-    id_to_token[_id] = token
+FERMI_BATCH_SIZE = int(os.environ.get("FERMI_BATCH_SIZE", 16))
+# Torch intra-op threads, set once when the model is loaded (0 keeps torch's default).
+# The setting is process-wide, so it is never changed per call under concurrent requests
+FERMI_NUM_THREADS = int(os.environ.get("FERMI_NUM_THREADS", 0))
+
+FERMI_MODEL_NAME = "atomic-canyon/fermi-1024"
+
+# Load model ONCE, on first use
+def load_fermi_model():
+    """
+    Returns (model, tokenizer, special_token_ids), loading them on the first call.
+    """
+    def load():
+        from transformers import AutoModelForMaskedLM, AutoTokenizer
+        print(f"Loading {FERMI_MODEL_NAME}")
+        model = AutoModelForMaskedLM.from_pretrained(FERMI_MODEL_NAME)
+        tokenizer = AutoTokenizer.from_pretrained(FERMI_MODEL_NAME)
+        # set the special tokens for post-process
+        special_token_ids = [tokenizer.vocab[token] for token in tokenizer.special_tokens_map.values()]
+        if FERMI_NUM_THREADS:
+            torch.set_num_threads(FERMI_NUM_THREADS)
+        return model, tokenizer, special_token_ids
+    return get_or_create(("fermi", FERMI_MODEL_NAME), load)
+
+def get_id_to_token():
+    # vocab-sized id_to_token transform, only built when tokens need to be displayed
+    def build():
+        _, tokenizer, _ = load_fermi_model()
+        id_to_token = [""] * tokenizer.vocab_size
+        for token, _id in tokenizer.vocab.items():
+            id_to_token[_id] = token
+        return id_to_token
+    return get_or_create(("fermi_id_to_token", FERMI_MODEL_NAME), build)
 
 # get sparse vector from dense vectors with shape batch_size * seq_len * vocab_size
 def get_sparse_vector(feature, output,special_token_ids):
@@ -40,11 +68,69 @@ def transform_sparse_vector_to_dict(sparse_vector, id_to_token):
         output.append(dict(zip(token_strings, weights)))
     return output
 
+# transform the sparse vector to one SparseVector (token id -> weight) per sample
+def transform_sparse_vector_to_rows(sparse_vector):
+    sample_indices,token_indices=torch.nonzero(sparse_vector,as_tuple=True)
+    non_zero_values = sparse_vector[(sample_indices,token_indices)].numpy()
+    number_of_tokens_for_each_sample = torch.bincount(sample_indices, minlength=sparse_vector.shape[0]).tolist()
+    token_indices = token_indices.numpy()
+
+    output = []
+    end_idxs = list(itertools.accumulate([0]+number_of_tokens_for_each_sample))
+    for i in range(len(end_idxs)-1):
+        output.append(SparseVector(token_indices[end_idxs[i]:end_idxs[i+1]].copy(),
+                                   non_zero_values[end_idxs[i]:end_idxs[i+1]].copy(),
+                                   sparse_vector.shape[1]))
+    return output
+
+# transform a SparseVector back to a dict of (token, weight) for inspection
+def sparse_vector_to_token_dict(vector):
+    id_to_token = get_id_to_token()
+    return {id_to_token[_id]: float(weight) for _id, weight in zip(vector.indices, vector.data)}
+
 
 def get_fermi_sentence_embedding(text):
+    model, tokenizer, special_token_ids = load_fermi_model()
     # get the sparse vector
     feature = tokenizer([text], padding=True, truncation=True, return_tensors='pt', return_token_type_ids=False)
-    output = model(**feature)[0]
-    sparse_vector = get_sparse_vector(feature, output,special_token_ids)[0].detach().numpy()
+    with torch.inference_mode():
+        output = model(**feature)[0]
+        sparse_vector = transform_sparse_vector_to_rows(get_sparse_vector(feature, output,special_token_ids))[0]
 
     return sparse_vector
+
+
+def get_fermi_sentence_embeddings(texts, batch_size=FERMI_BATCH_SIZE):
+    """
+    Embeds many texts with the Fermi model. Texts are tokenized once, sorted by token length
+    and padded only within each batch, so short chunks do not pay for the longest one.
+
+    Args:
+        texts (list): Normalized chunk texts.
+        batch_size (int): Number of texts per forward pass.
+
+    Returns:
+        list: One SparseVector (token id -> weight) per text, in the order of texts.
+    """
+    sparse_vectors = [None] * len(texts)
+    if not texts:
+        return sparse_vectors
+    model, tokenizer, special_token_ids = load_fermi_model()
+
+    encodings = tokenizer(list(texts), truncation=True, return_token_type_ids=False)
+    input_ids = encodings["input_ids"]
+    order = sorted(range(len(texts)), key=lambda i: len(input_ids[i]))
+
+    with torch.inference_mode():
+        for start in range(0, len(order), batch_size):
+            batch_ids = order[start:start + batch_size]
+            feature = tokenizer.pad(
+                {"input_ids": [input_ids[i] for i in batch_ids],
+                 "attention_mask": [encodings["attention_mask"][i] for i in batch_ids]},
+                padding=True, return_tensors='pt')
+            output = model(**feature)[0]
+            rows = transform_sparse_vector_to_rows(get_sparse_vector(feature, output, special_token_ids))
+            for i, row in zip(batch_ids, rows):
+                sparse_vectors[i] = row
+
+    return sparse_vectors
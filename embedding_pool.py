@@ -0,0 +1,120 @@
+#################################################################
+####---------Multi-process local embedding---------------------####
+#################################################################
+# all-MiniLM-L6-v2 and Fermi run on the CPU. One model.encode call (or the Fermi batch
+# loop) uses a single process, and torch scales poorly past a few intra-op threads,
+# so large ingests leave most cores idle. With EMBEDDING_POOL_WORKERS set, the chunk texts
+# are sharded across a pool of worker processes. Each worker loads its own copy of the
+# model and runs with EMBEDDING_POOL_THREADS torch threads. Shards come back in the
+# order they were submitted, so embeddings stay aligned with their chunks.
+import os
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+import numpy as np
+
+from model_registry import get_or_create, discard, get_process_context
+
+# Worker processes, 1 = embed in this process, 0 = one per EMBEDDING_POOL_THREADS cores
+EMBEDDING_POOL_WORKERS = int(os.environ.get("EMBEDDING_POOL_WORKERS", 1))
+EMBEDDING_POOL_THREADS = int(os.environ.get("EMBEDDING_POOL_THREADS", 1))  # torch threads per worker
+EMBEDDING_POOL_SHARD_SIZE = int(os.environ.get("EMBEDDING_POOL_SHARD_SIZE", 256))  # texts per task
+# Smaller runs are embedded in this process, where the model is already loaded
+EMBEDDING_POOL_MIN_TEXTS = int(os.environ.get("EMBEDDING_POOL_MIN_TEXTS", 2048))
+
+POOL_MODELS = ("all-MiniLM-L6-v2", "atomic-canyon-fermi-nrc")
+MINILM_BATCH_SIZE = 64
+
+# Set in each worker by _init_worker
+_worker_model_name = None
+_worker_threads = None
+
+
+def pool_workers(workers=EMBEDDING_POOL_WORKERS, threads=EMBEDDING_POOL_THREADS):
+    if workers:
+        return workers
+    return max(1, (os.cpu_count() or 1) // max(1, threads))
+
+def use_embedding_pool(model_name, n_texts):
+    """
+    Returns True when texts of model_name should be embedded by the worker pool.
+    """
+    return model_name in POOL_MODELS and pool_workers() > 1 and n_texts >= EMBEDDING_POOL_MIN_TEXTS
+
+
+def _init_worker(model_name, threads):
+    global _worker_model_name, _worker_threads
+    # Thread pools are sized when torch is first imported, so the limits are set before
+    for variable in ("OMP_NUM_THREADS", "MKL_NUM_THREADS"):
+        os.environ[variable] = str(threads)
+    import torch
+    _worker_model_name, _worker_threads = model_name, threads
+    # Load the model now rather than in the first task
+    _load_worker_model()
+    # Set after loading, so the worker's share of the cores wins over FERMI_NUM_THREADS
+    torch.set_num_threads(threads)
+
+def _load_worker_model():
+    if _worker_model_name == "all-MiniLM-L6-v2":
+        from model_registry import get_sentence_transformer
+        return get_sentence_transformer('sentence-transformers/all-MiniLM-L6-v2')
+    from custom_embed import load_fermi_model
+    return load_fermi_model()
+
+def _embed_shard(texts):
+    if _worker_model_name == "all-MiniLM-L6-v2":
+        model = _load_worker_model()
+        return model.encode(texts, batch_size=MINILM_BATCH_SIZE, convert_to_numpy=True).astype(np.float32)
+    from custom_embed import get_fermi_sentence_embeddings
+    return get_fermi_sentence_embeddings(texts)
+
+
+def get_embedding_pool(model_name, workers=None, threads=EMBEDDING_POOL_THREADS):
+    """
+    Returns the process pool of model_name, started on first use and then reused, so
+    workers load their model once per process rather than once per set-up.
+    """
+    workers = workers or pool_workers(threads=threads)
+    return get_or_create(_pool_key(model_name, workers, threads), lambda: _create_pool(model_name, workers, threads))
+
+def _pool_key(model_name, workers, threads):
+    return ("embedding_pool", model_name, workers, threads)
+
+def _create_pool(model_name, workers, threads):
+    # forkserver/spawn: forking a process that already runs torch threads can deadlock
+    print(f"Starting {workers} {model_name} embedding workers with {threads} threads each")
+    return ProcessPoolExecutor(max_workers=workers, mp_context=get_process_context(),
+                               initializer=_init_worker, initargs=(model_name, threads))
+
+def embed_with_pool(model_name, texts, shard_size=EMBEDDING_POOL_SHARD_SIZE, workers=None,
+                    threads=EMBEDDING_POOL_THREADS):
+    """
+    Embeds texts with a local model across the worker pool.
+
+    Args:
+        model_name (str): "all-MiniLM-L6-v2" or "atomic-canyon-fermi-nrc".
+        texts (list): Normalized chunk texts.
+        shard_size (int): Texts per task; several shards per worker balance the load.
+
+    Returns:
+        list: One embedding per text, in the order of texts (float32 vectors for MiniLM,
+        SparseVectors for Fermi).
+    """
+    if model_name not in POOL_MODELS:
+        raise ValueError(f"{model_name} is not a local embedding model")
+    texts = list(texts)
+    workers = workers or pool_workers(threads=threads)
+    pool = get_embedding_pool(model_name, workers, threads)
+    try:
+        futures = [pool.submit(_embed_shard, texts[start:start + shard_size])
+                   for start in range(0, len(texts), shard_size)]
+        embeddings = []
+        # Results are collected in submission order, whatever order the shards finish in
+        for future in futures:
+            embeddings.extend(future.result())
+    except BrokenProcessPool:
+        # A worker died (e.g. out of memory): the next run starts a new pool
+        discard(_pool_key(model_name, workers, threads))
+        pool.shutdown(wait=False, cancel_futures=True)
+        raise
+    print(f"Embedded {len(texts)} chunks in {len(futures)} shards")
+    return embeddings
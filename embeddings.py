@@ -2,19 +2,137 @@
 # Here you can define functions for embedding text, computing cosine similarity,
 # and for performing chunking. These functions are just placeholders; you would
 # need to fill in your actual model calls and logic.
-from openai import AzureOpenAI, OpenAI
+from openai import APIConnectionError, APITimeoutError, InternalServerError, RateLimitError
 import numpy as np 
-from sentence_transformers import SentenceTransformer
+from concurrent.futures import ThreadPoolExecutor, as_completed
 import os 
+import random
 import re
+import time
 
-from hdf5_file_constructor import load_pdfs_from_hdf5
-from custom_embed import get_fermi_sentence_embedding
+from hdf5_file_constructor import (load_pdfs_from_hdf5, store_ann_index_in_hdf5, load_ann_index_from_hdf5, ANN_INDEX_HDF5,
+                                   iter_embedding_blocks, load_embeddings_from_hdf5, corpus_fingerprint,
+                                   append_embeddings_to_hdf5, tombstone_embeddings_in_hdf5, get_embedding_progress)
+from vector_index import (get_index, set_index, search_batch, DenseIndex, IVFIndex, QuantizedIndex, SparseVector, to_float32_matrix,
+                          train_ivf, ANN_MIN_ROWS, QUANTIZATION)
+from chunk_table import ChunkTable
+from token_chunker import iter_chunk_spans
+from lexical_index import lexical_term_csr, get_lexical_index, reciprocal_rank_fusion
+from vector_store import vector_file_path, export_vectors, open_vectors, remove_vector_files, get_corpus
+from audit_log import get_audit_log, AUDIT_TOP_K
+from model_registry import (get_azure_embedding_client, get_openai_client, get_embedding_client, EMBEDDING_CLIENT_RETRIES,
+                            get_sentence_transformer, get_or_create)
+from query_cache import QueryEmbeddingCache
+from metrics import get_metrics, incr, timed
+from embedding_pool import use_embedding_pool, embed_with_pool
 
 ########################################################################################
 #################------STEP 1: EMBEDDING THE CORPUS DB -------##########################
 ########################################################################################
 
+# Remote embedding requests: the API accepts up to 2048 inputs and ~300k tokens per request
+EMBEDDING_BATCH_SIZE = int(os.environ.get("EMBEDDING_BATCH_SIZE", 256))
+EMBEDDING_BATCH_TOKENS = int(os.environ.get("EMBEDDING_BATCH_TOKENS", 200000))
+EMBEDDING_MAX_WORKERS = int(os.environ.get("EMBEDDING_MAX_WORKERS", 4))
+EMBEDDING_MAX_RETRIES = int(os.environ.get("EMBEDDING_MAX_RETRIES", 6))
+# Chunks embedded between two checkpoints written to the embedding store
+EMBEDDING_CHECKPOINT_CHUNKS = int(os.environ.get("EMBEDDING_CHECKPOINT_CHUNKS", 4096))
+RETRYABLE_ERRORS = (RateLimitError, APITimeoutError, APIConnectionError, InternalServerError)
+# search_docs ranking: "dense" (embeddings), "lexical" (BM25) or "hybrid" (both, fused)
+RETRIEVAL_MODE = os.environ.get("RETRIEVAL_MODE", "dense")
+LEXICAL_CANDIDATES = int(os.environ.get("LEXICAL_CANDIDATES", 50))  # BM25 hits per query
+RRF_K = int(os.environ.get("RRF_K", 60))
+# Best chunks retrieved to answer a question: only these have their text resolved and packed
+ANSWER_TOP_K = int(os.environ.get("ANSWER_TOP_K", 50))
+
+def estimate_tokens(text):
+    # Rough count (~4 characters per token) used only to size the request batches
+    return len(text) // 4 + 1
+
+def make_embedding_batches(texts, max_inputs=EMBEDDING_BATCH_SIZE, max_tokens=EMBEDDING_BATCH_TOKENS):
+    """
+    Groups text positions into request batches bounded by input count and estimated tokens.
+
+    Returns:
+        list: Lists of positions into texts, in order.
+    """
+    batches = []
+    current, current_tokens = [], 0
+    for i, text in enumerate(texts):
+        n_tokens = estimate_tokens(text)
+        if current and (len(current) >= max_inputs or current_tokens + n_tokens > max_tokens):
+            batches.append(current)
+            current, current_tokens = [], 0
+        current.append(i)
+        current_tokens += n_tokens
+    if current:
+        batches.append(current)
+    return batches
+
+def _retry_delay(error, attempt, base_delay=1.0, max_delay=60.0):
+    # Honour the server's Retry-After header, otherwise back off exponentially with jitter
+    response = getattr(error, "response", None)
+    retry_after = response.headers.get("retry-after") if response is not None else None
+    if retry_after:
+        try:
+            return min(float(retry_after), max_delay)
+        except ValueError:
+            pass
+    return min(max_delay, base_delay * 2 ** attempt) * (0.5 + random.random() / 2)
+
+def _create_embeddings_with_retry(client, texts, model, max_retries=EMBEDDING_MAX_RETRIES):
+    for attempt in range(max_retries + 1):
+        try:
+            incr("embedding_api_calls")
+            response = client.embeddings.create(input=texts, model=model)
+            return [item.embedding for item in sorted(response.data, key=lambda item: item.index)]
+        except RETRYABLE_ERRORS as e:
+            if attempt == max_retries:
+                incr("embedding_api_errors")
+                raise
+            incr("embedding_api_retries")
+            delay = _retry_delay(e, attempt)
+            print(f"Embedding request failed ({type(e).__name__}), retrying in {delay:.1f}s")
+            time.sleep(delay)
+
+def generate_embeddings_batched(client, texts, model, max_inputs=EMBEDDING_BATCH_SIZE,
+                                max_tokens=EMBEDDING_BATCH_TOKENS, max_workers=EMBEDDING_MAX_WORKERS,
+                                max_retries=EMBEDDING_MAX_RETRIES):
+    """
+    Embeds texts with as few requests as the API limits allow, running a bounded number of
+    requests concurrently and retrying rate-limited or failed ones with backoff.
+
+    Args:
+        client: AzureOpenAI or OpenAI client (point OPENAI_BASE_URL at a local stub to test).
+        texts (list): Normalized chunk texts.
+        model (str): Embedding model or Azure deployment name.
+
+    Returns:
+        list: One float32 embedding per text, in the order of texts.
+    """
+    embeddings = [None] * len(texts)
+    batches = make_embedding_batches(texts, max_inputs, max_tokens)
+
+    with ThreadPoolExecutor(max_workers=max_workers) as pool:
+        futures = {
+            pool.submit(_create_embeddings_with_retry, client, [texts[i] for i in batch], model, max_retries): batch
+            for batch in batches
+        }
+        try:
+            for future in as_completed(futures):
+                # float32 rows instead of lists of Python floats (8x smaller) until they are stored
+                for i, embedding in zip(futures[future], np.asarray(future.result(), dtype=np.float32)):
+                    embeddings[i] = embedding
+        except Exception:
+            # A batch failed for good: the run is lost, so the batches still queued are not sent
+            for future in futures:
+                future.cancel()
+            raise
+
+    print(f"Embedded {len(texts)} chunks in {len(batches)} requests")
+    return embeddings
+
+@timed("embed")
 def embed_text(raged_hdf5, model_name,llm_choice):
     # Example: call your embedding model (could be via Azure OpenAI)
     # Return the embedding vector
@@ -22,63 +140,48 @@ def embed_text(raged_hdf5, model_name,llm_choice):
     if (llm_choice == "AzureGPT") & (model_name == "text-embedding-ada-002"):
         
         try:
-            client = AzureOpenAI(
-                azure_endpoint=os.environ.get("AZURE_EMB_ENDPOINT"),
-                api_key=os.environ.get("AZURE_EMB_API_KEY"),
-                api_version=os.environ.get('AZURE_VERSION')
-            )
-            print("AZURE API Key Loaded Successfully")
+            client = get_azure_embedding_client()
 
         except Exception as e:
             print(f'Error with AzureGPT, this is more liketly due to API keys are not correct system error is as {str(e)}')
         
         try:
-            def generate_embeddings(text, model="text-embedding-3-large"): # model = "deployment_name"
-                return client.embeddings.create(input = [text], model=model).data[0].embedding
-
-        # rag_chunks = [{**chunk, "embedded": generate_embeddings(normalize_text(chunk["chunk"]))}
-        # for chunk in raged_hdf5]
+            # model = "deployment_name"
+            text_chunks = [normalize_text(text) for text in raged_hdf5.texts()]
+            embeddings = generate_embeddings_batched(client, text_chunks, model="text-embedding-3-large")
 
-            for chunk in raged_hdf5:
-                normalized_text = normalize_text(chunk["chunk"])
-                embedding = generate_embeddings(normalized_text)
-                chunk["embedded"] = embedding
+            raged_hdf5.embeddings = list(embeddings)
         except Exception as e:
             print(f' Error with text-embedding-ada-002, this is more liketly due to 1) embeding model deployment is not create, name mistmach or 2) API keys are not correct')
     else:
         try:
-            client = OpenAI(api_key=os.environ.get("OPENAI_API_KEY"))
-            print("OpenAI API Key Loaded Successfully")
+            client = get_openai_client(max_retries=EMBEDDING_CLIENT_RETRIES)
         except Exception as e:
             print(f'Error with OpenAI, this is more liketly due to 1) embeding model development is not create or 2) API keys are not correctsystem error is as {str(e)}')
 
 
         if model_name == "text-embedding-ada-002":
-            def generate_embeddings(text, model="text-embedding-ada-002"): # model = "deployment_name"
-                return client.embeddings.create(input = [text], model=model).data[0].embedding
+            text_chunks = [normalize_text(text) for text in raged_hdf5.texts()]
+            embeddings = generate_embeddings_batched(client, text_chunks, model="text-embedding-ada-002")
 
-            # rag_chunks = [{**chunk, "embedded": generate_embeddings(normalize_text(chunk["chunk"]))}
-            # for chunk in raged_hdf5]
-
-            for chunk in raged_hdf5:
-                normalized_text = normalize_text(chunk["chunk"])
-                embedding = generate_embeddings(normalized_text)
-                chunk["embedded"] = embedding
+            raged_hdf5.embeddings = list(embeddings)
 
         elif model_name == "all-MiniLM-L6-v2":
             try:
                 # !pip install -U sentence-transformers
-                # Load the pre-trained model
-                model = SentenceTransformer('sentence-transformers/all-MiniLM-L6-v2')
                 # Extract the text chunks
-                text_chunks = [normalize_text(chunk["chunk"]) for chunk in raged_hdf5]
+                text_chunks = [normalize_text(text) for text in raged_hdf5.texts()]
 
-                # Generate embeddings for all chunks
-                embeddings = model.encode(text_chunks, convert_to_tensor=True)
+                # Generate embeddings for all chunks, across worker processes for large runs
+                if use_embedding_pool(model_name, len(text_chunks)):
+                    embeddings = embed_with_pool(model_name, text_chunks)
+                else:
+                    # Load the pre-trained model
+                    model = get_sentence_transformer('sentence-transformers/all-MiniLM-L6-v2')
+                    embeddings = model.encode(text_chunks, convert_to_tensor=True)
 
-                # Add embeddings back to the rag_chunks dictionaries
-                for chunk, embedding in zip(raged_hdf5, embeddings):
-                    chunk["embedded"] = embedding
+                # Add embeddings back to the chunk table
+                raged_hdf5.embeddings = list(embeddings)
 
 
             except Exception as e:
@@ -86,15 +189,101 @@ def embed_text(raged_hdf5, model_name,llm_choice):
         else:
             print("Using Fermi 1024 model for embedding")
             try:
-                for chunk in raged_hdf5:
-                    normalized_text = normalize_text(chunk["chunk"])
-                    embedding = get_fermi_sentence_embedding(normalized_text)
-                    chunk["embedded"] = embedding
+                from custom_embed import get_fermi_sentence_embeddings
+                text_chunks = [normalize_text(text) for text in raged_hdf5.texts()]
+                if use_embedding_pool(model_name, len(text_chunks)):
+                    embeddings = embed_with_pool(model_name, text_chunks)
+                else:
+                    embeddings = get_fermi_sentence_embeddings(text_chunks)
+                raged_hdf5.embeddings = list(embeddings)
             except Exception as e:
                 print(f' Error with atomic-canyon embedding as {str(e)}')
-                
+
+    if raged_hdf5.embeddings is not None:
+        incr("chunks_embedded", len(raged_hdf5))
     return raged_hdf5  
 
+def embed_and_store(raged_hdf5, model_name, llm_choice, hdf5_filename, chunk_size, overlap, doc_hashes,
+                    checkpoint_chunks=EMBEDDING_CHECKPOINT_CHUNKS):
+    """
+    Embeds the chunks of raged_hdf5 in checkpoints of about checkpoint_chunks chunks and
+    appends each checkpoint to the embedding store as soon as it is embedded, with the
+    progress of the PDFs it only partly covers. A run that stopped (crash, timeout,
+    exhausted retries) resumes where its last checkpoint ended: PDFs already complete are
+    no longer pending, and the stored chunks of partly embedded PDFs are skipped.
+
+    Args:
+        raged_hdf5 (ChunkTable): Chunks of the pending PDFs (create_rag_chunks_from_hdf5).
+        doc_hashes (dict): { filename: content_hash } of the pending PDFs.
+
+    Returns:
+        bool: True if every chunk was embedded and stored.
+    """
+    model_key = embedding_model_key(model_name, llm_choice)
+    filenames = raged_hdf5.doc_filenames
+    chunk_docs = raged_hdf5.chunk_docs()
+    totals = np.bincount(chunk_docs, minlength=len(filenames))
+
+    # Chunks of a PDF are contiguous; skip those a previous run already stored, unless the
+    # PDF or its chunking changed since (its partial rows are then dropped and redone)
+    partial_docs, live_counts = get_embedding_progress(hdf5_filename, model_key, chunk_size, overlap)
+    stored = np.zeros(len(filenames), dtype=np.int64)
+    restart = []
+    for d, filename in enumerate(filenames):
+        progress, live = partial_docs.get(filename), live_counts.get(filename, 0)
+        if (progress and progress["hash"] == doc_hashes.get(filename) and progress["total"] == totals[d]
+                and progress["chunks"] == live):
+            stored[d] = live
+        elif progress or live:
+            restart.append(filename)
+    tombstone_embeddings_in_hdf5(hdf5_filename, model_key, chunk_size, overlap, restart)
+    if stored.any():
+        print(f"Resuming from checkpoint: {int(stored.sum())} chunks of {int((stored > 0).sum())} documents already stored")
+
+    doc_starts = np.concatenate([[0], np.cumsum(totals)[:-1]]).astype(np.int64)
+    todo = np.flatnonzero(np.arange(len(raged_hdf5)) - doc_starts[chunk_docs] >= stored[chunk_docs])
+    chunk_paragraph = np.asarray(raged_hdf5.chunk_paragraph, dtype=np.int32)
+
+    start = 0
+    while start < len(todo):
+        # Checkpoints end on a paragraph boundary, so no paragraph is stored twice
+        end = min(start + checkpoint_chunks, len(todo))
+        while end < len(todo) and chunk_paragraph[todo[end]] == chunk_paragraph[todo[end - 1]]:
+            end += 1
+        ids = todo[start:end]
+        try:
+            checkpoint = embed_text(raged_hdf5.select(ids), model_name, llm_choice)
+        except Exception as e:
+            print(f"Error embedding checkpoint: {str(e)}")
+            checkpoint = None
+        if checkpoint is None or checkpoint.embeddings is None or len(checkpoint.embeddings) != len(ids):
+            print(f"Embedding stopped after {start} of {len(todo)} chunks, run Set Up again to resume from the last checkpoint")
+            return False
+
+        stored += np.bincount(chunk_docs[ids], minlength=len(filenames))
+        docs = np.unique(chunk_docs[ids])
+        completed = {filenames[d]: doc_hashes[filenames[d]] for d in docs if stored[d] == totals[d]}
+        partial = {filenames[d]: {"hash": doc_hashes[filenames[d]], "chunks": int(stored[d]), "total": int(totals[d])}
+                   for d in docs if stored[d] < totals[d]}
+        if not append_embeddings_to_hdf5(checkpoint, hdf5_filename, model_key, chunk_size, overlap, completed, partial):
+            return False
+        start = end
+        print(f"Checkpoint: {start} of {len(todo)} chunks embedded and stored")
+
+    # PDFs without any chunk are complete too
+    chunked = {f for f, total in zip(filenames, totals) if total}
+    empty = {f: h for f, h in doc_hashes.items() if f not in chunked}
+    if empty:
+        append_embeddings_to_hdf5(ChunkTable(), hdf5_filename, model_key, chunk_size, overlap, empty)
+    return True
+
+def embedding_model_key(model_name, llm_choice):
+    # ada vectors differ between the Azure deployment and the OpenAI endpoint
+    if model_name == "text-embedding-ada-002":
+        provider = "azure" if llm_choice == "AzureGPT" else "openai"
+        return f"{model_name}@{provider}"
+    return model_name
+
 def cosine_similarity(a, b):
     return np.dot(a, b) / (np.linalg.norm(a) * np.linalg.norm(b))
 
@@ -103,51 +292,283 @@ def cosine_similarity(a, b):
 #########------STEP 2: SEARCHING THE CORPUS DB -------####################################
 ########################################################################################
 ## add for the different models
-def search_docs(df, user_query, model_name, llm_choice,top_n, to_print=True,):
+def embed_query(user_query, model_name, llm_choice):
+    """
+    Embeds a query with the same model the corpus was embedded with (no caching).
+    """
+    nor_query = normalize_text(user_query)
     
     if model_name == "all-MiniLM-L6-v2":
-        model = SentenceTransformer('sentence-transformers/all-MiniLM-L6-v2')
-            # Extract the text chunks
-        nor_query = [normalize_text(user_query)]
+        model = get_sentence_transformer('sentence-transformers/all-MiniLM-L6-v2')
 
             # Generate embeddings for all chunks
-        embedding = model.encode(nor_query, convert_to_tensor=True)
+        embedding = model.encode([nor_query], convert_to_tensor=True)
         
     elif model_name == "text-embedding-ada-002":
-        if llm_choice == "AzureGPT":
-                client = AzureOpenAI(
-                    azure_endpoint=os.environ.get("AZURE_EMB_ENDPOINT"),
-                    api_key=os.environ.get("AZURE_EMB_API_KEY"),
-                    api_version=os.environ.get('AZURE_VERSION')
-                        )
-                print("AZURE API Key Loaded Successfully")
-        else:
-            client = OpenAI(api_key=os.environ.get("OPENAI_API_KEY"))
-            print("OpenAI API Key Loaded Successfully")
+        client = get_embedding_client(llm_choice)
         
         def get_embedding(text, model="text-embedding-3-large"): # model = "deployment_name"
-            return client.embeddings.create(input = [text], model=model).data[0].embedding
+            # The client does not retry by itself, rate-limited requests are retried here
+            return _create_embeddings_with_retry(client, [text], model)[0]
         embedding = get_embedding(
-            user_query,
+            nor_query,
             model_name, # model should be set to the deployment name you chose when you deployed the text-embedding-ada-002 (Version 2) model,
             )
     else:
-        embedding = get_fermi_sentence_embedding(normalize_text(user_query))
-    
-    df["similarities"] = df.embedded.apply(lambda x: cosine_similarity(x, embedding))
-    
-    df.to_excel("ranked_chunk_all.xlsx")
-    
-    df_filtered = df[df["similarities"] >= top_n/100]  # Keep only similarities >= top_n%
-    df_final = df_filtered.sort_values("similarities", ascending=False)
+        from custom_embed import get_fermi_sentence_embedding
+        embedding = get_fermi_sentence_embedding(nor_query)
+    return embedding
+
+def embed_queries(user_queries, model_name, llm_choice):
+    """
+    Embeds several queries with one batched forward pass (local models) or one API request.
 
+    Returns:
+        list: One embedding per query, in order.
+    """
+    nor_queries = [normalize_text(q) for q in user_queries]
+    if not nor_queries:
+        return []
+    if model_name == "all-MiniLM-L6-v2":
+        model = get_sentence_transformer('sentence-transformers/all-MiniLM-L6-v2')
+        return list(model.encode(nor_queries, convert_to_tensor=True))
+    if model_name == "text-embedding-ada-002":
+        return _create_embeddings_with_retry(get_embedding_client(llm_choice), nor_queries, model_name)
+    from custom_embed import get_fermi_sentence_embeddings
+    return get_fermi_sentence_embeddings(nor_queries)
+
+def get_query_cache():
+    return get_or_create(("query_embedding_cache",), QueryEmbeddingCache)
+
+get_metrics().register_collector("query_cache", lambda: get_query_cache().stats())
+
+def get_query_embedding(user_query, model_name, llm_choice):
+    """
+    Returns the query embedding from the LRU cache, embedding the query only on a miss.
+    """
+    return get_query_cache().get_or_compute(
+        embedding_model_key(model_name, llm_choice), normalize_text(user_query),
+        lambda: embed_query(user_query, model_name, llm_choice))
+
+def get_query_embeddings(user_queries, model_name, llm_choice):
+    """
+    Batched get_query_embedding: cached queries are served from the LRU cache and the
+    others are embedded together with embed_queries.
+    """
+    cache = get_query_cache()
+    model_key = embedding_model_key(model_name, llm_choice)
+    embeddings = [cache.get(model_key, normalize_text(q)) for q in user_queries]
+    missing = list(dict.fromkeys(q for q, e in zip(user_queries, embeddings) if e is None))
+    if missing:
+        computed = dict(zip(missing, embed_queries(missing, model_name, llm_choice)))
+        for q in missing:
+            computed[q] = cache.put(model_key, normalize_text(q), computed[q])
+        embeddings = [computed[q] if e is None else e for q, e in zip(user_queries, embeddings)]
+    return embeddings
+
+def _fuse_results(df, user_query, best_ids, best_scores, top_k, mode):
+    """
+    Returns (df_final, ids, scores) for the dense hits of a query; in "hybrid" mode they
+    are fused with the BM25 hits.
+    """
+    if mode != "hybrid":
+        # Only the returned chunks have their text resolved
+        return df.to_frame(best_ids).assign(similarities=best_scores), best_ids, best_scores
+    lexical_ids, _ = get_lexical_index(df).search(user_query, LEXICAL_CANDIDATES)
+    dense_scores = dict(zip(best_ids.tolist(), best_scores.tolist()))
+    best_ids, best_scores = reciprocal_rank_fusion([best_ids, lexical_ids], k=RRF_K, top_k=top_k)
+    similarities = [dense_scores.get(i, np.nan) for i in best_ids.tolist()]
+    return df.to_frame(best_ids).assign(similarities=similarities, fused_scores=best_scores), best_ids, best_scores
+
+def _audit_sources(df, df_final):
+    # Chunk ids only resolve in their corpus version; the links still do after later set-ups
+    return {"corpus_version": df.attrs.get("corpus_version", ""),
+            "sources": df_final["pdf_link"].tolist()[:AUDIT_TOP_K]}
+
+def search_docs(df, user_query, model_name, llm_choice,top_n, to_print=True, top_k=None, mode=RETRIEVAL_MODE):
+    """
+    Scores every chunk against the query and returns the chunks whose similarity is at
+    least top_n%, best first. df is the ChunkTable or its CorpusHandle. top_k caps the
+    number of returned chunks. With to_print the query is recorded in the background
+    audit log (see audit_log.py).
+
+    mode "lexical" returns the LEXICAL_CANDIDATES best BM25 matches (no embedding call);
+    "hybrid" fuses the dense hits with them by reciprocal rank fusion, in which case
+    'similarities' is the cosine similarity of the dense hits (NaN for lexical-only hits)
+    and 'fused_scores' the fused score the rows are ordered by.
+    """
+    df = get_corpus(df)
+    start_time = time.perf_counter()
+    if mode == "lexical":
+        embedded_time = start_time
+        best_ids, best_scores = get_lexical_index(df).search(user_query, top_k or LEXICAL_CANDIDATES)
+        df_final = df.to_frame(best_ids).assign(similarities=best_scores)
+    else:
+        embedding = get_query_embedding(user_query, model_name, llm_choice)
+        embedded_time = time.perf_counter()
+
+        # One matrix-vector product for dense models (restricted to the probed lists of an ANN
+        # index on large corpora), posting-list lookups for Fermi.
+        # Keep only similarities >= top_n%, selecting the best top_k without a full sort
+        index = get_index(df)
+        best_ids, best_scores = index.search(embedding, top_k, min_score=top_n/100)
+        df_final, best_ids, best_scores = _fuse_results(df, user_query, best_ids, best_scores, top_k, mode)
+    end_time = time.perf_counter()
+    get_metrics().observe("query_embed", embedded_time - start_time)
+    get_metrics().observe("search", end_time - embedded_time)
 
     # df_final=df.sort_values("similarities", ascending=False).head(top_n)
     if to_print:
-        user_query = user_query[:15].strip().replace(' ','_')
-        df_final.to_csv(f'ranked_chunkto{user_query}.csv')
+        # Written by a background thread, off the request path
+        get_audit_log().record(
+            user_query, model_name, best_ids[:AUDIT_TOP_K], best_scores[:AUDIT_TOP_K], llm=llm_choice,
+            timings={"embed_ms": (embedded_time - start_time) * 1000,
+                     "search_ms": (end_time - embedded_time) * 1000,
+                     "total_ms": (end_time - start_time) * 1000},
+            **_audit_sources(df, df_final))
     return df_final
 
+def search_docs_batch(df, user_queries, model_name, llm_choice, top_n, to_print=True, top_k=None, mode=RETRIEVAL_MODE):
+    """
+    search_docs for several queries at once: the queries are embedded in one batch and
+    scored against an exact dense index with a single matrix-matrix product.
+
+    Returns:
+        list: One result DataFrame per query, as returned by search_docs.
+    """
+    df = get_corpus(df)
+    if mode == "lexical":
+        return [search_docs(df, q, model_name, llm_choice, top_n, to_print, top_k, mode) for q in user_queries]
+
+    start_time = time.perf_counter()
+    embeddings = get_query_embeddings(user_queries, model_name, llm_choice)
+    embedded_time = time.perf_counter()
+    hits = search_batch(get_index(df), embeddings, top_k, min_score=top_n/100)
+    results = []
+    for user_query, (best_ids, best_scores) in zip(user_queries, hits):
+        df_final, best_ids, best_scores = _fuse_results(df, user_query, best_ids, best_scores, top_k, mode)
+        results.append((df_final, best_ids, best_scores))
+    end_time = time.perf_counter()
+    get_metrics().observe("query_embed_batch", embedded_time - start_time)
+    get_metrics().observe("search_batch", end_time - embedded_time)
+    incr("queries_batched", len(user_queries))
+
+    if to_print:
+        # Timings are those of the whole batch
+        for user_query, (df_final, best_ids, best_scores) in zip(user_queries, results):
+            get_audit_log().record(
+                user_query, model_name, best_ids[:AUDIT_TOP_K], best_scores[:AUDIT_TOP_K], llm=llm_choice,
+                timings={"embed_ms": (embedded_time - start_time) * 1000,
+                         "search_ms": (end_time - embedded_time) * 1000,
+                         "total_ms": (end_time - start_time) * 1000},
+                **_audit_sources(df, df_final))
+    return [df_final for df_final, _, _ in results]
+
+def build_search_index(df, corpus_version, min_rows=ANN_MIN_ROWS, store=None, quantization=QUANTIZATION):
+    """
+    Builds the search index for the ChunkTable df at setup time. Dense corpora of at least min_rows chunks
+    get an IVF (approximate) index, reloaded from ANN_INDEX_HDF5 when one was stored for
+    this corpus version; smaller corpora keep exact search over the memory-mapped vectors
+    shared by every session (see vector_store.py).
+
+    Args:
+        store (tuple): (hdf5_filename, model_name, chunk_size, overlap) of the embedding group
+            df was loaded from. Required when df has no 'embedded' column.
+        quantization (str): "int8" or "binary" to search quantized codes kept in memory and
+            rescore the shortlist with the full-precision vectors of the vector store.
+    """
+    if "embedded" in df:
+        embeddings = df["embedded"]
+        if len(df) < min_rows or isinstance(embeddings[0], SparseVector):
+            return get_index(df)
+        index = load_ann_index_from_hdf5(ANN_INDEX_HDF5, corpus_version, embeddings)
+        if index is None:
+            index = IVFIndex(to_float32_matrix(embeddings))
+            _store_ann_index(index, corpus_version)
+    elif store is None:
+        raise ValueError("store is required when the embeddings were left on disk")
+    elif quantization or len(df) < min_rows:
+        embeddings = _exported_vectors(df, corpus_version, store)
+        if quantization:
+            # Rescored from the file of this corpus version, not from the HDF5 store: a later
+            # compaction renumbers the store rows while sessions still search this version
+            index = QuantizedIndex.from_blocks(
+                lambda: (embeddings[start:start + 65536] for start in range(0, len(embeddings), 65536)),
+                quantization,
+                lambda ids: embeddings[ids],
+            )
+            print(f"{quantization} index: {len(index)} chunks, {index.nbytes / 1e6:.1f} MB of codes")
+        else:
+            index = DenseIndex(embeddings, normalized=True)
+        set_index(df, index)
+        return index
+    else:
+        index = _memory_mapped_ivf_index(df, corpus_version, store)
+
+    recall = "not measured" if index.measured_recall is None else f"{index.measured_recall:.3f}"
+    print(f"ANN index: {index.n_lists} lists, nprobe={index.nprobe}, recall@10={recall}")
+    set_index(df, index)
+    return index
+
+def _store_ann_index(index, corpus_version):
+    # Recall against an exact scan is measured once, when the index is built, and stored with it
+    index.measured_recall = index.recall(top_k=10)
+    store_ann_index_in_hdf5(index, ANN_INDEX_HDF5, corpus_version)
+
+def _exported_vectors(df, corpus_version, store):
+    # Memory-mapped normalized vectors of the corpus version, exported from the store once
+    path = vector_file_path(corpus_version)
+    if not os.path.exists(path):
+        export_vectors(iter_embedding_blocks(*store, df.store_rows), len(df.store_rows), path)
+    return open_vectors(path)
+
+def _memory_mapped_ivf_index(df, corpus_version, store, block_size=65536):
+    """
+    IVF index over a file holding the vectors in list order, memory-mapped like the
+    exact store, so no process keeps a private copy of the corpus. The file in chunk
+    order is only needed to build it and is removed afterwards.
+    """
+    ordered_path = vector_file_path(corpus_version, "ivf")
+    if os.path.exists(ordered_path):
+        index = load_ann_index_from_hdf5(ANN_INDEX_HDF5, corpus_version, open_vectors(ordered_path), list_ordered=True)
+        if index is not None:
+            return index
+
+    embeddings = _exported_vectors(df, corpus_version, store)
+    centroids, row_ids, list_ptr = train_ivf(embeddings)
+    export_vectors((embeddings[row_ids[start:start + block_size]] for start in range(0, len(row_ids), block_size)),
+                   len(row_ids), ordered_path)
+    index = IVFIndex(open_vectors(ordered_path), centroids=centroids, row_ids=row_ids, list_ptr=list_ptr,
+                     list_ordered=True)
+    _store_ann_index(index, corpus_version)
+    del embeddings
+    remove_vector_files(corpus_version, kinds=("",))
+    return index
+
+@timed("index")
+def load_search_corpus(hdf5_filename, model_key, chunk_size, overlap):
+    """
+    Loads the chunks of an embedding group (see load_embeddings_from_hdf5), tags them with
+    their corpus_version and builds their dense and lexical search indexes.
+
+    Returns:
+        ChunkTable: The indexed chunks, empty when the group does not exist.
+    """
+    # Dense vectors stay on disk: they are memory-mapped from the shared vector store, or
+    # only their compact codes are kept in memory when QUANTIZATION is set
+    store = (hdf5_filename, model_key, chunk_size, overlap)
+    df = load_embeddings_from_hdf5(*store, include_embeddings=False) or ChunkTable()
+
+    # Cached answers and ANN indexes are only reused for the exact corpus and embedding model
+    df.attrs["corpus_version"] = f"{model_key}:{corpus_fingerprint(df)}"
+    if len(df):
+        build_search_index(df, df.attrs["corpus_version"], store=store)
+        get_lexical_index(df)
+        # Sparse vectors and term counts now live in the indexes, the shared table only keeps the text
+        df.embeddings = None
+        df.terms = None
+    return df
+
 def normalize_text(s, sep_token = " \n "):
     s = re.sub(r'\s+',  ' ', s).strip()
     s = re.sub(r". ,","",s)
@@ -160,33 +581,40 @@ def normalize_text(s, sep_token = " \n "):
     return s
 
 
-def create_rag_chunks_from_hdf5(hdf5_filename, chunk_size=300,overlap=50):
+@timed("chunk")
+def create_rag_chunks_from_hdf5(hdf5_filename, chunk_size=300,overlap=50, filenames=None, model_name=None,
+                                max_tokens=None):
     """
-    Loads PDFs from HDF5 and generates RAG chunks.
+    Loads PDFs from HDF5 and generates RAG chunks. filenames restricts chunking to the
+    given PDFs (e.g. only the new and modified ones).
+
+    Args:
+        chunk_size (int): Tokens per chunk, counted with the tokenizer of model_name (words
+            when model_name is None) and capped to the model's max_tokens input window.
+        overlap (int): Tokens shared by consecutive chunks of a paragraph.
 
     Returns:
-        List of dictionaries containing:
-        - 'chunk': Chunk text
-        - 'source_paragraph': Full paragraph the chunk came from
-        - 'page': Page number
-        - 'pdf_link': Hyperlink to the PDF at the correct location
+        ChunkTable: Each paragraph and document is stored once; a chunk is its token window
+        as a character span in its paragraph, with its lexical term counts. Resolve the 'chunk', 'source_paragraph',
+        'page', 'pdf_link' and 'filename' columns with texts() / to_frame().
     """
-    rag_chunks = []
-    pdfs_data = load_pdfs_from_hdf5(hdf5_filename)
+    rag_chunks = ChunkTable()
+    pdfs_data = load_pdfs_from_hdf5(hdf5_filename, filenames)
 
     # return rag_chunks
-    step = chunk_size - overlap
     for filename, pdf_data in pdfs_data.items():
-        pdf_link = pdf_data["link"]
+        doc_id = rag_chunks.add_document(filename, pdf_data["link"])
         for page_num, paragraphs in pdf_data["pages"].items():
             for paragraph in paragraphs:
-                words = paragraph.split()
-                for i in range(0, len(words), step):
-                    chunk_text = " ".join(words[i:i + chunk_size])
-                    rag_chunks.append({
-                        "chunk": chunk_text,
-                        "source_paragraph": paragraph,
-                        "page": page_num,
-                        "pdf_link": f"{pdf_link}#page={page_num}"
-                    })
+                if paragraph.strip():
+                    rag_chunks.add_paragraph(doc_id, page_num, paragraph)
+
+    # All paragraphs are tokenized in large batches, then cut on token offsets
+    spans = iter_chunk_spans(rag_chunks.paragraphs, chunk_size, overlap, model_name, max_tokens)
+    for paragraph_id, paragraph_spans in enumerate(spans):
+        for start, end in paragraph_spans:
+            rag_chunks.add_chunk(paragraph_id, start, end)
+    # Term counts for the BM25 index, stored with the embeddings
+    rag_chunks.terms = lexical_term_csr(rag_chunks.texts())
+    incr("chunks_created", len(rag_chunks))
     return rag_chunks
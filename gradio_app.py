@@ -1,9 +1,14 @@
-import os
-import gradio as gr
-from hdf5_file_constructor import store_pdfs_in_hdf5, load_pdfs_from_hdf5
-from embeddings import embed_text, create_rag_chunks_from_hdf5, search_docs
-from azure_gpt import get_cited_RAG_completion
-import pandas as pd
+import time
+_startup_start = time.perf_counter()  # measures cold start up to demo.launch()
+
+from hdf5_file_constructor import (update_pdfs_in_hdf5, get_embedded_document_hashes,
+                                   tombstone_embeddings_in_hdf5, restore_embeddings_in_hdf5, get_embedding_progress,
+                                   EMBEDDINGS_HDF5)
+from embeddings import (embed_and_store, create_rag_chunks_from_hdf5, search_docs, embedding_model_key, get_query_embedding,
+                        load_search_corpus, RETRIEVAL_MODE, ANSWER_TOP_K)
+from azure_gpt import stream_cited_RAG_completion
+from vector_store import register_corpus
+from metrics import start_metrics_server
 
 MODEL_CONFIGS = {
     "all-MiniLM-L6-v2": {
@@ -21,56 +26,66 @@ MODEL_CONFIGS = {
         "dimension": 768,
         "recommended_chunk": 800,
         'overlap':300}}
+# context_window: tokens of prompt and answer the model accepts; max_tokens: ceiling of the answer length
 LLM_CONFIGS = {
     'AzureGPT': {
+        "context_window": 8192,
         "max_tokens": 4096,
         "dimension": 768,
         "recommended_chunk": 2000,
         'overlap': 300
     },
     'gpt-4o': {
+        "context_window": 128000,
         "max_tokens": 8192,
         "dimension": 1536,
         "recommended_chunk": 4000,
         'overlap': 400
     },
     'gpt-4o-mini': {
+        "context_window": 128000,
         "max_tokens": 4096,
         "dimension": 1024,
         "recommended_chunk": 2000,
         'overlap': 300
     },
     'gpt-4o-turbo': {
+        "context_window": 128000,
         "max_tokens": 128000,
         "dimension": 1536,
         "recommended_chunk": 8000,
         'overlap': 500
     },
     'gpt-4o-turbo-mini': {
+        "context_window": 128000,
         "max_tokens": 64000,
         "dimension": 1024,
         "recommended_chunk": 4000,
         'overlap': 400
     },
     'gpt-3.5-turbo': {
+        "context_window": 16385,
         "max_tokens": 4096,
         "dimension": 1024,
         "recommended_chunk": 2000,
         'overlap': 300
     },
     'gpt-3.5-turbo-mini': {
+        "context_window": 16385,
         "max_tokens": 2048,
         "dimension": 768,
         "recommended_chunk": 1000,
         'overlap': 200
     },
     'gpt-3.5-turbo-ada': {
+        "context_window": 16385,
         "max_tokens": 4096,
         "dimension": 1536,
         "recommended_chunk": 2000,
         'overlap': 300
     },
     'gpt-3.5-turbo-ada-mini': {
+        "context_window": 16385,
         "max_tokens": 2048,
         "dimension": 1024,
         "recommended_chunk": 1000,
@@ -106,24 +121,49 @@ def process_file(file):
     
     return file.name
 
-def setup_process(files,model_choice,llm_choice,chunk_size,overlap,temp_def, max_tokens):
+def setup_process(files,model_choice,llm_choice,chunk_size,overlap,temp_def, max_tokens, replace_corpus=False):
     
     filess=[process_file(file) for file in files]
 
-    pdf_hdf5=store_pdfs_in_hdf5(filess,'pdfs_chunks.hdf5')
+    # Only new and modified PDFs are extracted; PDFs missing from the upload are only
+    # tombstoned when the upload replaces the corpus
+    pdf_hdf5='pdfs_chunks.hdf5'
+    changes=update_pdfs_in_hdf5(filess,pdf_hdf5,replace=replace_corpus)
+    doc_hashes=changes["hashes"]
 
-    raged_hdf5=create_rag_chunks_from_hdf5(pdf_hdf5,chunk_size,overlap)
+    # Chunk and embed only the PDFs whose stored embeddings are missing or stale
+    model_key = embedding_model_key(model_choice, llm_choice)
+    embedded_hashes = get_embedded_document_hashes(EMBEDDINGS_HDF5, model_key, chunk_size, overlap)
+    stale = [f for f, h in embedded_hashes.items() if doc_hashes.get(f) != h]
+    # Partly embedded PDFs (interrupted run) that were removed from the corpus since
+    partial_docs, _ = get_embedding_progress(EMBEDDINGS_HDF5, model_key, chunk_size, overlap)
+    stale += [f for f in partial_docs if f not in doc_hashes]
+    tombstone_embeddings_in_hdf5(EMBEDDINGS_HDF5, model_key, chunk_size, overlap, stale)
+    # PDFs added again unchanged get their tombstoned embeddings back instead of being re-embedded
+    missing = {f: h for f, h in doc_hashes.items() if embedded_hashes.get(f) != h}
+    restored = restore_embeddings_in_hdf5(EMBEDDINGS_HDF5, model_key, chunk_size, overlap, missing)
+    pending = [f for f in missing if f not in restored]
 
-    # for c in raged_hdf5[:20]:
-    #     print(f"Chunk (Page {c['page']}) - {c['pdf_link']}\n{c['chunk']}\n")
-    rag_chunks=embed_text(raged_hdf5,model_choice,llm_choice)
+    status_message = (f"Setup complete: {len(pending)} documents embedded, {len(doc_hashes) - len(pending)} loaded from "
+                      f"the HDF5 store ({len(restored)} restored), {len(changes['removed'])} removed.")
+    if pending:
+        raged_hdf5=create_rag_chunks_from_hdf5(pdf_hdf5,chunk_size,overlap,filenames=pending,model_name=model_choice,
+                                                max_tokens=MODEL_CONFIGS.get(model_choice, {}).get("max_tokens"))
 
-    df = pd.DataFrame(rag_chunks)
+        # for c in raged_hdf5[:20]:
+        #     print(f"Chunk (Page {c['page']}) - {c['pdf_link']}\n{c['chunk']}\n")
+        # Embedded chunks are stored checkpoint by checkpoint; a failed run resumes on the next Set Up
+        stored = embed_and_store(raged_hdf5, model_choice, llm_choice, EMBEDDINGS_HDF5, chunk_size, overlap,
+                                 {f: doc_hashes[f] for f in pending})
+        if not stored:
+            status_message = (f"Setup incomplete: embedding stopped for {len(pending)} documents. "
+                              "Completed checkpoints are stored, run Set Up again to resume.")
 
-    df.to_csv('rag_chunks.csv')
-    status_message = "Setup complete: embeddings generated."
+    rag_chunks = load_search_corpus(EMBEDDINGS_HDF5, model_key, chunk_size, overlap)
+    rag_chunks.to_csv('rag_chunks.csv', 'rag_paragraphs.csv')
 
-    return df, status_message
+    # The session keeps a handle, the table and the index are shared by all sessions
+    return register_corpus(rag_chunks), status_message
 
 # call back functions for question embedding LLM input and answer
 def answer_question(question_input, model_choice, top_n, rag_chunks, llm_choice, temp_def, max_tokens):
@@ -136,21 +176,35 @@ def answer_question(question_input, model_choice, top_n, rag_chunks, llm_choice,
         processing_status = "📚 Searching relevant documents..."
         yield processing_status, ""
         
-        df_top = search_docs(rag_chunks, question_input, model_choice, llm_choice, top_n, to_print=True)
+        # Only the best ANSWER_TOP_K chunks above the threshold are resolved and offered to the packer
+        df_top = search_docs(rag_chunks, question_input, model_choice, llm_choice, top_n, to_print=True,
+                             top_k=ANSWER_TOP_K)
         res = df_top
         
         # Generate answer with LLM
         processing_status = "🤖 Generating answer with AI..."
         yield processing_status, ""
         
-        ans = get_cited_RAG_completion(
+        # Stream the answer into the answer pane as tokens arrive. The answer cache is keyed
+        # on the query embedding, taken from the cache filled by search_docs; lexical
+        # retrieval embeds nothing, so it skips the answer cache rather than pay for one
+        query_embedding = None
+        if RETRIEVAL_MODE != "lexical":
+            query_embedding = get_query_embedding(question_input, model_choice, llm_choice)
+        ans = ""
+        for delta in stream_cited_RAG_completion(
             question_input, 
             res, 
             llm_choice,  # Pass llm_choice as the third parameter
             top_n,
             temp_def=temp_def, 
-            max_tokens=max_tokens
-        )
+            max_tokens=max_tokens,
+            query_embedding=query_embedding,
+            # The context is packed best-first into what the LLM's window leaves for the prompt
+            context_tokens=LLM_CONFIGS.get(llm_choice, {}).get("context_window")
+        ):
+            ans += delta
+            yield processing_status, ans
         
         # Final result
         yield "✅ Complete", ans
@@ -160,133 +214,144 @@ def answer_question(question_input, model_choice, top_n, rag_chunks, llm_choice,
 
 
 
-# call back function for LLM input and answer
-theme = gr.themes.Base(
-    primary_hue="gray",
-    secondary_hue="gray", 
-    neutral_hue="gray",
-    font=("Arial", "Helvetica", "sans-serif"),
-    font_mono=("Courier New", "monospace"),
-    radius_size="none",  # No rounded corners
-    spacing_size="sm",   # Compact spacing
-).set(
-    # Colors
-    body_background_fill="white",
-    block_background_fill="#fafafa",
-    block_border_color="#d0d0d0",
-    block_border_width="1px",
-    shadow_drop="none",  # No shadows in v5
-    
-    # Buttons
-    button_primary_background_fill="#003366",
-    button_primary_background_fill_hover="#002244",
-    button_primary_text_color="white",
-    button_primary_border_color="transparent",
-    
-    # Inputs
-    input_background_fill="white",
-    input_border_color="#d0d0d0",
-    input_border_width="1px",
-    
-    # Text
-    block_title_text_weight="400",  # Normal weight
-    block_label_text_weight="400",
-)
-
-# Build the Gradio interface
-with gr.Blocks(title="Nuclear Power Assistant for Retrieval of Technical Data", theme=theme) as demo:
-    gr.Markdown("# Designed for Nuclear Technical Data Retrieval and Analysis")
-    gr.Markdown("RAG (Retrieval-Augmented Generation) Application for Nuclear Safety")
-    
-    with gr.Tab("Set Up"):
-        with gr. Row():
-            with gr.Column():
-                
-                llm_choice = gr.Dropdown(
-                    choices=list(LLM_CONFIGS.keys()),
-                    label="LLM Model",
-                    value=list(LLM_CONFIGS.keys())[0],
-                    container=True,
-                    min_width=200
-                )
-                temp_def=gr.Slider(minimum=0,maximum=1,step=0.1,label="Temperature",value=0.5,container=True)
-                max_tokens = gr.Slider(minimum=100,
-                                       maximum=LLM_CONFIGS[list(LLM_CONFIGS.keys())[0]]["max_tokens"],
-                                       step=100,label="Max Tokens",
-                                       value=LLM_CONFIGS[list(LLM_CONFIGS.keys())[0]]["recommended_chunk"],
-                                       container=True)
-                files = gr.File(label="Upload PDFs", file_count="multiple",scale=1)
-                
- 
-            with gr.Column():
-                    model_choice = gr.Dropdown(
-                    choices=list(MODEL_CONFIGS.keys()),
-                    label="Embedding Model",
-                    value=list(MODEL_CONFIGS.keys())[0]
-                )
-            # with gr.Row():
-                    chunk_size = gr.Slider(
-                        minimum=100,
-                        maximum=MODEL_CONFIGS[list(MODEL_CONFIGS.keys())[0]]["max_tokens"],
-                        step=50,
-                        label="Chunk Size",
-                        value=MODEL_CONFIGS[list(MODEL_CONFIGS.keys())[0]]["recommended_chunk"]
+def build_demo():
+    """
+    Builds the Gradio interface. Only the app process calls it: PDF extraction and embedding
+    worker processes re-import this script as __mp_main__ and skip the UI.
+    """
+    theme = gr.themes.Base(
+        primary_hue="gray",
+        secondary_hue="gray", 
+        neutral_hue="gray",
+        font=("Arial", "Helvetica", "sans-serif"),
+        font_mono=("Courier New", "monospace"),
+        radius_size="none",  # No rounded corners
+        spacing_size="sm",   # Compact spacing
+    ).set(
+        # Colors
+        body_background_fill="white",
+        block_background_fill="#fafafa",
+        block_border_color="#d0d0d0",
+        block_border_width="1px",
+        shadow_drop="none",  # No shadows in v5
+
+        # Buttons
+        button_primary_background_fill="#003366",
+        button_primary_background_fill_hover="#002244",
+        button_primary_text_color="white",
+        button_primary_border_color="transparent",
+
+        # Inputs
+        input_background_fill="white",
+        input_border_color="#d0d0d0",
+        input_border_width="1px",
+
+        # Text
+        block_title_text_weight="400",  # Normal weight
+        block_label_text_weight="400",
+    )
+
+    # Build the Gradio interface
+    with gr.Blocks(title="Nuclear Power Assistant for Retrieval of Technical Data", theme=theme) as demo:
+        gr.Markdown("# Designed for Nuclear Technical Data Retrieval and Analysis")
+        gr.Markdown("RAG (Retrieval-Augmented Generation) Application for Nuclear Safety")
+
+        with gr.Tab("Set Up"):
+            with gr. Row():
+                with gr.Column():
+
+                    llm_choice = gr.Dropdown(
+                        choices=list(LLM_CONFIGS.keys()),
+                        label="LLM Model",
+                        value=list(LLM_CONFIGS.keys())[0],
+                        container=True,
+                        min_width=200
                     )
-                    overlap = gr.Slider(
-                        minimum=0,
-                        maximum=1000,
-                        step=10,
-                        label="Overlap",
-                        value=MODEL_CONFIGS[list(MODEL_CONFIGS.keys())[0]]["overlap"]
+                    temp_def=gr.Slider(minimum=0,maximum=1,step=0.1,label="Temperature",value=0.5,container=True)
+                    max_tokens = gr.Slider(minimum=100,
+                                           maximum=LLM_CONFIGS[list(LLM_CONFIGS.keys())[0]]["max_tokens"],
+                                           step=100,label="Max Tokens",
+                                           value=LLM_CONFIGS[list(LLM_CONFIGS.keys())[0]]["recommended_chunk"],
+                                           container=True)
+                    files = gr.File(label="Upload PDFs", file_count="multiple",scale=1)
+                    replace_corpus = gr.Checkbox(label="Replace corpus (remove stored PDFs missing from this upload)",
+                                                 value=False, container=True)
+
+
+                with gr.Column():
+                        model_choice = gr.Dropdown(
+                        choices=list(MODEL_CONFIGS.keys()),
+                        label="Embedding Model",
+                        value=list(MODEL_CONFIGS.keys())[0]
                     )
-    
-                    setup_button = gr.Button("Set Up")
-                    status_message = gr.Textbox(label="Processing Output")
-            
-        with gr.Row():
-            # rag_chunks=gr.Dataframe(label="Embedding Results", headers=[""])
-            rag_chunks=gr.State()
-
-            setup_button.click(fn=setup_process, inputs=[files, model_choice,llm_choice, chunk_size, overlap,temp_def, max_tokens], outputs=[rag_chunks,status_message])
-            model_choice.change(fn=update_from_model_config, inputs=model_choice, outputs=[chunk_size, overlap])
-            llm_choice.change(
-                fn=update_from_llm_config, 
-                inputs=llm_choice, 
-                outputs=[chunk_size,max_tokens]
-            )
-    # When the model dropdown changes, update both the chunk_size and overlap sliders.
-    
-        with gr.Tab("Ask Question"):
-            top_n = gr.Slider(minimum=1, maximum=100, step=1, label="Similarity Threshold",value=20)
-            question_input = gr.Textbox(label="Your Question")
-            answer_button = gr.Button("Answer")
-            
-            # Add processing status indicator
-            processing_status = gr.Textbox(
-                label="Status",
-                value="Ready to answer questions",
-                interactive=False,
-                show_copy_button=False
-            )
-            
-            answer_output = gr.Markdown(
-                label="Answer",
-                latex_delimiters=[
-                    {"left": "$$", "right": "$$", "display": True},   # Block math
-                    {"left": "$", "right": "$", "display": False},     # Inline math
-                    {"left": "\\[", "right": "\\]", "display": True},  # Block math alternative
-                    {"left": "\\(", "right": "\\)", "display": False}  # Inline math alternative
-                ]
-            )
-            
-            # Update button click to handle both status and answer outputs
-            answer_button.click(
-                fn=answer_question, 
-                inputs=[question_input, model_choice, top_n, rag_chunks, llm_choice, temp_def, max_tokens], 
-                outputs=[processing_status, answer_output]
-            )
-    
+                # with gr.Row():
+                        chunk_size = gr.Slider(
+                            minimum=100,
+                            maximum=MODEL_CONFIGS[list(MODEL_CONFIGS.keys())[0]]["max_tokens"],
+                            step=50,
+                            label="Chunk Size (tokens)",
+                            value=MODEL_CONFIGS[list(MODEL_CONFIGS.keys())[0]]["recommended_chunk"]
+                        )
+                        overlap = gr.Slider(
+                            minimum=0,
+                            maximum=1000,
+                            step=10,
+                            label="Overlap (tokens)",
+                            value=MODEL_CONFIGS[list(MODEL_CONFIGS.keys())[0]]["overlap"]
+                        )
+
+                        setup_button = gr.Button("Set Up")
+                        status_message = gr.Textbox(label="Processing Output")
+
+            with gr.Row():
+                # rag_chunks=gr.Dataframe(label="Embedding Results", headers=[""])
+                rag_chunks=gr.State()
+
+                setup_button.click(fn=setup_process, inputs=[files, model_choice,llm_choice, chunk_size, overlap,temp_def, max_tokens, replace_corpus], outputs=[rag_chunks,status_message])
+                model_choice.change(fn=update_from_model_config, inputs=model_choice, outputs=[chunk_size, overlap])
+                llm_choice.change(
+                    fn=update_from_llm_config, 
+                    inputs=llm_choice, 
+                    outputs=[chunk_size,max_tokens]
+                )
+        # When the model dropdown changes, update both the chunk_size and overlap sliders.
+
+            with gr.Tab("Ask Question"):
+                top_n = gr.Slider(minimum=1, maximum=100, step=1, label="Similarity Threshold",value=20)
+                question_input = gr.Textbox(label="Your Question")
+                answer_button = gr.Button("Answer")
+
+                # Add processing status indicator
+                processing_status = gr.Textbox(
+                    label="Status",
+                    value="Ready to answer questions",
+                    interactive=False,
+                    show_copy_button=False
+                )
+
+                answer_output = gr.Markdown(
+                    label="Answer",
+                    latex_delimiters=[
+                        {"left": "$$", "right": "$$", "display": True},   # Block math
+                        {"left": "$", "right": "$", "display": False},     # Inline math
+                        {"left": "\\[", "right": "\\]", "display": True},  # Block math alternative
+                        {"left": "\\(", "right": "\\)", "display": False}  # Inline math alternative
+                    ]
+                )
+
+                # Update button click to handle both status and answer outputs
+                answer_button.click(
+                    fn=answer_question, 
+                    inputs=[question_input, model_choice, top_n, rag_chunks, llm_choice, temp_def, max_tokens], 
+                    outputs=[processing_status, answer_output]
+                )
+    return demo
 
  
 if __name__ == "__main__":
+    # Imported here rather than at the top, for the same reason: workers never load Gradio
+    import gradio as gr
+    demo = build_demo()
+    print(f"App startup took {time.perf_counter() - _startup_start:.2f}s")
+    start_metrics_server()
     demo.launch()
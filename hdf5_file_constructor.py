@@ -2,7 +2,23 @@ import fitz  # PyMuPDF
 import os
 import json
 import h5py
+import hashlib
 import pathlib
+import numpy as np
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from concurrent.futures.process import BrokenProcessPool
+
+from chunk_table import ChunkTable
+from vector_index import (SparseVector, IVFIndex, to_float32_matrix, sparse_vectors_to_csr,
+                          csr_to_sparse_vectors, select_csr_rows)
+from lexical_index import lexical_term_csr
+from metrics import incr, timed
+from model_registry import get_or_create, discard, get_process_context
+
+EMBEDDINGS_HDF5 = "embeddings_store.hdf5"
+ANN_INDEX_HDF5 = "ann_index.hdf5"
+# Worker processes used to extract PDFs, 0 means one per CPU core
+PDF_EXTRACT_WORKERS = int(os.environ.get("PDF_EXTRACT_WORKERS", 0))
 
 def get_file_url(file_path):
     # Convert to absolute path
@@ -55,31 +71,164 @@ def extract_paragraphs_from_pdf(pdf_path):
 
     return pdf_data
 
-def store_pdfs_in_hdf5(pdf_paths, hdf5_filename):
+def file_content_hash(pdf_path, block_size=1 << 20):
+    """
+    Returns the SHA-256 of a file's bytes, used to detect new and modified PDFs.
+    """
+    digest = hashlib.sha256()
+    with open(pdf_path, "rb") as f:
+        for block in iter(lambda: f.read(block_size), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+def pdf_extract_workers(max_workers=PDF_EXTRACT_WORKERS):
+    return max_workers or os.cpu_count() or 1
+
+def get_pdf_extract_pool(max_workers=PDF_EXTRACT_WORKERS):
+    """
+    Returns the PDF extraction process pool, started on first use and reused by later
+    set-ups. Worker processes are started as tasks need them and then stay up, so small
+    incremental uploads do not pay their start-up again.
+    """
+    workers = pdf_extract_workers(max_workers)
+    # Not forked: Set Up runs inside the threaded Gradio server
+    return get_or_create(("pdf_extract_pool", workers),
+                         lambda: ProcessPoolExecutor(max_workers=workers, mp_context=get_process_context()))
+
+def iter_extracted_pdfs(pdf_paths, max_workers=PDF_EXTRACT_WORKERS):
+    """
+    Extracts PDFs, in the worker processes of the extraction pool when more than one
+    worker is available. Results are yielded as they complete, so a single caller can
+    write them to HDF5.
+
+    Args:
+        pdf_paths (list): List of PDF file paths.
+        max_workers (int): Number of worker processes, 0 means one per CPU core.
+
+    Yields:
+        tuple: (pdf_path, pdf_data) as returned by extract_paragraphs_from_pdf.
+    """
+    pdf_paths = list(pdf_paths)
+    if min(pdf_extract_workers(max_workers), len(pdf_paths)) <= 1:
+        for pdf_path in pdf_paths:
+            yield pdf_path, extract_paragraphs_from_pdf(pdf_path)
+        return
+
+    pool = get_pdf_extract_pool(max_workers)
+    futures = {pool.submit(extract_paragraphs_from_pdf, pdf_path): pdf_path for pdf_path in pdf_paths}
+    try:
+        for future in as_completed(futures):
+            yield futures[future], future.result()
+    except BrokenProcessPool:
+        # A worker died (e.g. out of memory): the next set-up starts a new pool
+        discard(("pdf_extract_pool", pdf_extract_workers(max_workers)))
+        pool.shutdown(wait=False, cancel_futures=True)
+        raise
+    finally:
+        # Extractions still queued when the caller stops early are dropped
+        for future in futures:
+            future.cancel()
+
+@timed("pdf_ingest")
+def store_pdfs_in_hdf5(pdf_paths, hdf5_filename, max_workers=PDF_EXTRACT_WORKERS):
     """
     Processes multiple PDFs and stores their structured text into an HDF5 file.
 
     Args:
         pdf_paths (list): List of PDF file paths.
         hdf5_filename (str): Name of the HDF5 file to store the data.
+        max_workers (int): Extraction worker processes, 0 means one per CPU core.
     """
     with h5py.File(hdf5_filename, "w") as hdf5_file:
-        for pdf_path in pdf_paths:
-            pdf_data = extract_paragraphs_from_pdf(pdf_path)
-
+        for pdf_path, pdf_data in iter_extracted_pdfs(pdf_paths, max_workers):
+            incr("pdfs_extracted")
+            incr("pages_extracted", len(pdf_data["pages"]))
             # Convert dict to JSON string before storing in HDF5
             pdf_json = json.dumps(pdf_data, indent=2)
 
             # Store each PDF's data under a group named after the filename
-            hdf5_file.create_dataset(pdf_data["filename"], data=pdf_json)
+            dataset = hdf5_file.create_dataset(pdf_data["filename"], data=pdf_json)
+            dataset.attrs["content_hash"] = file_content_hash(pdf_path)
 
     print(f"Stored {len(pdf_paths)} PDFs in {hdf5_filename}")
 
     return hdf5_filename
+
+@timed("pdf_ingest")
+def update_pdfs_in_hdf5(pdf_paths, hdf5_filename, max_workers=PDF_EXTRACT_WORKERS, replace=False):
+    """
+    Incrementally syncs the HDF5 file with the given PDFs. Unchanged PDFs (same content
+    hash) are skipped and new and modified ones are extracted and written. Stored PDFs
+    missing from pdf_paths stay in the corpus, unless replace is set: the given PDFs then
+    make up the whole corpus and the others are tombstoned rather than deleted.
+
+    Args:
+        pdf_paths (list): List of PDF file paths.
+        hdf5_filename (str): Name of the HDF5 file to store the data.
+        max_workers (int): Extraction worker processes, 0 means one per CPU core.
+        replace (bool): Remove the stored PDFs that are not in pdf_paths.
+
+    Returns:
+        dict: Filename lists under "added", "modified", "removed", "unchanged" and "kept"
+        (stored, not uploaded), and the content hash of every current PDF under "hashes".
+    """
+    changes = {"added": [], "modified": [], "removed": [], "unchanged": [], "kept": [], "hashes": {}}
+    to_extract = []
+
+    with h5py.File(hdf5_filename, "a") as hdf5_file:
+        for pdf_path in pdf_paths:
+            filename = os.path.basename(pdf_path)
+            content_hash = file_content_hash(pdf_path)
+            changes["hashes"][filename] = content_hash
+
+            if filename in hdf5_file:
+                dataset = hdf5_file[filename]
+                same_content = dataset.attrs.get("content_hash") == content_hash
+                if same_content and not dataset.attrs.get("deleted", False):
+                    changes["unchanged"].append(filename)
+                    continue
+                if same_content:
+                    # Re-added with the same content: restore the tombstoned text
+                    dataset.attrs["deleted"] = False
+                    changes["added"].append(filename)
+                    continue
+                changes["modified" if not dataset.attrs.get("deleted", False) else "added"].append(filename)
+                del hdf5_file[filename]
+            else:
+                changes["added"].append(filename)
+            to_extract.append(pdf_path)
+
+        # Workers only parse; this process is the single HDF5 writer
+        for pdf_path, pdf_data in iter_extracted_pdfs(to_extract, max_workers):
+            incr("pdfs_extracted")
+            incr("pages_extracted", len(pdf_data["pages"]))
+            filename = os.path.basename(pdf_path)
+            dataset = hdf5_file.create_dataset(filename, data=json.dumps(pdf_data, indent=2))
+            dataset.attrs["content_hash"] = changes["hashes"][filename]
+            dataset.attrs["deleted"] = False
+
+        for filename in hdf5_file.keys():
+            dataset = hdf5_file[filename]
+            if filename in changes["hashes"] or dataset.attrs.get("deleted", False):
+                continue
+            if replace:
+                dataset.attrs["deleted"] = True
+                changes["removed"].append(filename)
+            else:
+                # A partial upload adds to the corpus, it does not remove the other PDFs
+                changes["hashes"][filename] = dataset.attrs.get("content_hash")
+                changes["kept"].append(filename)
+
+    print(f"Synced {len(pdf_paths)} PDFs in {hdf5_filename}: {len(changes['added'])} added, "
+          f"{len(changes['modified'])} modified, {len(changes['removed'])} removed, "
+          f"{len(changes['unchanged'])} unchanged, {len(changes['kept'])} kept")
+
+    return changes
     
-def load_pdfs_from_hdf5(hdf5_filename):
+def load_pdfs_from_hdf5(hdf5_filename, filenames=None):
     """
     Loads all PDFs stored in an HDF5 file and reconstructs the original dictionary format.
+    Tombstoned PDFs are skipped; filenames restricts loading to the given PDFs.
 
     Returns:
         dict: { "filename": { "link": pdf_link, "pages": { page_number: [paragraphs] } } }
@@ -88,7 +237,429 @@ def load_pdfs_from_hdf5(hdf5_filename):
 
     with h5py.File(hdf5_filename, "r") as hdf5_file:
         for filename in hdf5_file.keys():
+            if filenames is not None and filename not in filenames:
+                continue
+            if hdf5_file[filename].attrs.get("deleted", False):
+                continue
             pdf_json = hdf5_file[filename][()]  # Read as byte string
             pdfs_data[filename] = json.loads(pdf_json.decode("utf-8"))  # Convert back to dict
 
-    return pdfs_data
\ No newline at end of file
+    return pdfs_data
+
+
+def corpus_fingerprint(rag_chunks):
+    """
+    Computes a stable hash of the chunk texts and their locations, used to tell whether
+    two sets of chunks belong to the same corpus.
+    """
+    digest = hashlib.sha256()
+    for i in range(len(rag_chunks)):
+        digest.update(f"{rag_chunks.pdf_link(i)}\x00{rag_chunks.chunk_text(i)}\x00".encode("utf-8"))
+    return digest.hexdigest()
+
+def embedding_store_key(model_name, chunk_size, overlap):
+    # One group per embedding model and chunking configuration (sizes in model tokens)
+    return f"{model_name}/tokens{int(chunk_size)}_overlap{int(overlap)}"
+
+# An embedding group holds normalized tables: documents (doc_filename, doc_link),
+# paragraphs (paragraph, paragraph_doc, paragraph_page) and one row per chunk
+# (_CHUNK_COLUMNS, deleted, the embedding and its lexical term counts as CSR terms_*)
+_CHUNK_COLUMNS = ("chunk_paragraph", "chunk_start", "chunk_end")
+
+def _append_rows(dataset, values):
+    # Grows a resizable dataset along its first axis
+    start = dataset.shape[0]
+    dataset.resize(start + len(values), axis=0)
+    dataset[start:] = values
+
+def _is_appendable(group):
+    # Groups written before the normalized layout are rebuilt (their PDFs are re-embedded)
+    return group is not None and "deleted" in group and "chunk_paragraph" in group and "terms_indptr" in group
+
+def _open_embedding_group(hdf5_file, key, is_sparse, dimension, model_name, chunk_size, overlap):
+    """
+    Returns the appendable group for key, creating it (or replacing a group written in an
+    older, non-appendable layout) when needed.
+    """
+    group = hdf5_file.get(key)
+    if _is_appendable(group) and group.attrs.get("embedding_format") == ("csr" if is_sparse else "dense"):
+        return group
+    if group is not None:
+        del hdf5_file[key]
+
+    str_dtype = h5py.string_dtype(encoding="utf-8")
+    group = hdf5_file.create_group(key)
+    for column in ("doc_filename", "doc_link", "paragraph"):
+        group.create_dataset(column, shape=(0,), maxshape=(None,), dtype=str_dtype, chunks=True)
+    for column in ("paragraph_doc", "paragraph_page") + _CHUNK_COLUMNS:
+        group.create_dataset(column, shape=(0,), maxshape=(None,), dtype=np.int32, chunks=True)
+    group.create_dataset("deleted", shape=(0,), maxshape=(None,), dtype=bool, chunks=True)
+    group.create_dataset("terms_indptr", data=np.zeros(1, dtype=np.int64), maxshape=(None,), chunks=True)
+    group.create_dataset("terms_indices", shape=(0,), maxshape=(None,), dtype=np.int32, chunks=True)
+    group.create_dataset("terms_data", shape=(0,), maxshape=(None,), dtype=np.float32, chunks=True)
+    if is_sparse:
+        # Sparse (Fermi) vectors are stored as CSR arrays of token ids and weights
+        group.create_dataset("embedded_indptr", data=np.zeros(1, dtype=np.int64), maxshape=(None,), chunks=True)
+        group.create_dataset("embedded_indices", shape=(0,), maxshape=(None,), dtype=np.int32, chunks=True)
+        group.create_dataset("embedded_data", shape=(0,), maxshape=(None,), dtype=np.float32, chunks=True)
+        group.attrs["embedding_format"] = "csr"
+    else:
+        group.create_dataset("embedded", shape=(0, dimension), maxshape=(None, dimension), dtype=np.float32,
+                             chunks=(max(1, min(1024, (1 << 20) // (4 * max(dimension, 1)))), dimension))
+        group.attrs["embedding_format"] = "dense"
+    group.attrs["dimension"] = dimension
+    group.attrs["model_name"] = model_name
+    group.attrs["chunk_size"] = int(chunk_size)
+    group.attrs["overlap"] = int(overlap)
+    group.attrs["doc_hashes"] = "{}"
+    return group
+
+def get_embedded_document_hashes(hdf5_filename, model_name, chunk_size, overlap):
+    """
+    Returns { filename: content_hash } of the PDFs already embedded under this key.
+    """
+    if not os.path.exists(hdf5_filename):
+        return {}
+    key = embedding_store_key(model_name, chunk_size, overlap)
+    with h5py.File(hdf5_filename, "r") as hdf5_file:
+        group = hdf5_file.get(key)
+        if not _is_appendable(group):
+            return {}
+        return json.loads(group.attrs.get("doc_hashes", "{}"))
+
+def get_embedding_progress(hdf5_filename, model_name, chunk_size, overlap):
+    """
+    Returns the checkpoint of an interrupted embedding run under this key: the partially
+    stored PDFs as { filename: {"hash", "chunks" (stored), "total"} }, and the live stored
+    chunk count of every PDF as { filename: n_chunks }.
+    """
+    if not os.path.exists(hdf5_filename):
+        return {}, {}
+    key = embedding_store_key(model_name, chunk_size, overlap)
+    with h5py.File(hdf5_filename, "r") as hdf5_file:
+        group = hdf5_file.get(key)
+        if not _is_appendable(group):
+            return {}, {}
+        partial_docs = json.loads(group.attrs.get("partial_docs", "{}"))
+        live = ~group["deleted"][()]
+        chunk_docs = group["paragraph_doc"][()][group["chunk_paragraph"][()][live]]
+        filenames, counts = np.unique(group["doc_filename"].asstr()[()][chunk_docs], return_counts=True)
+    return partial_docs, dict(zip(filenames.tolist(), counts.tolist()))
+
+@timed("store")
+def append_embeddings_to_hdf5(rag_chunks, hdf5_filename, model_name, chunk_size, overlap, doc_hashes=None,
+                              partial_docs=None):
+    """
+    Appends the documents, paragraphs, chunks and embeddings of a ChunkTable as typed rows
+    to the group keyed by embedding model, chunk_size and overlap.
+
+    Args:
+        rag_chunks (ChunkTable): Chunks with one embedding each (rag_chunks.embeddings).
+        hdf5_filename (str): Name of the HDF5 file holding the embeddings.
+        model_name (str): Embedding model (and provider) the vectors were produced with.
+        chunk_size (int): Chunk size used to build the chunks.
+        overlap (int): Overlap used to build the chunks.
+        doc_hashes (dict): { filename: content_hash } of the PDFs these chunks complete.
+        partial_docs (dict): Progress of the PDFs these chunks only partly cover (see
+            get_embedding_progress), recorded as the checkpoint of the embedding run.
+
+    Returns:
+        bool: True if the embeddings were stored.
+    """
+    embeddings = rag_chunks.embeddings if len(rag_chunks) else []
+    if embeddings is None or len(embeddings) != len(rag_chunks) or any(e is None for e in embeddings):
+        print("Embeddings are incomplete, they will not be stored in the HDF5 store")
+        return False
+
+    is_sparse = bool(len(embeddings)) and isinstance(embeddings[0], SparseVector)
+    if is_sparse:
+        indptr, indices, data, dimension = sparse_vectors_to_csr(embeddings)
+    elif len(embeddings):
+        matrix = to_float32_matrix(embeddings)
+        dimension = matrix.shape[1]
+    key = embedding_store_key(model_name, chunk_size, overlap)
+
+    with h5py.File(hdf5_filename, "a") as hdf5_file:
+        if len(embeddings):
+            group = _open_embedding_group(hdf5_file, key, is_sparse, dimension, model_name, chunk_size, overlap)
+            # Ids of the appended rows continue after the rows already stored
+            doc_offset = group["doc_filename"].shape[0]
+            paragraph_offset = group["paragraph"].shape[0]
+            _append_rows(group["doc_filename"], rag_chunks.doc_filenames)
+            _append_rows(group["doc_link"], rag_chunks.doc_links)
+            _append_rows(group["paragraph"], rag_chunks.paragraphs)
+            _append_rows(group["paragraph_doc"], np.asarray(rag_chunks.paragraph_doc, dtype=np.int32) + doc_offset)
+            _append_rows(group["paragraph_page"], np.asarray(rag_chunks.paragraph_page, dtype=np.int32))
+            _append_rows(group["chunk_paragraph"],
+                         np.asarray(rag_chunks.chunk_paragraph, dtype=np.int32) + paragraph_offset)
+            _append_rows(group["chunk_start"], np.asarray(rag_chunks.chunk_start, dtype=np.int32))
+            _append_rows(group["chunk_end"], np.asarray(rag_chunks.chunk_end, dtype=np.int32))
+            _append_rows(group["deleted"], np.zeros(len(rag_chunks), dtype=bool))
+            terms_indptr, terms_indices, terms_data = rag_chunks.terms or lexical_term_csr(rag_chunks.texts())
+            _append_rows(group["terms_indptr"], terms_indptr[1:] + group["terms_indptr"][-1])
+            _append_rows(group["terms_indices"], terms_indices)
+            _append_rows(group["terms_data"], terms_data)
+            if is_sparse:
+                offset = group["embedded_indptr"][-1]
+                _append_rows(group["embedded_indptr"], indptr[1:] + offset)
+                _append_rows(group["embedded_indices"], indices)
+                _append_rows(group["embedded_data"], data)
+            else:
+                _append_rows(group["embedded"], matrix)
+        else:
+            group = hdf5_file.get(key)
+            if not _is_appendable(group):
+                return True
+
+        stored_hashes = json.loads(group.attrs.get("doc_hashes", "{}"))
+        stored_hashes.update(doc_hashes or {})
+        group.attrs["doc_hashes"] = json.dumps(stored_hashes)
+        # Progress is recorded after the rows, so a checkpoint never counts unwritten rows
+        stored_partial = json.loads(group.attrs.get("partial_docs", "{}"))
+        for filename in doc_hashes or {}:
+            stored_partial.pop(filename, None)
+        stored_partial.update(partial_docs or {})
+        group.attrs["partial_docs"] = json.dumps(stored_partial)
+
+    print(f"Appended {len(rag_chunks)} embeddings to {hdf5_filename}[{key}]")
+    return True
+
+def store_embeddings_in_hdf5(rag_chunks, hdf5_filename, model_name, chunk_size, overlap, doc_hashes=None,
+                             partial_docs=None):
+    """
+    Replaces the group keyed by embedding model, chunk_size and overlap with rag_chunks.
+    """
+    key = embedding_store_key(model_name, chunk_size, overlap)
+    if os.path.exists(hdf5_filename):
+        with h5py.File(hdf5_filename, "a") as hdf5_file:
+            if key in hdf5_file:
+                del hdf5_file[key]
+    return append_embeddings_to_hdf5(rag_chunks, hdf5_filename, model_name, chunk_size, overlap, doc_hashes,
+                                     partial_docs)
+
+def _row_docs(group):
+    # Document row of every chunk row
+    return group["paragraph_doc"][()][group["chunk_paragraph"][()]]
+
+def tombstone_embeddings_in_hdf5(hdf5_filename, model_name, chunk_size, overlap, filenames, compact_ratio=0.5):
+    """
+    Marks the rows of the given PDFs as deleted. The rows of fully embedded PDFs are
+    recorded under their content hash, so restore_embeddings_in_hdf5 can bring them back
+    if the same PDF is added again. When more than compact_ratio of the rows are
+    tombstoned, the group is rewritten with the live rows only (and the tombstoned rows
+    can no longer be restored).
+
+    Returns:
+        int: Number of rows tombstoned.
+    """
+    filenames = set(filenames)
+    if not filenames or not os.path.exists(hdf5_filename):
+        return 0
+
+    key = embedding_store_key(model_name, chunk_size, overlap)
+    with h5py.File(hdf5_filename, "a") as hdf5_file:
+        group = hdf5_file.get(key)
+        if not _is_appendable(group):
+            return 0
+        row_docs = _row_docs(group)
+        row_files = group["doc_filename"].asstr()[()][row_docs]
+        deleted = group["deleted"][()]
+        newly_deleted = np.isin(row_files, list(filenames)) & ~deleted
+        deleted |= newly_deleted
+        group["deleted"][:] = deleted
+
+        stored_hashes = json.loads(group.attrs.get("doc_hashes", "{}"))
+        stored_partial = json.loads(group.attrs.get("partial_docs", "{}"))
+        tombstoned = json.loads(group.attrs.get("tombstoned_docs", "{}"))
+        for filename in filenames:
+            content_hash = stored_hashes.pop(filename, None)
+            stored_partial.pop(filename, None)
+            docs = np.unique(row_docs[newly_deleted & (row_files == filename)])
+            if content_hash is not None and len(docs):
+                tombstoned.setdefault(filename, {})[content_hash] = docs.tolist()
+        group.attrs["doc_hashes"] = json.dumps(stored_hashes)
+        group.attrs["partial_docs"] = json.dumps(stored_partial)
+        group.attrs["tombstoned_docs"] = json.dumps(tombstoned)
+        needs_compaction = len(deleted) > 0 and deleted.mean() > compact_ratio
+
+    n_deleted = int(newly_deleted.sum())
+    print(f"Tombstoned {n_deleted} embeddings in {hdf5_filename}[{key}]")
+
+    if needs_compaction:
+        live_chunks = load_embeddings_from_hdf5(hdf5_filename, model_name, chunk_size, overlap) or ChunkTable()
+        store_embeddings_in_hdf5(live_chunks, hdf5_filename, model_name, chunk_size, overlap, stored_hashes,
+                                 stored_partial)
+
+    return n_deleted
+
+def restore_embeddings_in_hdf5(hdf5_filename, model_name, chunk_size, overlap, doc_hashes):
+    """
+    Brings back the tombstoned rows of PDFs added again with the content they had when
+    they were removed, instead of re-embedding them. Leftover rows of an interrupted run
+    for the same PDFs are tombstoned first.
+
+    Args:
+        doc_hashes (dict): { filename: content_hash } of the PDFs to restore if possible.
+
+    Returns:
+        list: Filenames whose embeddings were restored.
+    """
+    if not doc_hashes or not os.path.exists(hdf5_filename):
+        return []
+
+    key = embedding_store_key(model_name, chunk_size, overlap)
+    with h5py.File(hdf5_filename, "a") as hdf5_file:
+        group = hdf5_file.get(key)
+        if not _is_appendable(group):
+            return []
+        tombstoned = json.loads(group.attrs.get("tombstoned_docs", "{}"))
+        restorable = {f: tombstoned[f][h] for f, h in doc_hashes.items() if h in tombstoned.get(f, {})}
+        if not restorable:
+            return []
+
+        row_docs = _row_docs(group)
+        row_files = group["doc_filename"].asstr()[()][row_docs]
+        deleted = group["deleted"][()]
+        stored_hashes = json.loads(group.attrs.get("doc_hashes", "{}"))
+        stored_partial = json.loads(group.attrs.get("partial_docs", "{}"))
+        for filename, docs in restorable.items():
+            deleted |= row_files == filename
+            deleted &= ~np.isin(row_docs, docs)
+            stored_hashes[filename] = doc_hashes[filename]
+            stored_partial.pop(filename, None)
+            del tombstoned[filename][doc_hashes[filename]]
+            if not tombstoned[filename]:
+                del tombstoned[filename]
+        group["deleted"][:] = deleted
+        group.attrs["doc_hashes"] = json.dumps(stored_hashes)
+        group.attrs["partial_docs"] = json.dumps(stored_partial)
+        group.attrs["tombstoned_docs"] = json.dumps(tombstoned)
+
+    print(f"Restored the embeddings of {len(restorable)} documents in {hdf5_filename}[{key}]")
+    return list(restorable)
+
+def load_embeddings_from_hdf5(hdf5_filename, model_name, chunk_size, overlap, include_embeddings=True):
+    """
+    Loads the live (not tombstoned) chunks and their embeddings. Only the paragraphs and
+    documents referenced by live chunks are loaded.
+
+    Args:
+        include_embeddings (bool): When False, dense vectors are left on disk (read them with
+            iter_embedding_blocks); sparse vectors are always loaded.
+
+    Returns:
+        ChunkTable: Live chunks, with store_rows (rows in the HDF5 group) and embeddings
+        (float32 matrix, or SparseVectors for CSR groups), or None when nothing is stored
+        for this key.
+    """
+    if not os.path.exists(hdf5_filename):
+        return None
+
+    key = embedding_store_key(model_name, chunk_size, overlap)
+    with h5py.File(hdf5_filename, "r") as hdf5_file:
+        group = hdf5_file.get(key)
+        if not _is_appendable(group):
+            return None
+
+        live = np.flatnonzero(~group["deleted"][()])
+        chunk_columns = {column: group[column][()][live] for column in _CHUNK_COLUMNS}
+        # Keep the referenced paragraphs and documents and renumber them
+        paragraph_ids, chunk_paragraph = np.unique(chunk_columns["chunk_paragraph"], return_inverse=True)
+        paragraph_doc = group["paragraph_doc"][()][paragraph_ids]
+        doc_ids, paragraph_doc = np.unique(paragraph_doc, return_inverse=True)
+        rag_chunks = ChunkTable(
+            doc_filenames=group["doc_filename"].asstr()[()][doc_ids].tolist(),
+            doc_links=group["doc_link"].asstr()[()][doc_ids].tolist(),
+            paragraphs=group["paragraph"].asstr()[()][paragraph_ids].tolist(),
+            paragraph_doc=paragraph_doc.astype(np.int32).reshape(-1).tolist(),
+            paragraph_page=group["paragraph_page"][()][paragraph_ids].tolist(),
+            chunk_paragraph=chunk_paragraph.astype(np.int32).reshape(-1).tolist(),
+            chunk_start=chunk_columns["chunk_start"].tolist(),
+            chunk_end=chunk_columns["chunk_end"].tolist(),
+            terms=select_csr_rows(group["terms_indptr"][()], group["terms_indices"][()], group["terms_data"][()], live),
+            store_rows=live,
+        )
+        if group.attrs.get("embedding_format") == "csr":
+            embeddings = csr_to_sparse_vectors(group["embedded_indptr"][()], group["embedded_indices"][()],
+                                               group["embedded_data"][()], group.attrs["dimension"])
+            rag_chunks.embeddings = [embeddings[i] for i in live]
+        elif include_embeddings:
+            rag_chunks.embeddings = group["embedded"][()][live]
+
+    if rag_chunks.embeddings is None:
+        print(f"Loaded {len(live)} chunks from {hdf5_filename}[{key}], embeddings left on disk")
+    else:
+        print(f"Loaded {len(live)} embeddings from {hdf5_filename}[{key}]")
+    return rag_chunks
+
+def iter_embedding_blocks(hdf5_filename, model_name, chunk_size, overlap, store_rows, block_size=65536):
+    """
+    Yields the dense embeddings of the given (increasing) group rows in blocks, so a whole
+    corpus can be processed without loading its float32 matrix into memory.
+    """
+    store_rows = np.asarray(store_rows, dtype=np.int64)
+    key = embedding_store_key(model_name, chunk_size, overlap)
+    with h5py.File(hdf5_filename, "r") as hdf5_file:
+        dataset = hdf5_file[key]["embedded"]
+        for start in range(0, len(store_rows), block_size):
+            rows = store_rows[start:start + block_size]
+            # Read the covering slice, then keep the live rows
+            block = dataset[rows[0]:rows[-1] + 1]
+            yield block[rows - rows[0]]
+
+
+def store_ann_index_in_hdf5(index, hdf5_filename, corpus_version):
+    """
+    Stores the IVF structure (centroids and per-list row ids) of an IVFIndex under the corpus
+    version it was built for, with its measured recall. The vectors themselves stay in the
+    embeddings store.
+    """
+    with h5py.File(hdf5_filename, "a") as hdf5_file:
+        if corpus_version in hdf5_file:
+            del hdf5_file[corpus_version]
+        group = hdf5_file.create_group(corpus_version)
+        group.create_dataset("centroids", data=index.centroids)
+        group.create_dataset("row_ids", data=index.row_ids)
+        group.create_dataset("list_ptr", data=index.list_ptr)
+        group.attrs["n_rows"] = len(index)
+        group.attrs["nprobe"] = index.nprobe
+        if index.measured_recall is not None:
+            group.attrs["recall_at_10"] = index.measured_recall
+    print(f"Stored ANN index ({index.n_lists} lists) in {hdf5_filename}[{corpus_version}]")
+
+def delete_ann_index_from_hdf5(hdf5_filename, corpus_version):
+    """
+    Deletes the IVF structure stored for corpus_version, e.g. once that version is superseded.
+    """
+    if not os.path.exists(hdf5_filename):
+        return
+    with h5py.File(hdf5_filename, "a") as hdf5_file:
+        if corpus_version in hdf5_file:
+            del hdf5_file[corpus_version]
+            print(f"Deleted the ANN index of {corpus_version} from {hdf5_filename}")
+
+def load_ann_index_from_hdf5(hdf5_filename, corpus_version, embeddings, nprobe=None, list_ordered=False):
+    """
+    Rebuilds an IVFIndex for embeddings from the structure stored for corpus_version.
+    list_ordered: embeddings are the normalized rows in list order (see IVFIndex).
+
+    Returns:
+        IVFIndex: or None when no index was stored for this corpus version.
+    """
+    if not os.path.exists(hdf5_filename):
+        return None
+    with h5py.File(hdf5_filename, "r") as hdf5_file:
+        group = hdf5_file.get(corpus_version)
+        if group is None or group.attrs["n_rows"] != len(embeddings):
+            return None
+        centroids = group["centroids"][()]
+        row_ids = group["row_ids"][()]
+        list_ptr = group["list_ptr"][()]
+        stored_nprobe = int(group.attrs["nprobe"])
+        # The stored recall was measured at the stored nprobe
+        measured_recall = group.attrs.get("recall_at_10") if nprobe in (None, stored_nprobe) else None
+        nprobe = nprobe or stored_nprobe
+    print(f"Loaded ANN index ({len(centroids)} lists) from {hdf5_filename}[{corpus_version}]")
+    return IVFIndex(to_float32_matrix(embeddings), nprobe=nprobe, centroids=centroids,
+                    row_ids=row_ids, list_ptr=list_ptr, list_ordered=list_ordered,
+                    measured_recall=None if measured_recall is None else float(measured_recall))
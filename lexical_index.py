@@ -0,0 +1,131 @@
+#################################################################
+####---------BM25 lexical index and rank fusion----------------####
+#################################################################
+# Exact-term lookups such as "GDC 55" or "10 CFR 50.46" are poorly served by embeddings
+# alone. Term counts are computed for every chunk at ingest and stored next to its
+# embedding in the HDF5 store (terms_* datasets); the BM25 posting lists are rebuilt from
+# them at setup. A query only visits the posting lists of its own terms.
+import os
+import re
+import zlib
+import numpy as np
+
+from vector_index import SparseVector, sparse_vectors_to_csr, top_k_indices, get_registered_index, set_index
+
+BM25_K1 = float(os.environ.get("BM25_K1", 1.2))
+BM25_B = float(os.environ.get("BM25_B", 0.75))
+# Terms are hashed to 31-bit ids, so appended chunks need no shared vocabulary
+LEXICAL_DIMENSION = 1 << 31
+
+# Words and numbers, keeping dotted/dashed references such as 50.46 or 3.1-2 whole
+_TERM_RE = re.compile(r"[a-z0-9]+(?:[.\-][a-z0-9]+)*")
+
+
+def lexical_terms(text):
+    """
+    Lower-cased terms of a text, plus the bigrams of adjacent terms so that references
+    such as "gdc 55" outrank chunks that only mention "gdc" and "55" apart.
+    """
+    words = _TERM_RE.findall(text.lower())
+    return words + [f"{a} {b}" for a, b in zip(words, words[1:])]
+
+def term_ids(terms):
+    return np.fromiter((zlib.crc32(t.encode("utf-8")) & 0x7FFFFFFF for t in terms), dtype=np.int64, count=len(terms))
+
+def lexical_term_vector(text):
+    """
+    Returns the term counts of a text as a SparseVector over hashed term ids.
+    """
+    ids, counts = np.unique(term_ids(lexical_terms(text)), return_counts=True)
+    return SparseVector(ids, counts, LEXICAL_DIMENSION)
+
+def lexical_term_csr(texts):
+    # (indptr, indices, data) term counts of many texts
+    return sparse_vectors_to_csr(lexical_term_vector(text) for text in texts)[:3]
+
+
+class BM25Index:
+    """
+    Okapi BM25 over CSR term counts (one row per chunk). idf and length normalization are
+    folded into the posting weights at build time, so a query is a sum of posting lists.
+    """
+
+    def __init__(self, indptr, indices, data, k1=BM25_K1, b=BM25_B):
+        indptr = np.asarray(indptr, dtype=np.int64)
+        counts = np.asarray(data, dtype=np.float32)
+        self.n_rows = len(indptr) - 1
+        row_ids = np.repeat(np.arange(self.n_rows, dtype=np.int32), np.diff(indptr))
+        lengths = np.bincount(row_ids, weights=counts, minlength=self.n_rows)
+        avg_length = lengths.mean() if self.n_rows and lengths.mean() > 0 else 1.0
+
+        # Compact vocabulary: sorted hashed term ids, looked up with searchsorted
+        self.terms, term_index = np.unique(np.asarray(indices, dtype=np.int64), return_inverse=True)
+        term_index = term_index.reshape(-1)
+        doc_freq = np.bincount(term_index, minlength=len(self.terms))
+        idf = np.log1p((self.n_rows - doc_freq + 0.5) / (doc_freq + 0.5))
+        norm = k1 * (1 - b + b * lengths[row_ids] / avg_length)
+        weights = (idf[term_index] * counts * (k1 + 1) / (counts + norm)).astype(np.float32)
+
+        order = np.argsort(term_index, kind="stable")
+        self.posting_rows = row_ids[order]
+        self.posting_weights = weights[order]
+        self.term_ptr = np.zeros(len(self.terms) + 1, dtype=np.int64)
+        np.cumsum(doc_freq, out=self.term_ptr[1:])
+
+    def __len__(self):
+        return self.n_rows
+
+    def score(self, query):
+        """
+        Returns (rows, scores) of the chunks sharing at least one term with the query.
+        """
+        ids = np.unique(term_ids(lexical_terms(query)))
+        positions = np.minimum(np.searchsorted(self.terms, ids), max(len(self.terms) - 1, 0))
+        rows, weights = [], []
+        for term, p in zip(ids, positions):
+            if len(self.terms) and self.terms[p] == term:
+                rows.append(self.posting_rows[self.term_ptr[p]:self.term_ptr[p + 1]])
+                weights.append(self.posting_weights[self.term_ptr[p]:self.term_ptr[p + 1]])
+        if not rows:
+            return np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.float32)
+        rows, inverse = np.unique(np.concatenate(rows), return_inverse=True)
+        scores = np.bincount(inverse.reshape(-1), weights=np.concatenate(weights), minlength=len(rows))
+        return rows.astype(np.int64), scores.astype(np.float32)
+
+    def search(self, query, top_k=None):
+        """
+        Returns (ids, scores) of the best matching chunks, best first.
+        """
+        rows, scores = self.score(query)
+        best = top_k_indices(scores, top_k)
+        return rows[best], scores[best]
+
+
+def get_lexical_index(df):
+    """
+    Returns the BM25 index of the corpus in df (a ChunkTable), building it from df.terms
+    on first use.
+    """
+    index = get_registered_index(df, kind="bm25")
+    if index is None or len(index) != len(df):
+        if getattr(df, "terms", None) is None:
+            raise ValueError("No lexical index is registered for this corpus, run Set Up again")
+        index = BM25Index(*df.terms)
+        set_index(df, index, kind="bm25")
+    return index
+
+def reciprocal_rank_fusion(rankings, k=60, top_k=None):
+    """
+    Fuses ranked id lists: every list adds 1 / (k + rank) to the score of its ids.
+
+    Returns:
+        tuple: (ids, fused scores), best first.
+    """
+    fused = {}
+    for ranking in rankings:
+        for rank, row in enumerate(ranking):
+            fused[int(row)] = fused.get(int(row), 0.0) + 1.0 / (k + rank + 1)
+    ids = np.fromiter(fused.keys(), dtype=np.int64, count=len(fused))
+    scores = np.fromiter(fused.values(), dtype=np.float32, count=len(fused))
+    best = top_k_indices(scores, top_k)
+    return ids[best], scores[best]
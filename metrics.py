@@ -0,0 +1,191 @@
+#################################################################
+####---------Stage timings and counters------------------------####
+#################################################################
+# Pipeline stages (PDF extraction, chunking, embedding, search, prompt building, LLM
+# calls) are wrapped in named spans and the work they do is counted (chunks embedded,
+# API calls, retries, prompt tokens, ...). Collectors add the hit counts of the query and
+# answer caches. snapshot() returns everything as a dict; with METRICS_PORT set, the
+# same values are served in the Prometheus text format on /metrics.
+#
+# Disabled (the default), timed functions are called directly and incr() returns at
+# once, so instrumented code pays one attribute check per call.
+import functools
+import os
+import threading
+import time
+from bisect import bisect_left
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+METRICS_ENABLED = os.environ.get("METRICS_ENABLED", "0").lower() in ("1", "true", "yes")
+METRICS_PORT = int(os.environ.get("METRICS_PORT", 0))  # 0 = no scrape endpoint
+# Upper bounds (seconds) of the span duration histogram buckets
+SPAN_BUCKETS = (0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1.0, 5.0, 10.0, 60.0, 300.0)
+
+
+class _Span:
+    __slots__ = ("metrics", "name", "start")
+
+    def __init__(self, metrics, name):
+        self.metrics = metrics
+        self.name = name
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.metrics.observe(self.name, time.perf_counter() - self.start, error=exc_type is not None)
+        return False
+
+
+class Metrics:
+    """
+    Thread-safe counters and span statistics (count, errors, total, max and histogram of
+    the durations). Collectors are functions returning a dict of numbers, read on snapshot.
+    """
+
+    def __init__(self, enabled=METRICS_ENABLED):
+        self.enabled = enabled
+        self.started_at = time.time()
+        self._lock = threading.Lock()
+        self._counters = {}
+        self._spans = {}
+        self._collectors = {}
+
+    def incr(self, name, value=1):
+        if not self.enabled:
+            return
+        with self._lock:
+            self._counters[name] = self._counters.get(name, 0) + value
+
+    def observe(self, name, seconds, error=False):
+        if not self.enabled:
+            return
+        with self._lock:
+            stats = self._spans.get(name)
+            if stats is None:
+                stats = self._spans[name] = {"count": 0, "errors": 0, "total_seconds": 0.0, "max_seconds": 0.0,
+                                             "buckets": [0] * (len(SPAN_BUCKETS) + 1)}
+            stats["count"] += 1
+            stats["errors"] += bool(error)
+            stats["total_seconds"] += seconds
+            stats["max_seconds"] = max(stats["max_seconds"], seconds)
+            stats["buckets"][bisect_left(SPAN_BUCKETS, seconds)] += 1
+
+    def register_collector(self, name, collect):
+        with self._lock:
+            self._collectors[name] = collect
+
+    def snapshot(self):
+        """
+        Returns {"uptime_seconds", "counters", "spans", "collectors"}; span buckets are
+        non-cumulative counts per upper bound in SPAN_BUCKETS (the last one is +Inf).
+        """
+        with self._lock:
+            counters = dict(self._counters)
+            spans = {name: {**stats, "buckets": list(stats["buckets"])} for name, stats in self._spans.items()}
+            collectors = dict(self._collectors)
+        collected = {}
+        for name, collect in collectors.items():
+            try:
+                collected[name] = collect()
+            except Exception as e:
+                print(f"Error collecting {name} metrics: {str(e)}")
+        return {"uptime_seconds": time.time() - self.started_at, "counters": counters, "spans": spans,
+                "collectors": collected}
+
+    def reset(self):
+        with self._lock:
+            self._counters.clear()
+            self._spans.clear()
+
+    def render_prometheus(self, prefix="rag"):
+        """
+        Formats the snapshot in the Prometheus text exposition format. Every metric family
+        is preceded by its # TYPE line and its samples are grouped together.
+        """
+        snapshot = self.snapshot()
+        lines = [f"# TYPE {prefix}_uptime_seconds gauge", f"{prefix}_uptime_seconds {snapshot['uptime_seconds']:.3f}"]
+        for name, value in sorted(snapshot["counters"].items()):
+            lines += [f"# TYPE {prefix}_{name}_total counter", f"{prefix}_{name}_total {value}"]
+        spans = sorted(snapshot["spans"].items())
+        if spans:
+            metric = f"{prefix}_stage_duration_seconds"
+            lines.append(f"# TYPE {metric} histogram")
+            for name, stats in spans:
+                cumulative = 0
+                for bound, count in zip(SPAN_BUCKETS + ("+Inf",), stats["buckets"]):
+                    cumulative += count
+                    lines.append(f'{metric}_bucket{{stage="{name}",le="{bound}"}} {cumulative}')
+                lines.append(f'{metric}_sum{{stage="{name}"}} {stats["total_seconds"]:.6f}')
+                lines.append(f'{metric}_count{{stage="{name}"}} {stats["count"]}')
+            lines.append(f"# TYPE {prefix}_stage_errors_total counter")
+            for name, stats in spans:
+                lines.append(f'{prefix}_stage_errors_total{{stage="{name}"}} {stats["errors"]}')
+        for collector, values in sorted(snapshot["collectors"].items()):
+            for name, value in sorted(values.items()):
+                lines += [f"# TYPE {prefix}_{collector}_{name} gauge", f"{prefix}_{collector}_{name} {value}"]
+        return "\n".join(lines) + "\n"
+
+
+_metrics = Metrics()
+
+def get_metrics():
+    return _metrics
+
+def incr(name, value=1):
+    _metrics.incr(name, value)
+
+def timed(name):
+    """
+    Decorator timing every call of a function as a span of the stage name.
+    """
+    def decorate(fn):
+        @functools.wraps(fn)
+        def wrapper(*args, **kwargs):
+            if not _metrics.enabled:
+                return fn(*args, **kwargs)
+            with _Span(_metrics, name):
+                return fn(*args, **kwargs)
+        return wrapper
+    return decorate
+
+def metrics_enabled():
+    # For callers that must do extra work (e.g. count tokens) to feed a counter
+    return _metrics.enabled
+
+
+class _MetricsHandler(BaseHTTPRequestHandler):
+    def log_message(self, *args):
+        pass
+
+    def do_GET(self):
+        if self.path.split("?")[0] not in ("/metrics", "/"):
+            self.send_error(404)
+            return
+        data = _metrics.render_prometheus().encode("utf-8")
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain; version=0.0.4")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+def start_metrics_server(port=METRICS_PORT, host="0.0.0.0"):
+    """
+    Serves the metrics on http://host:port/metrics from a daemon thread, when metrics are
+    enabled and port is set.
+
+    Returns:
+        ThreadingHTTPServer or None.
+    """
+    if not (_metrics.enabled and port):
+        return None
+    try:
+        server = ThreadingHTTPServer((host, port), _MetricsHandler)
+    except OSError as e:
+        print(f"Error starting the metrics endpoint on port {port}: {str(e)}")
+        return None
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, name="metrics", daemon=True).start()
+    print(f"Metrics served on http://{host}:{port}/metrics")
+    return server
@@ -0,0 +1,110 @@
+#################################################################
+####---------Shared embedding models and API clients----------####
+#################################################################
+# Models and clients are created lazily on first use and then reused by every
+# Gradio request. Reusing an OpenAI/AzureOpenAI client keeps its HTTP connection
+# pool (and TLS sessions) alive between calls.
+import multiprocessing
+import os
+import threading
+from openai import AzureOpenAI, OpenAI
+
+_registry = {}
+_registry_lock = threading.Lock()
+_key_locks = {}
+# Embedding requests are retried by embeddings._create_embeddings_with_retry, which counts
+# and backs off on every retry, so the SDK's own retries are turned off for those clients
+EMBEDDING_CLIENT_RETRIES = 0
+# Modules the fork server imports once, so worker processes start with them loaded
+WORKER_PRELOAD = ["hdf5_file_constructor", "embedding_pool"]
+
+
+def get_or_create(key, factory):
+    """
+    Returns the registered object for key, calling factory() once to create it.
+    Concurrent callers asking for the same key wait for the first one to finish.
+    """
+    value = _registry.get(key)
+    if value is not None:
+        return value
+
+    with _registry_lock:
+        key_lock = _key_locks.setdefault(key, threading.Lock())
+    with key_lock:
+        value = _registry.get(key)
+        if value is None:
+            value = factory()
+            _registry[key] = value
+    return value
+
+def discard(key):
+    # Drops one registered object, e.g. a worker pool that broke, so it is created again
+    with _registry_lock:
+        _registry.pop(key, None)
+
+def get_process_context():
+    """
+    Returns the multiprocessing context of the worker pools (PDF extraction, local
+    embedding): forkserver, or spawn where it is unavailable. Forking the threaded Gradio
+    server (or a process already running torch threads) can deadlock the workers.
+    """
+    def create():
+        method = "forkserver" if "forkserver" in multiprocessing.get_all_start_methods() else "spawn"
+        context = multiprocessing.get_context(method)
+        if method == "forkserver":
+            # The default preloads __main__, i.e. the whole Gradio app, into the fork server
+            context.set_forkserver_preload(WORKER_PRELOAD)
+        return context
+    return get_or_create(("process_context",), create)
+
+def clear_registry():
+    # Drops every cached model and client, e.g. after the API keys changed
+    with _registry_lock:
+        _registry.clear()
+        _key_locks.clear()
+
+
+def get_sentence_transformer(model_name='sentence-transformers/all-MiniLM-L6-v2'):
+    def load():
+        from sentence_transformers import SentenceTransformer
+        print(f"Loading {model_name}")
+        return SentenceTransformer(model_name)
+    return get_or_create(("sentence_transformer", model_name), load)
+
+def get_azure_embedding_client():
+    endpoint = os.environ.get("AZURE_EMB_ENDPOINT")
+    api_key = os.environ.get("AZURE_EMB_API_KEY")
+    api_version = os.environ.get('AZURE_VERSION')
+
+    def create():
+        client = AzureOpenAI(azure_endpoint=endpoint, api_key=api_key, api_version=api_version,
+                             max_retries=EMBEDDING_CLIENT_RETRIES)
+        print("AZURE API Key Loaded Successfully")
+        return client
+    return get_or_create(("azure_embedding", endpoint, api_key, api_version), create)
+
+def get_azure_chat_client():
+    endpoint = os.environ.get("AZURE_OPENAI_ENDPOINT")
+    api_key = os.environ.get("AZURE_OPENAI_KEY")
+    api_version = os.environ.get("AZURE_VERSION")
+    return get_or_create(("azure", endpoint, api_key, api_version),
+                         lambda: AzureOpenAI(azure_endpoint=endpoint, api_key=api_key, api_version=api_version))
+
+def get_openai_client(max_retries=None):
+    # max_retries=None keeps the SDK default (chat completions)
+    api_key = os.environ.get("OPENAI_API_KEY")
+
+    def create():
+        if max_retries is None:
+            client = OpenAI(api_key=api_key)
+        else:
+            client = OpenAI(api_key=api_key, max_retries=max_retries)
+        print("OpenAI API Key Loaded Successfully")
+        return client
+    return get_or_create(("openai", api_key, max_retries), create)
+
+def get_embedding_client(llm_choice):
+    # Azure hosts the ada deployment when the Azure LLM is selected, OpenAI otherwise
+    if llm_choice == "AzureGPT":
+        return get_azure_embedding_client()
+    return get_openai_client(max_retries=EMBEDDING_CLIENT_RETRIES)
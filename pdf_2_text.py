@@ -1,6 +1,9 @@
 import PyPDF2
 import fitz  
 import os
+from metrics import timed
+
+@timed("pdf_to_text")
 def pdf_to_text(pdf_path):
     
 
@@ -20,6 +23,7 @@ def pdf_to_text(pdf_path):
 
     return text
 
+@timed("pdf_to_text")
 def extract_text_from_pdf(pdf_path,directory):
     os.chdir(directory)
     try:
@@ -42,6 +46,7 @@ def extract_text_from_pdf(pdf_path,directory):
         print(f"Error: {e}")
         return None
 
+@timed("pdf_to_text")
 def read_pdf(file_path,directory):
     os.chdir(directory)
     pdf_text = ""
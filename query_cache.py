@@ -0,0 +1,140 @@
+#################################################################
+####---------LRU cache of query embeddings---------------------####
+#################################################################
+import hashlib
+import os
+import threading
+import time
+from collections import OrderedDict
+import h5py
+
+from vector_index import SparseVector, to_float32_vector
+
+QUERY_CACHE_SIZE = int(os.environ.get("QUERY_CACHE_SIZE", 1024))
+QUERY_CACHE_TTL = float(os.environ.get("QUERY_CACHE_TTL", 24 * 3600))  # seconds, 0 disables expiry
+QUERY_CACHE_PATH = os.environ.get("QUERY_CACHE_PATH", "")  # HDF5 file, empty keeps the cache in memory
+
+
+class QueryEmbeddingCache:
+    """
+    Bounded LRU cache of query embeddings keyed on (model, normalized query), with a TTL
+    and hit/miss counters. When path is given, entries are written through to an HDF5
+    file and reloaded on start-up, so repeated questions survive restarts.
+    """
+
+    def __init__(self, max_entries=QUERY_CACHE_SIZE, ttl=QUERY_CACHE_TTL, path=QUERY_CACHE_PATH or None):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.path = path
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._entries = OrderedDict()  # key -> (created_at, embedding)
+        self._lock = threading.Lock()
+        if self.path and os.path.exists(self.path):
+            self._load()
+
+    @staticmethod
+    def make_key(model, query):
+        return hashlib.sha256(f"{model}\x00{query}".encode("utf-8")).hexdigest()
+
+    def _expired(self, created_at, now):
+        return self.ttl > 0 and now - created_at > self.ttl
+
+    def get(self, model, query):
+        """
+        Returns the cached embedding, or None on a miss or an expired entry.
+        """
+        key = self.make_key(model, query)
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and not self._expired(entry[0], time.time()):
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return entry[1]
+            if entry is not None:
+                self._remove(key)
+            self.misses += 1
+            return None
+
+    def put(self, model, query, embedding):
+        # Embeddings are stored as float32 arrays (or SparseVectors) whatever the model returned
+        if not isinstance(embedding, SparseVector):
+            embedding = to_float32_vector(embedding)
+        key = self.make_key(model, query)
+        created_at = time.time()
+        with self._lock:
+            self._entries[key] = (created_at, embedding)
+            self._entries.move_to_end(key)
+            if self.path:
+                self._write(key, model, query, created_at, embedding)
+            while len(self._entries) > self.max_entries:
+                self._remove(next(iter(self._entries)))
+                self.evictions += 1
+        return embedding
+
+    def get_or_compute(self, model, query, compute):
+        """
+        Returns the cached embedding for (model, query), calling compute() on a miss.
+        """
+        embedding = self.get(model, query)
+        if embedding is None:
+            embedding = self.put(model, query, compute())
+        return embedding
+
+    def stats(self):
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "entries": len(self._entries),
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "hit_rate": self.hits / lookups if lookups else 0.0,
+            }
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            if self.path and os.path.exists(self.path):
+                os.remove(self.path)
+
+    def _remove(self, key):
+        self._entries.pop(key, None)
+        if self.path and os.path.exists(self.path):
+            with h5py.File(self.path, "a") as hdf5_file:
+                if key in hdf5_file:
+                    del hdf5_file[key]
+
+    def _write(self, key, model, query, created_at, embedding):
+        with h5py.File(self.path, "a") as hdf5_file:
+            if key in hdf5_file:
+                del hdf5_file[key]
+            group = hdf5_file.create_group(key)
+            group.attrs["model"] = model
+            group.attrs["query"] = query
+            group.attrs["created_at"] = created_at
+            if isinstance(embedding, SparseVector):
+                group.create_dataset("indices", data=embedding.indices)
+                group.create_dataset("data", data=embedding.data)
+                group.attrs["dimension"] = embedding.dimension
+            else:
+                group.create_dataset("vector", data=embedding)
+
+    def _load(self):
+        now = time.time()
+        entries = []
+        with h5py.File(self.path, "r") as hdf5_file:
+            for key, group in hdf5_file.items():
+                created_at = float(group.attrs["created_at"])
+                if self._expired(created_at, now):
+                    continue
+                if "vector" in group:
+                    embedding = group["vector"][()]
+                else:
+                    embedding = SparseVector(group["indices"][()], group["data"][()], group.attrs["dimension"])
+                entries.append((created_at, key, embedding))
+        # Oldest first, so the most recent entries are the last to be evicted
+        for created_at, key, embedding in sorted(entries, key=lambda e: e[0])[-self.max_entries:]:
+            self._entries[key] = (created_at, embedding)
+        print(f"Loaded {len(self._entries)} cached query embeddings from {self.path}")
@@ -0,0 +1,174 @@
+#################################################################
+####---------Headless async query service----------------------####
+#################################################################
+# Serves search and cited answers without the Gradio UI. Queries arriving within a few
+# milliseconds of each other are collected into one micro-batch: their embeddings are
+# computed in a single forward pass (local models) or a single API request (ada), and
+# an exact dense index scores them all with one matrix-matrix product. LLM completions
+# then run concurrently in their own threads, so slow answers do not hold up searches.
+#
+#   python query_service.py --model all-MiniLM-L6-v2 --llm gpt-4o-mini \
+#       --chunk-size 256 --overlap 50 "What is GDC 55?" "What does 10 CFR 50.46 require?"
+import argparse
+import asyncio
+import functools
+import os
+from concurrent.futures import ThreadPoolExecutor
+
+from embeddings import (search_docs_batch, get_query_embedding, embedding_model_key, load_search_corpus, RETRIEVAL_MODE,
+                        ANSWER_TOP_K)
+from azure_gpt import get_cited_RAG_completion
+from hdf5_file_constructor import EMBEDDINGS_HDF5
+from vector_store import register_corpus, get_corpus
+from metrics import start_metrics_server
+
+QUERY_BATCH_WINDOW_MS = float(os.environ.get("QUERY_BATCH_WINDOW_MS", 5))
+QUERY_MAX_BATCH = int(os.environ.get("QUERY_MAX_BATCH", 64))
+QUERY_MAX_WORKERS = int(os.environ.get("QUERY_MAX_WORKERS", 8))  # threads running search batches
+# Threads running LLM completions, kept apart so slow answers never delay the next search batch
+QUERY_COMPLETION_WORKERS = int(os.environ.get("QUERY_COMPLETION_WORKERS", 16))
+
+
+class QueryService:
+    """
+    Async search and answer API over a loaded corpus (a CorpusHandle or a ChunkTable).
+
+    Args:
+        corpus: Corpus returned by register_corpus (or load_search_corpus).
+        model_name (str): Embedding model the corpus was embedded with.
+        llm_choice (str): LLM (and Azure/OpenAI endpoint) used for answers and ada queries.
+        top_n (int): Minimum similarity in percent, as the top_n slider of the UI.
+        top_k (int): Chunks returned per query when search or answer is not given one.
+        batch_window_ms (float): How long the first query of a batch waits for others.
+        max_batch (int): Queries per batch; a full batch is flushed at once.
+        max_workers (int): Threads running search batches.
+        completion_workers (int): Threads running LLM completions, i.e. answers generated at once.
+        context_tokens (int): Context window of the LLM (see get_cited_RAG_completion).
+    """
+
+    def __init__(self, corpus, model_name, llm_choice, top_n=20, top_k=ANSWER_TOP_K, mode=RETRIEVAL_MODE,
+                 batch_window_ms=QUERY_BATCH_WINDOW_MS, max_batch=QUERY_MAX_BATCH,
+                 max_workers=QUERY_MAX_WORKERS, completion_workers=QUERY_COMPLETION_WORKERS, context_tokens=None):
+        self.corpus = corpus
+        self.model_name = model_name
+        self.llm_choice = llm_choice
+        self.top_n = top_n
+        self.top_k = top_k
+        self.mode = mode
+        self.batch_window = batch_window_ms / 1000
+        self.max_batch = max_batch
+        self.context_tokens = context_tokens
+        self._executor = ThreadPoolExecutor(max_workers=max_workers)
+        self._completion_executor = ThreadPoolExecutor(max_workers=completion_workers)
+        # (top_k) -> list of (query, future) waiting for the next flush
+        self._pending = {}
+        self._flush_handles = {}
+        # Running batches: the event loop only keeps weak references to tasks
+        self._tasks = set()
+
+    async def search(self, query, top_k=None):
+        """
+        Returns the search results of the query (a DataFrame, as search_docs), computed in
+        a micro-batch with the queries submitted at about the same time.
+        """
+        top_k = top_k or self.top_k
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        batch = self._pending.setdefault(top_k, [])
+        batch.append((query, future))
+        if len(batch) >= self.max_batch:
+            self._flush(top_k)
+        elif top_k not in self._flush_handles:
+            self._flush_handles[top_k] = loop.call_later(self.batch_window, self._flush, top_k)
+        return await future
+
+    def _flush(self, top_k):
+        handle = self._flush_handles.pop(top_k, None)
+        if handle is not None:
+            handle.cancel()
+        batch = self._pending.pop(top_k, [])
+        if batch:
+            task = asyncio.ensure_future(self._run_batch(batch, top_k))
+            self._tasks.add(task)
+            task.add_done_callback(self._tasks.discard)
+
+    async def _run_batch(self, batch, top_k):
+        # Every future of the batch is resolved, whatever happens: callers never hang
+        queries = [query for query, _ in batch]
+        try:
+            results = await asyncio.get_running_loop().run_in_executor(
+                self._executor,
+                functools.partial(search_docs_batch, self.corpus, queries, self.model_name, self.llm_choice,
+                                  self.top_n, to_print=True, top_k=top_k, mode=self.mode))
+            if len(results) != len(batch):
+                raise RuntimeError(f"Search returned {len(results)} results for {len(batch)} queries")
+            for (_, future), result in zip(batch, results):
+                if not future.done():
+                    future.set_result(result)
+        except asyncio.CancelledError:
+            for _, future in batch:
+                future.cancel()
+            raise
+        except Exception as e:
+            for _, future in batch:
+                if not future.done():
+                    future.set_exception(e)
+
+    async def answer(self, query, temp_def=0.5, max_tokens=300, top_k=None):
+        """
+        Searches the query and returns (answer, search results).
+        """
+        results = await self.search(query, top_k)
+        loop = asyncio.get_running_loop()
+
+        def complete():
+            # The query embedding comes from the cache filled by the search batch
+            query_embedding = None
+            if self.mode != "lexical":
+                query_embedding = get_query_embedding(query, self.model_name, self.llm_choice)
+            return get_cited_RAG_completion(query, results, self.llm_choice, temp_def=temp_def, max_tokens=max_tokens,
+                                            query_embedding=query_embedding, context_tokens=self.context_tokens)
+        answer = await loop.run_in_executor(self._completion_executor, complete)
+        return answer, results
+
+    def close(self):
+        self._executor.shutdown(wait=False)
+        self._completion_executor.shutdown(wait=False)
+
+
+def load_query_service(model_name, llm_choice, chunk_size, overlap, hdf5_filename=EMBEDDINGS_HDF5, **kwargs):
+    """
+    Loads the embedding group of (model, chunk_size, overlap) that a previous set-up
+    stored in hdf5_filename and returns a QueryService over it.
+    """
+    model_key = embedding_model_key(model_name, llm_choice)
+    corpus = register_corpus(load_search_corpus(hdf5_filename, model_key, chunk_size, overlap))
+    if not len(get_corpus(corpus)):
+        raise ValueError(f"No embeddings stored for {model_key} (chunk size {chunk_size}, overlap {overlap}) "
+                         f"in {hdf5_filename}, run Set Up first")
+    return QueryService(corpus, model_name, llm_choice, **kwargs)
+
+
+async def _answer_all(service, questions, temp_def, max_tokens):
+    return await asyncio.gather(*(service.answer(q, temp_def=temp_def, max_tokens=max_tokens) for q in questions))
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Answer questions over a stored corpus without the Gradio UI.")
+    parser.add_argument("questions", nargs="+")
+    parser.add_argument("--model", default="all-MiniLM-L6-v2")
+    parser.add_argument("--llm", default="AzureGPT")
+    parser.add_argument("--chunk-size", type=int, default=256)
+    parser.add_argument("--overlap", type=int, default=50)
+    parser.add_argument("--top-n", type=int, default=20)
+    parser.add_argument("--temperature", type=float, default=0.5)
+    parser.add_argument("--max-tokens", type=int, default=300)
+    args = parser.parse_args()
+
+    start_metrics_server()
+    service = load_query_service(args.model, args.llm, args.chunk_size, args.overlap, top_n=args.top_n)
+    try:
+        answers = asyncio.run(_answer_all(service, args.questions, args.temperature, args.max_tokens))
+        for question, (answer, _) in zip(args.questions, answers):
+            print(f"Q: {question}\n{answer}\n")
+    finally:
+        service.close()
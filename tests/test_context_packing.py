@@ -0,0 +1,83 @@
+import pandas as pd
+import pytest
+
+import azure_gpt
+from azure_gpt import pack_context, PACK_TOKENIZE_BATCH
+from token_chunker import count_tokens
+
+
+def make_results(rows):
+    """
+    Search results as search_docs returns them: (chunk id, paragraph, link, page) rows, best first.
+    """
+    ids, paragraphs, links, pages = zip(*rows)
+    return pd.DataFrame({"source_paragraph": paragraphs, "pdf_link": links, "page": pages},
+                        index=pd.Index(ids))
+
+def paragraph(i, words=30):
+    return " ".join(f"p{i}w{w}" for w in range(words))
+
+def entry_tokens(rows):
+    # Tokens one packed paragraph costs: its quote and its citation line
+    (chunk_id, text, link, page) = rows[0]
+    ids = ", ".join(str(r[0]) for r in rows)
+    return count_tokens([f"> {text}\n\n" + f"- Chunk {ids}, Page {page}: [{link}]({link})\n"])[0]
+
+
+def test_chunks_of_one_paragraph_share_a_quote_and_citation():
+    results = make_results([
+        (7, paragraph(1), "a.pdf#page=2", 2),
+        (3, paragraph(2), "a.pdf#page=3", 3),
+        (9, paragraph(1), "a.pdf#page=2", 2),
+    ])
+    context, citations, packed_ids = pack_context(results)
+    assert context.count(paragraph(1)) == 1 and context.count(paragraph(2)) == 1
+    # The paragraph comes first, at the rank of its best chunk, and cites all its chunks
+    assert context.index(paragraph(1)) < context.index(paragraph(2))
+    assert citations.splitlines() == ["- Chunk 7, 9, Page 2: [a.pdf#page=2](a.pdf#page=2)",
+                                      "- Chunk 3, Page 3: [a.pdf#page=3](a.pdf#page=3)"]
+    assert packed_ids == [7, 9, 3]
+
+def test_same_text_on_two_pages_is_quoted_twice():
+    results = make_results([(1, paragraph(1), "a.pdf#page=1", 1), (2, paragraph(1), "b.pdf#page=1", 1)])
+    context, _, packed_ids = pack_context(results)
+    assert context.count(paragraph(1)) == 2 and packed_ids == [1, 2]
+
+def test_budget_keeps_best_paragraphs_in_order():
+    rows = [(i, paragraph(i), f"a.pdf#page={i}", i) for i in range(10)]
+    budget = sum(entry_tokens([row]) for row in rows[:3]) + 1
+    context, citations, packed_ids = pack_context(make_results(rows), token_budget=budget)
+    assert packed_ids == [0, 1, 2]
+    assert count_tokens([context + citations])[0] <= budget
+
+def test_best_paragraph_is_cut_to_a_small_budget():
+    rows = [(i, paragraph(i, words=400), f"a.pdf#page={i}", i) for i in range(3)]
+    context, citations, packed_ids = pack_context(make_results(rows), token_budget=60)
+    assert packed_ids == [0]
+    assert context.startswith("> p0w0 ") and context.endswith(" ...\n\n")
+    assert count_tokens([context + citations])[0] <= 60
+
+def test_no_budget_packs_everything():
+    rows = [(i, paragraph(i), f"a.pdf#page={i}", i) for i in range(50)]
+    _, _, packed_ids = pack_context(make_results(rows))
+    assert packed_ids == list(range(50))
+
+def test_only_considered_paragraphs_are_tokenized(monkeypatch):
+    counted = []
+
+    def counting(texts, *args, **kwargs):
+        counted.extend(texts)
+        return count_tokens(texts, *args, **kwargs)
+    monkeypatch.setattr(azure_gpt, "count_tokens", counting)
+
+    rows = [(i, paragraph(i), f"a.pdf#page={i}", i) for i in range(5000)]
+    budget = sum(entry_tokens([row]) for row in rows[:3])
+    _, _, packed_ids = pack_context(make_results(rows), token_budget=budget)
+    assert packed_ids == [0, 1, 2]
+    assert len(counted) <= PACK_TOKENIZE_BATCH
+
+@pytest.mark.parametrize("budget", [0, 1])
+def test_tiny_budget_still_has_context(budget):
+    rows = [(i, paragraph(i), f"a.pdf#page={i}", i) for i in range(3)]
+    context, _, packed_ids = pack_context(make_results(rows), token_budget=budget)
+    assert packed_ids == [0] and context.startswith("> p0w0")
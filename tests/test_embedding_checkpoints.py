@@ -0,0 +1,112 @@
+import zlib
+import numpy as np
+import pytest
+
+import embeddings
+from chunk_table import ChunkTable
+from embeddings import embed_and_store
+from hdf5_file_constructor import load_embeddings_from_hdf5, get_embedding_progress, get_embedded_document_hashes
+
+MODEL, CHUNK_SIZE, OVERLAP = "test-model", 8, 2
+DOC_HASHES = {"a.pdf": "hash-a", "b.pdf": "hash-b"}
+
+
+def make_corpus():
+    """
+    Two documents of several paragraphs, each paragraph cut into a few chunks.
+    """
+    table = ChunkTable()
+    for filename, n_paragraphs in (("a.pdf", 5), ("b.pdf", 4)):
+        doc_id = table.add_document(filename, f"file:///{filename}")
+        for p in range(n_paragraphs):
+            text = " ".join(f"{filename}-p{p}-w{w}" for w in range(6))
+            paragraph_id = table.add_paragraph(doc_id, p + 1, text)
+            for start in range(0, len(text), 40):
+                table.add_chunk(paragraph_id, start, min(start + 40, len(text)))
+    return table
+
+def text_vector(text):
+    return np.random.default_rng(zlib.crc32(text.encode("utf-8"))).standard_normal(4).astype(np.float32)
+
+
+class FakeEmbedder:
+    """
+    Stands in for embed_text: deterministic vectors, failing on call number fail_on.
+    """
+
+    def __init__(self, fail_on=None):
+        self.fail_on = fail_on
+        self.calls = 0
+        self.embedded = 0
+
+    def __call__(self, table, model_name, llm_choice):
+        self.calls += 1
+        if self.calls == self.fail_on:
+            raise RuntimeError("simulated rate limit")
+        table.embeddings = [text_vector(t) for t in table.texts()]
+        self.embedded += len(table)
+        return table
+
+
+def run(monkeypatch, path, embedder, doc_hashes=DOC_HASHES, checkpoint_chunks=4):
+    """
+    Embeds the pending documents (stored hash missing or different), as setup_process does.
+    """
+    monkeypatch.setattr(embeddings, "embed_text", embedder)
+    embedded = get_embedded_document_hashes(path, MODEL, CHUNK_SIZE, OVERLAP)
+    pending = {f: h for f, h in doc_hashes.items() if embedded.get(f) != h}
+    corpus = make_corpus()
+    table = corpus.select(np.flatnonzero(np.isin(corpus.chunk_filenames(), list(pending))))
+    return embed_and_store(table, MODEL, "AzureGPT", path, CHUNK_SIZE, OVERLAP, pending,
+                           checkpoint_chunks=checkpoint_chunks)
+
+def stored(path):
+    chunks = load_embeddings_from_hdf5(path, MODEL, CHUNK_SIZE, OVERLAP)
+    return chunks.texts(), list(chunks["filename"]), np.asarray(chunks["embedded"])
+
+
+# a.pdf is complete before the failure on the fifth checkpoint, partial before the others
+@pytest.mark.parametrize("fail_on", [2, 3, 5])
+def test_interrupted_run_resumes_aligned(monkeypatch, tmp_path, fail_on):
+    corpus = make_corpus()
+    reference = str(tmp_path / "reference.hdf5")
+    assert run(monkeypatch, reference, FakeEmbedder())
+
+    path = str(tmp_path / "resumed.hdf5")
+    first = FakeEmbedder(fail_on=fail_on)
+    assert not run(monkeypatch, path, first)
+    partial_docs, live = get_embedding_progress(path, MODEL, CHUNK_SIZE, OVERLAP)
+    assert sum(live.values()) == first.embedded
+
+    second = FakeEmbedder()
+    assert run(monkeypatch, path, second)
+    # Only the chunks missing from the checkpoints are embedded again
+    assert first.embedded + second.embedded == len(corpus)
+
+    texts, filenames, vectors = stored(path)
+    assert len(texts) == len(filenames) == len(vectors) == len(corpus)
+    assert texts == corpus.texts()
+    np.testing.assert_array_equal(vectors, np.stack([text_vector(t) for t in texts]))
+    ref_texts, ref_filenames, ref_vectors = stored(reference)
+    assert (texts, filenames) == (ref_texts, ref_filenames)
+    np.testing.assert_array_equal(vectors, ref_vectors)
+    assert get_embedding_progress(path, MODEL, CHUNK_SIZE, OVERLAP)[0] == {}
+    assert get_embedded_document_hashes(path, MODEL, CHUNK_SIZE, OVERLAP) == DOC_HASHES
+
+
+def test_modified_document_restarts_from_its_start(monkeypatch, tmp_path):
+    path = str(tmp_path / "store.hdf5")
+    # The first checkpoint covers part of a.pdf only
+    assert not run(monkeypatch, path, FakeEmbedder(fail_on=2), checkpoint_chunks=3)
+    partial_docs, _ = get_embedding_progress(path, MODEL, CHUNK_SIZE, OVERLAP)
+    assert list(partial_docs) == ["a.pdf"]
+
+    changed = {"a.pdf": "hash-a2", "b.pdf": "hash-b"}
+    embedder = FakeEmbedder()
+    assert run(monkeypatch, path, embedder, doc_hashes=changed, checkpoint_chunks=3)
+    corpus = make_corpus()
+    assert embedder.embedded == len(corpus)
+    texts, _, vectors = stored(path)
+    assert texts == corpus.texts()
+    np.testing.assert_array_equal(vectors, np.stack([text_vector(t) for t in texts]))
+    assert get_embedded_document_hashes(path, MODEL, CHUNK_SIZE, OVERLAP) == changed
@@ -0,0 +1,126 @@
+import numpy as np
+import pytest
+
+from chunk_table import ChunkTable
+from hdf5_file_constructor import (append_embeddings_to_hdf5, tombstone_embeddings_in_hdf5, restore_embeddings_in_hdf5,
+                                   load_embeddings_from_hdf5, get_embedded_document_hashes, update_pdfs_in_hdf5)
+
+MODEL, CHUNK_SIZE, OVERLAP = "test-model", 8, 2
+DIMENSION = 4
+
+
+def make_chunks(filename, n_chunks, seed):
+    """
+    One document of n_chunks chunks (one paragraph each) with random embeddings.
+    """
+    table = ChunkTable()
+    doc_id = table.add_document(filename, f"file:///{filename}")
+    for i in range(n_chunks):
+        text = f"{filename} paragraph {i}"
+        table.add_chunk(table.add_paragraph(doc_id, 1, text), 0, len(text))
+    table.embeddings = np.random.default_rng(seed).standard_normal((n_chunks, DIMENSION)).astype(np.float32)
+    return table
+
+def store(path, filename, n_chunks, seed, content_hash):
+    assert append_embeddings_to_hdf5(make_chunks(filename, n_chunks, seed), path, MODEL, CHUNK_SIZE, OVERLAP,
+                                     {filename: content_hash})
+
+def live_files(path):
+    chunks = load_embeddings_from_hdf5(path, MODEL, CHUNK_SIZE, OVERLAP)
+    return sorted(chunks["filename"]), chunks
+
+def stored_rows(path):
+    import h5py
+    with h5py.File(path, "r") as f:
+        return f[f"{MODEL}/tokens{CHUNK_SIZE}_overlap{OVERLAP}"]["deleted"].shape[0]
+
+
+@pytest.fixture
+def store_path(tmp_path):
+    return str(tmp_path / "embeddings.hdf5")
+
+
+def test_remove_and_restore_keeps_rows(store_path):
+    store(store_path, "a.pdf", 3, 0, "hash-a")
+    store(store_path, "b.pdf", 4, 1, "hash-b")
+    _, before = live_files(store_path)
+
+    assert tombstone_embeddings_in_hdf5(store_path, MODEL, CHUNK_SIZE, OVERLAP, ["a.pdf"]) == 3
+    files, _ = live_files(store_path)
+    assert files == ["b.pdf"] * 4
+    assert get_embedded_document_hashes(store_path, MODEL, CHUNK_SIZE, OVERLAP) == {"b.pdf": "hash-b"}
+    # 3 of 7 rows tombstoned: no compaction
+    assert stored_rows(store_path) == 7
+
+    # Another content under the same name is not restored
+    assert restore_embeddings_in_hdf5(store_path, MODEL, CHUNK_SIZE, OVERLAP, {"a.pdf": "other"}) == []
+    assert restore_embeddings_in_hdf5(store_path, MODEL, CHUNK_SIZE, OVERLAP, {"a.pdf": "hash-a"}) == ["a.pdf"]
+    files, after = live_files(store_path)
+    assert files == ["a.pdf"] * 3 + ["b.pdf"] * 4
+    np.testing.assert_array_equal(after["embedded"], before["embedded"])
+    assert get_embedded_document_hashes(store_path, MODEL, CHUNK_SIZE, OVERLAP) == {"a.pdf": "hash-a", "b.pdf": "hash-b"}
+    # Restored once: a second restore finds nothing
+    assert restore_embeddings_in_hdf5(store_path, MODEL, CHUNK_SIZE, OVERLAP, {"a.pdf": "hash-a"}) == []
+
+
+def test_restore_picks_the_matching_version(store_path):
+    store(store_path, "a.pdf", 2, 0, "v1")
+    store(store_path, "b.pdf", 6, 1, "hash-b")
+    _, original = live_files(store_path)
+    # a.pdf modified, then reverted to v1
+    tombstone_embeddings_in_hdf5(store_path, MODEL, CHUNK_SIZE, OVERLAP, ["a.pdf"])
+    store(store_path, "a.pdf", 3, 2, "v2")
+    tombstone_embeddings_in_hdf5(store_path, MODEL, CHUNK_SIZE, OVERLAP, ["a.pdf"])
+
+    assert restore_embeddings_in_hdf5(store_path, MODEL, CHUNK_SIZE, OVERLAP, {"a.pdf": "v1"}) == ["a.pdf"]
+    files, chunks = live_files(store_path)
+    assert files == ["a.pdf"] * 2 + ["b.pdf"] * 6
+    np.testing.assert_array_equal(chunks["embedded"], original["embedded"])
+
+
+def test_compaction_drops_tombstoned_rows(store_path):
+    store(store_path, "a.pdf", 5, 0, "hash-a")
+    store(store_path, "b.pdf", 3, 1, "hash-b")
+    _, before = live_files(store_path)
+
+    # 5 of 8 rows tombstoned: the group is rewritten with the live rows only
+    assert tombstone_embeddings_in_hdf5(store_path, MODEL, CHUNK_SIZE, OVERLAP, ["a.pdf"]) == 5
+    assert stored_rows(store_path) == 3
+    files, after = live_files(store_path)
+    assert files == ["b.pdf"] * 3
+    np.testing.assert_array_equal(after["embedded"], before["embedded"][5:])
+    np.testing.assert_array_equal(after.store_rows, np.arange(3))
+    assert after.texts() == before.texts()[5:]
+    assert get_embedded_document_hashes(store_path, MODEL, CHUNK_SIZE, OVERLAP) == {"b.pdf": "hash-b"}
+
+    # Compacted rows cannot be restored, the PDF is embedded again
+    assert restore_embeddings_in_hdf5(store_path, MODEL, CHUNK_SIZE, OVERLAP, {"a.pdf": "hash-a"}) == []
+    store(store_path, "a.pdf", 5, 0, "hash-a")
+    files, _ = live_files(store_path)
+    assert files == ["a.pdf"] * 5 + ["b.pdf"] * 3
+
+
+def _write_pdf(path, text):
+    import fitz
+    doc = fitz.open()
+    doc.new_page().insert_text((72, 72), text)
+    doc.save(path)
+    doc.close()
+    return str(path)
+
+def test_partial_upload_keeps_other_pdfs(tmp_path):
+    pdf_store = str(tmp_path / "pdfs.hdf5")
+    a = _write_pdf(tmp_path / "a.pdf", "reactor coolant system")
+    b = _write_pdf(tmp_path / "b.pdf", "containment isolation valve")
+    update_pdfs_in_hdf5([a, b], pdf_store, max_workers=1)
+
+    changes = update_pdfs_in_hdf5([a], pdf_store, max_workers=1)
+    assert changes["removed"] == [] and changes["kept"] == ["b.pdf"]
+    assert set(changes["hashes"]) == {"a.pdf", "b.pdf"}
+
+    changes = update_pdfs_in_hdf5([a], pdf_store, max_workers=1, replace=True)
+    assert changes["removed"] == ["b.pdf"] and set(changes["hashes"]) == {"a.pdf"}
+
+    # Uploaded again unchanged: restored from the tombstoned text, not extracted again
+    changes = update_pdfs_in_hdf5([a, b], pdf_store, max_workers=1)
+    assert changes["added"] == ["b.pdf"] and changes["unchanged"] == ["a.pdf"]
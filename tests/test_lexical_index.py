@@ -0,0 +1,89 @@
+import math
+import numpy as np
+import pytest
+
+import embeddings
+from chunk_table import ChunkTable
+from lexical_index import BM25Index, lexical_terms, lexical_term_csr, reciprocal_rank_fusion
+
+TEXTS = [
+    "Containment isolation valves shall meet GDC 55 for lines penetrating containment.",
+    "GDC 17 covers electric power systems; see also 55 gallons of diesel fuel.",
+    "The ECCS acceptance criteria of 10 CFR 50.46 limit peak cladding temperature.",
+    "Section 3.1-2 lists the design basis accidents considered in the analysis.",
+    "Emergency core cooling must keep cladding temperature below 2200 F per 10 CFR 50.46.",
+    "Reactor coolant pressure boundary design, GDC 14 and GDC 15.",
+]
+
+
+def reference_bm25(texts, query, k1=1.2, b=0.75):
+    """
+    Okapi BM25 computed term by term from the token lists, without any index.
+    """
+    docs = [lexical_terms(t) for t in texts]
+    avg_length = sum(len(d) for d in docs) / len(docs)
+    scores = np.zeros(len(docs))
+    for term in set(lexical_terms(query)):
+        doc_freq = sum(term in d for d in docs)
+        idf = math.log1p((len(docs) - doc_freq + 0.5) / (doc_freq + 0.5))
+        for i, doc in enumerate(docs):
+            count = doc.count(term)
+            if count:
+                scores[i] += idf * count * (k1 + 1) / (count + k1 * (1 - b + b * len(doc) / avg_length))
+    return scores
+
+
+@pytest.mark.parametrize("query", ["GDC 55", "10 CFR 50.46 cladding temperature", "section 3.1-2", "unrelated words"])
+def test_bm25_matches_reference_scores(query):
+    index = BM25Index(*lexical_term_csr(TEXTS))
+    expected = reference_bm25(TEXTS, query)
+    ids, scores = index.search(query)
+    np.testing.assert_array_equal(np.sort(ids), np.flatnonzero(expected))
+    np.testing.assert_allclose(scores, expected[ids], rtol=1e-5)
+    assert np.all(np.diff(scores) <= 0)
+
+def test_bm25_ranks_exact_references_first():
+    index = BM25Index(*lexical_term_csr(TEXTS))
+    # The bigram "gdc 55" outranks a chunk with "gdc" and "55" apart
+    assert index.search("GDC 55", top_k=1)[0].tolist() == [0]
+    assert index.search("50.46", top_k=2)[0].tolist() in ([2, 4], [4, 2])
+    assert index.search("3.1-2", top_k=1)[0].tolist() == [3]
+
+def test_reciprocal_rank_fusion():
+    ids, scores = reciprocal_rank_fusion([[3, 1, 2], [1, 4]], k=60)
+    # 1 is in both lists; then 3 (first of one list), 4 (second) and 2 (third)
+    assert ids.tolist() == [1, 3, 4, 2]
+    np.testing.assert_allclose(scores, [1 / 62 + 1 / 61, 1 / 61, 1 / 62, 1 / 63], rtol=1e-6)
+    assert reciprocal_rank_fusion([[3, 1, 2], [1, 4]], k=60, top_k=2)[0].tolist() == [1, 3]
+
+
+def test_hybrid_search_fuses_dense_and_bm25(monkeypatch):
+    """
+    search_docs in hybrid mode returns the rank fusion of the dense and BM25 hits.
+    """
+    table = ChunkTable()
+    doc_id = table.add_document("a.pdf", "file:///a.pdf")
+    for text in TEXTS:
+        table.add_chunk(table.add_paragraph(doc_id, 1, text), 0, len(text))
+    rng = np.random.default_rng(0)
+    table.embeddings = list(rng.standard_normal((len(TEXTS), 8)).astype(np.float32))
+    table.terms = lexical_term_csr(table.texts())
+    query_embedding = table.embeddings[5] + 0.1
+    monkeypatch.setattr(embeddings, "get_query_embedding", lambda *args: query_embedding)
+
+    result = embeddings.search_docs(table, "GDC 55", "all-MiniLM-L6-v2", "AzureGPT", top_n=-100,
+                                    to_print=False, top_k=4, mode="hybrid")
+    matrix = np.stack(table.embeddings)
+    cosines = matrix @ query_embedding / (np.linalg.norm(matrix, axis=1) * np.linalg.norm(query_embedding))
+    dense_ranking = np.argsort(-cosines)[:4]
+    lexical_ranking = BM25Index(*table.terms).search("GDC 55", embeddings.LEXICAL_CANDIDATES)[0]
+    expected_ids, expected_scores = reciprocal_rank_fusion([dense_ranking, lexical_ranking], k=embeddings.RRF_K,
+                                                           top_k=4)
+    assert result.index.tolist() == expected_ids.tolist()
+    np.testing.assert_allclose(result["fused_scores"], expected_scores, rtol=1e-6)
+    # Dense similarities are kept for dense hits, NaN for lexical-only ones
+    for chunk_id, similarity in zip(result.index, result["similarities"]):
+        if chunk_id in dense_ranking:
+            assert similarity == pytest.approx(cosines[chunk_id], abs=1e-5)
+        else:
+            assert np.isnan(similarity)
@@ -0,0 +1,104 @@
+import asyncio
+import threading
+
+import query_service
+from query_service import QueryService
+
+
+class FakeSearch:
+    """
+    Stands in for search_docs_batch: records each batch and returns one result per query.
+    """
+
+    def __init__(self, fail=None, drop=False):
+        self.batches = []
+        self.fail = fail
+        self.drop = drop
+        self.lock = threading.Lock()
+
+    def __call__(self, corpus, queries, *args, top_k=None, **kwargs):
+        with self.lock:
+            self.batches.append((list(queries), top_k))
+        if self.fail is not None:
+            raise self.fail
+        results = [f"results of {q} ({top_k})" for q in queries]
+        return results[:-1] if self.drop else results
+
+def make_service(monkeypatch, search, **kwargs):
+    monkeypatch.setattr(query_service, "search_docs_batch", search)
+    kwargs.setdefault("batch_window_ms", 20)
+    return QueryService(corpus=None, model_name="all-MiniLM-L6-v2", llm_choice="AzureGPT", mode="lexical", **kwargs)
+
+def run(service, coroutine):
+    try:
+        return asyncio.run(coroutine)
+    finally:
+        service.close()
+
+async def search_all(service, queries, top_k=None):
+    return await asyncio.gather(*(service.search(q, top_k) for q in queries), return_exceptions=True)
+
+
+def test_concurrent_searches_share_one_batch(monkeypatch):
+    search = FakeSearch()
+    service = make_service(monkeypatch, search, top_k=7)
+    queries = [f"q{i}" for i in range(5)]
+    results = run(service, search_all(service, queries))
+    assert results == [f"results of q{i} (7)" for i in range(5)]
+    assert search.batches == [(queries, 7)]
+
+def test_batches_are_split_by_top_k(monkeypatch):
+    search = FakeSearch()
+    service = make_service(monkeypatch, search)
+
+    async def mixed():
+        return await asyncio.gather(service.search("a", 5), service.search("b", 10), service.search("c", 5))
+    assert run(service, mixed()) == ["results of a (5)", "results of b (10)", "results of c (5)"]
+    assert sorted(search.batches) == [(["a", "c"], 5), (["b"], 10)]
+
+def test_full_batch_is_flushed_at_once(monkeypatch):
+    search = FakeSearch()
+    # The window is far longer than the test: only a full batch can be flushed
+    service = make_service(monkeypatch, search, batch_window_ms=60_000, max_batch=3)
+
+    async def full_batch():
+        return await asyncio.wait_for(search_all(service, ["a", "b", "c"]), timeout=5)
+    assert len(run(service, full_batch())) == 3
+    assert search.batches == [(["a", "b", "c"], service.top_k)]
+
+def test_search_error_reaches_every_caller(monkeypatch):
+    error = ValueError("index not loaded")
+    service = make_service(monkeypatch, FakeSearch(fail=error))
+    results = run(service, search_all(service, ["a", "b", "c"]))
+    assert all(result is error for result in results)
+
+def test_result_count_mismatch_raises(monkeypatch):
+    service = make_service(monkeypatch, FakeSearch(drop=True))
+    results = run(service, search_all(service, ["a", "b"]))
+    assert all(isinstance(result, RuntimeError) for result in results)
+
+def test_answer_uses_batched_search_results(monkeypatch):
+    search = FakeSearch()
+    service = make_service(monkeypatch, search)
+    monkeypatch.setattr(query_service, "get_cited_RAG_completion",
+                        lambda query, results, *args, **kwargs: f"answer to {query} from {results}")
+
+    async def answers():
+        return await asyncio.gather(service.answer("a", top_k=3), service.answer("b", top_k=3))
+    assert run(service, answers()) == [("answer to a from results of a (3)", "results of a (3)"),
+                                       ("answer to b from results of b (3)", "results of b (3)")]
+    assert search.batches == [(["a", "b"], 3)]
+
+def test_completion_error_reaches_its_caller(monkeypatch):
+    service = make_service(monkeypatch, FakeSearch())
+
+    def completion(query, *args, **kwargs):
+        if query == "bad":
+            raise ConnectionError("LLM unavailable")
+        return "ok"
+    monkeypatch.setattr(query_service, "get_cited_RAG_completion", completion)
+
+    async def answers():
+        return await asyncio.gather(service.answer("good"), service.answer("bad"), return_exceptions=True)
+    good, bad = run(service, answers())
+    assert good[0] == "ok" and isinstance(bad, ConnectionError)
@@ -0,0 +1,152 @@
+import numpy as np
+import pytest
+
+from vector_index import DenseIndex, IVFIndex, QuantizedIndex, SparseIndex, SparseVector, search_batch, train_ivf
+
+N_ROWS, DIMENSION = 600, 32
+
+
+def make_corpus(seed=0, n_rows=N_ROWS, dimension=DIMENSION):
+    """
+    Random vectors around a few directions, so nearest neighbours are well separated.
+    """
+    rng = np.random.default_rng(seed)
+    centers = rng.standard_normal((8, dimension))
+    return (centers[rng.integers(0, 8, n_rows)] + 0.5 * rng.standard_normal((n_rows, dimension))).astype(np.float32)
+
+def make_queries(matrix, n_queries=20, seed=1):
+    rng = np.random.default_rng(seed)
+    rows = matrix[rng.choice(len(matrix), n_queries, replace=False)]
+    return rows + 0.1 * rng.standard_normal(rows.shape).astype(np.float32)
+
+def brute_force(matrix, query, top_k=None, min_score=None):
+    """
+    Cosine similarity of every row, fully sorted: the reference the indexes must match.
+    """
+    scores = (matrix @ query) / (np.linalg.norm(matrix, axis=1) * np.linalg.norm(query))
+    ids = np.argsort(-scores, kind="stable")
+    if min_score is not None:
+        ids = ids[scores[ids] >= min_score]
+    return ids[:top_k], scores[ids[:top_k]]
+
+
+@pytest.mark.parametrize("top_k, min_score", [(10, None), (None, 0.6), (25, 0.3)])
+def test_dense_search_matches_brute_force(top_k, min_score):
+    matrix = make_corpus()
+    index = DenseIndex(matrix)
+    for query in make_queries(matrix):
+        ids, scores = index.search(query, top_k, min_score)
+        expected_ids, expected_scores = brute_force(matrix, query, top_k, min_score)
+        np.testing.assert_array_equal(ids, expected_ids)
+        np.testing.assert_allclose(scores, expected_scores, atol=1e-5)
+
+def test_search_batch_matches_single_queries():
+    matrix = make_corpus()
+    index = DenseIndex(matrix)
+    queries = make_queries(matrix)
+    for query, (ids, scores) in zip(queries, search_batch(index, list(queries), top_k=10, min_score=0.2)):
+        expected_ids, expected_scores = index.search(query, 10, 0.2)
+        np.testing.assert_array_equal(ids, expected_ids)
+        np.testing.assert_allclose(scores, expected_scores, atol=1e-5)
+
+
+def make_sparse_corpus(n_rows=300, dimension=2000, nnz=40, seed=0, vocabulary=None):
+    """
+    SPLADE-like rows: a few dozen positive weights over the first vocabulary token ids.
+    """
+    rng = np.random.default_rng(seed)
+    vocabulary = vocabulary or dimension
+    return [SparseVector(np.sort(rng.choice(vocabulary, nnz, replace=False)), rng.random(nnz) + 0.01, dimension)
+            for _ in range(n_rows)]
+
+def test_sparse_index_matches_brute_force():
+    vectors = make_sparse_corpus()
+    dense = np.stack([v.to_dense() for v in vectors])
+    index = SparseIndex.from_vectors(vectors)
+    for query in vectors[:10] + make_sparse_corpus(n_rows=10, seed=1):
+        ids, scores = index.search(query, top_k=10)
+        expected_ids, expected_scores = brute_force(dense, query.to_dense(), top_k=10)
+        np.testing.assert_array_equal(ids, expected_ids)
+        np.testing.assert_allclose(scores, expected_scores, atol=1e-5)
+
+def test_sparse_query_without_shared_terms_scores_zero():
+    index = SparseIndex.from_vectors(make_sparse_corpus(vocabulary=1000))
+    query = SparseVector([1500, 1700], [1.0, 2.0], 2000)
+    assert not index.score(query).any()
+    ids, _ = index.search(query, top_k=5, min_score=0.01)
+    assert len(ids) == 0
+
+
+def test_ivf_probing_every_list_is_exact():
+    matrix = make_corpus()
+    index = IVFIndex(matrix, n_lists=16, nprobe=16)
+    for query in make_queries(matrix):
+        ids, scores = index.search(query, top_k=10)
+        expected_ids, expected_scores = brute_force(matrix, query, top_k=10)
+        np.testing.assert_array_equal(ids, expected_ids)
+        np.testing.assert_allclose(scores, expected_scores, atol=1e-5)
+
+def test_ivf_top_k_recall_and_exact_scores():
+    matrix = make_corpus()
+    index = IVFIndex(matrix, n_lists=16, nprobe=4)
+    found = 0
+    for query in make_queries(matrix):
+        ids, scores = index.search(query, top_k=10)
+        expected_ids, _ = brute_force(matrix, query, top_k=10)
+        found += len(np.intersect1d(ids, expected_ids))
+        # Returned scores are exact cosines, best first
+        exact = (matrix[ids] @ query) / (np.linalg.norm(matrix[ids], axis=1) * np.linalg.norm(query))
+        np.testing.assert_allclose(scores, exact, atol=1e-5)
+        assert np.all(np.diff(scores) <= 0)
+    assert found / (10 * 20) >= 0.9
+    assert index.recall(top_k=10) >= 0.9
+
+def test_list_ordered_ivf_matches_in_memory_ivf():
+    matrix = make_corpus()
+    normalized = matrix / np.linalg.norm(matrix, axis=1, keepdims=True)
+    centroids, row_ids, list_ptr = train_ivf(normalized, n_lists=16)
+    in_memory = IVFIndex(matrix, nprobe=4, centroids=centroids, row_ids=row_ids, list_ptr=list_ptr)
+    ordered = IVFIndex(normalized[row_ids], nprobe=4, centroids=centroids, row_ids=row_ids, list_ptr=list_ptr,
+                       list_ordered=True)
+    for query in make_queries(matrix):
+        ids, scores = ordered.search(query, top_k=10)
+        expected_ids, expected_scores = in_memory.search(query, top_k=10)
+        np.testing.assert_array_equal(ids, expected_ids)
+        np.testing.assert_allclose(scores, expected_scores, atol=1e-5)
+
+
+def make_quantized_index(matrix, mode, **kwargs):
+    """
+    Quantized index streaming matrix in small blocks, rescored from matrix itself.
+    """
+    fetched = []
+
+    def fetch_rows(ids):
+        fetched.append(len(ids))
+        return matrix[ids]
+    index = QuantizedIndex.from_blocks(lambda: (matrix[s:s + 100] for s in range(0, len(matrix), 100)), mode,
+                                       fetch_rows, **kwargs)
+    return index, fetched
+
+@pytest.mark.parametrize("mode, rescore_factor", [("int8", 4), ("binary", 16)])
+def test_quantized_top_k_matches_brute_force(mode, rescore_factor):
+    matrix = make_corpus()
+    index, fetched = make_quantized_index(matrix, mode, rescore_factor=rescore_factor)
+    assert index.nbytes < matrix.nbytes / 3
+    for query in make_queries(matrix):
+        ids, scores = index.search(query, top_k=10)
+        expected_ids, expected_scores = brute_force(matrix, query, top_k=10)
+        np.testing.assert_array_equal(ids, expected_ids)
+        # Shortlist scores are rescored with the full-precision rows, so they are exact
+        np.testing.assert_allclose(scores, expected_scores, atol=1e-5)
+    # Only the shortlist is read back, never the whole corpus
+    assert max(fetched) == 10 * rescore_factor
+
+def test_quantized_min_score_matches_brute_force():
+    matrix = make_corpus()
+    index, _ = make_quantized_index(matrix, "int8")
+    for query in make_queries(matrix):
+        ids, scores = index.search(query, min_score=0.7)
+        expected_ids, expected_scores = brute_force(matrix, query, min_score=0.7)
+        np.testing.assert_array_equal(ids, expected_ids)
+        np.testing.assert_allclose(scores, expected_scores, atol=1e-5)
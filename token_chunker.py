@@ -0,0 +1,129 @@
+#################################################################
+####---------Token-accurate chunking---------------------------####
+#################################################################
+# Chunk sizes and overlaps are counted in the tokens of the selected embedding model,
+# and chunks are cut on the character offsets of those tokens. A chunk therefore never
+# exceeds the model's input window, so no text is silently truncated at embedding time.
+import re
+
+from model_registry import get_or_create
+
+# Tokenizer of each embedding model: a HuggingFace fast tokenizer or a tiktoken encoding
+# (text-embedding-ada-002 and the Azure text-embedding-3-large deployment share cl100k_base)
+CHUNK_TOKENIZERS = {
+    "all-MiniLM-L6-v2": ("huggingface", "sentence-transformers/all-MiniLM-L6-v2"),
+    "atomic-canyon-fermi-nrc": ("huggingface", "atomic-canyon/fermi-1024"),
+    "text-embedding-ada-002": ("tiktoken", "cl100k_base"),
+}
+# Paragraphs tokenized per call of a batch tokenizer
+TOKENIZE_BATCH_SIZE = 1024
+
+
+def _whitespace_offsets(texts):
+    # Fallback: one "token" per whitespace-separated word
+    return [[(m.start(), m.end()) for m in re.finditer(r"\S+", text)] for text in texts]
+
+def _huggingface_offsets(tokenizer):
+    def offsets(texts):
+        encodings = tokenizer(list(texts), add_special_tokens=False, return_offsets_mapping=True,
+                              return_attention_mask=False, return_token_type_ids=False, verbose=False)
+        return [[tuple(span) for span in spans] for spans in encodings["offset_mapping"]]
+    return offsets
+
+def _tiktoken_offsets(encoding):
+    def offsets(texts):
+        result = []
+        for text, tokens in zip(texts, encoding.encode_ordinary_batch(list(texts))):
+            _, starts = encoding.decode_with_offsets(tokens)
+            result.append(list(zip(starts, starts[1:] + [len(text)])))
+        return result
+    return offsets
+
+def get_chunk_tokenizer(model_name):
+    """
+    Returns (offsets, n_special_tokens) for an embedding model. offsets maps a list of
+    texts to the (start, end) character span of every token of each text; n_special_tokens
+    is the number of tokens the model adds around each input (e.g. [CLS] and [SEP]).
+    Unknown models, or models whose tokenizer cannot be loaded, fall back to words.
+    """
+    kind, name = CHUNK_TOKENIZERS.get(model_name, (None, None))
+
+    def load():
+        try:
+            if kind == "huggingface":
+                from transformers import AutoTokenizer
+                tokenizer = AutoTokenizer.from_pretrained(name, use_fast=True)
+                if not tokenizer.is_fast:
+                    raise ValueError(f"{name} has no fast tokenizer, token offsets are unavailable")
+                return _huggingface_offsets(tokenizer), tokenizer.num_special_tokens_to_add()
+            if kind == "tiktoken":
+                import tiktoken
+                return _tiktoken_offsets(tiktoken.get_encoding(name)), 0
+        except Exception as e:
+            print(f"Error loading the {model_name} tokenizer, counting words as tokens instead: {str(e)}")
+        return _whitespace_offsets, 0
+    return get_or_create(("chunk_tokenizer", model_name), load)
+
+def token_windows(offsets, chunk_size, overlap):
+    """
+    Yields the (start, end) character span of every window of chunk_size tokens, one
+    window every chunk_size - overlap tokens. The last window ends on the last token.
+    """
+    step = max(1, chunk_size - overlap)
+    for i in range(0, len(offsets), step):
+        yield offsets[i][0], offsets[min(i + chunk_size, len(offsets)) - 1][1]
+        if i + chunk_size >= len(offsets):
+            break
+
+def iter_chunk_spans(texts, chunk_size, overlap, model_name=None, max_tokens=None):
+    """
+    Batch-tokenizes texts and yields, for each text, the list of its chunk spans.
+
+    Args:
+        texts (list): Paragraphs (or any texts) to cut.
+        chunk_size (int): Tokens per chunk, capped to max_tokens minus the model's special tokens.
+        overlap (int): Tokens shared by consecutive chunks.
+        model_name (str): Embedding model whose tokenizer counts the tokens (None: words).
+        max_tokens (int): Input window of the embedding model.
+    """
+    offsets_fn, n_special = get_chunk_tokenizer(model_name) if model_name else (_whitespace_offsets, 0)
+    chunk_size = int(chunk_size)
+    if max_tokens:
+        chunk_size = min(chunk_size, int(max_tokens) - n_special)
+    chunk_size = max(1, chunk_size)
+    overlap = min(int(overlap), chunk_size - 1)
+
+    for start in range(0, len(texts), TOKENIZE_BATCH_SIZE):
+        for offsets in offsets_fn(texts[start:start + TOKENIZE_BATCH_SIZE]):
+            yield list(token_windows(offsets, chunk_size, overlap))
+
+def split_text(text, chunk_size, overlap, model_name=None, max_tokens=None):
+    """
+    Cuts one text into chunks of chunk_size tokens, overlapping by overlap tokens.
+
+    Returns:
+        list: Chunk strings.
+    """
+    spans = next(iter_chunk_spans([text], chunk_size, overlap, model_name, max_tokens))
+    return [text[start:end] for start, end in spans]
+
+def count_tokens(texts, model_name="text-embedding-ada-002"):
+    """
+    Counts the tokens of each text with the tokenizer of model_name. The default
+    (cl100k_base) is also a close estimate for the GPT chat models' prompts.
+
+    Returns:
+        list: One token count per text.
+    """
+    offsets_fn, _ = get_chunk_tokenizer(model_name)
+    return [len(offsets) for offsets in offsets_fn(list(texts))]
+
+def truncate_tokens(text, max_tokens, model_name="text-embedding-ada-002"):
+    """
+    Returns the longest prefix of text holding at most max_tokens tokens of model_name.
+    """
+    offsets_fn, _ = get_chunk_tokenizer(model_name)
+    offsets = offsets_fn([text])[0]
+    if len(offsets) <= max_tokens:
+        return text
+    return text[:offsets[max_tokens - 1][1]] if max_tokens > 0 else ""
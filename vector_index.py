@@ -0,0 +1,571 @@
+#################################################################
+####---------Vector indexes used by search_docs----------------####
+#################################################################
+import os
+import weakref
+from collections import OrderedDict
+import numpy as np
+
+# Dense corpora with at least ANN_MIN_ROWS chunks get an approximate (IVF) index
+ANN_MIN_ROWS = int(os.environ.get("ANN_MIN_ROWS", 100000))
+ANN_NLIST = int(os.environ.get("ANN_NLIST", 0))  # 0 picks sqrt(n_chunks) lists
+ANN_NPROBE = int(os.environ.get("ANN_NPROBE", 16))
+# Optional quantized storage of dense vectors: "", "int8" or "binary"
+QUANTIZATION = os.environ.get("QUANTIZATION", "")
+QUANT_RESCORE_FACTOR = int(os.environ.get("QUANT_RESCORE_FACTOR", 8))
+QUANT_MAX_SHORTLIST = int(os.environ.get("QUANT_MAX_SHORTLIST", 2000))
+
+
+class SparseVector:
+    """
+    Non-zero entries of a vocabulary-sized vector (e.g. a Fermi/SPLADE embedding).
+    indices are token ids, matching the tokenizer's id_to_token mapping.
+    """
+    __slots__ = ("indices", "data", "dimension")
+
+    def __init__(self, indices, data, dimension):
+        self.indices = np.asarray(indices, dtype=np.int32)
+        self.data = np.asarray(data, dtype=np.float32)
+        self.dimension = int(dimension)
+
+    @classmethod
+    def from_dense(cls, vector):
+        vector = np.asarray(vector, dtype=np.float32).reshape(-1)
+        indices = np.flatnonzero(vector)
+        return cls(indices, vector[indices], vector.shape[0])
+
+    def to_dense(self):
+        vector = np.zeros(self.dimension, dtype=np.float32)
+        vector[self.indices] = self.data
+        return vector
+
+    def __len__(self):
+        return len(self.indices)
+
+    def __repr__(self):
+        return f"SparseVector(nnz={len(self.indices)}, dimension={self.dimension})"
+
+
+def to_float32_vector(embedding):
+    """
+    Converts an embedding (list, numpy array, torch tensor or SparseVector) to a flat float32 array.
+    """
+    if isinstance(embedding, SparseVector):
+        return embedding.to_dense()
+    if hasattr(embedding, "detach"):
+        embedding = embedding.detach().cpu().numpy()
+    return np.asarray(embedding, dtype=np.float32).reshape(-1)
+
+def to_float32_matrix(embeddings):
+    """
+    Stacks a sequence of embeddings into a contiguous (n_chunks x dim) float32 matrix.
+    """
+    if isinstance(embeddings, np.ndarray) and embeddings.ndim == 2:
+        return np.ascontiguousarray(embeddings, dtype=np.float32)
+    return np.ascontiguousarray(np.vstack([to_float32_vector(e) for e in embeddings]))
+
+def top_k_indices(scores, top_k=None, min_score=None):
+    """
+    Selects the best scoring rows without sorting the whole corpus.
+
+    Args:
+        scores (np.ndarray): One score per chunk.
+        top_k (int): Maximum number of rows to return, all rows when None.
+        min_score (float): Only rows scoring at least this value are returned.
+
+    Returns:
+        np.ndarray: Row ids ordered by descending score.
+    """
+    if min_score is not None:
+        candidates = np.flatnonzero(scores >= min_score)
+    else:
+        candidates = np.arange(len(scores))
+
+    if top_k is not None and len(candidates) > top_k:
+        if top_k <= 0:
+            return candidates[:0]
+        best = np.argpartition(scores[candidates], -top_k)[-top_k:]
+        candidates = candidates[best]
+
+    return candidates[np.argsort(-scores[candidates], kind="stable")]
+
+
+class DenseIndex:
+    """
+    Exact cosine-similarity index over a contiguous, pre-normalized (n_chunks x dim) matrix.
+    A query is scored with a single matrix-vector product.
+    """
+
+    def __init__(self, matrix, normalized=False):
+        matrix = to_float32_matrix(matrix)
+        if normalized:
+            # Used as is, e.g. a read-only memory-mapped store (see vector_store.py)
+            self.matrix = matrix
+            return
+        norms = np.linalg.norm(matrix, axis=1, keepdims=True)
+        norms[norms == 0] = 1.0
+        self.matrix = np.ascontiguousarray(matrix / norms)
+
+    @classmethod
+    def from_embeddings(cls, embeddings):
+        return cls(to_float32_matrix(list(embeddings)))
+
+    def __len__(self):
+        return self.matrix.shape[0]
+
+    @property
+    def dimension(self):
+        return self.matrix.shape[1]
+
+    @staticmethod
+    def normalize_query(query_embedding):
+        query = to_float32_vector(query_embedding)
+        norm = np.linalg.norm(query)
+        return query / norm if norm > 0 else query
+
+    def score(self, query_embedding):
+        """
+        Returns the cosine similarity between the query and every chunk.
+        """
+        return self.matrix @ self.normalize_query(query_embedding)
+
+    def search(self, query_embedding, top_k=None, min_score=None):
+        """
+        Returns (ids, scores) of the best matching chunks, best first.
+        """
+        scores = self.score(query_embedding)
+        ids = top_k_indices(scores, top_k, min_score)
+        return ids, scores[ids]
+
+
+def _assign_to_centroids(matrix, centroids, block_size=65536):
+    # Nearest centroid (by cosine) of every row, computed in blocks to bound memory
+    assignment = np.empty(matrix.shape[0], dtype=np.int32)
+    for start in range(0, matrix.shape[0], block_size):
+        assignment[start:start + block_size] = np.argmax(matrix[start:start + block_size] @ centroids.T, axis=1)
+    return assignment
+
+def train_kmeans(matrix, n_clusters, n_iter=10, sample_size=None, seed=0):
+    """
+    Spherical k-means on normalized rows, trained on a random sample.
+
+    Returns:
+        np.ndarray: (n_clusters x dim) normalized centroids.
+    """
+    rng = np.random.default_rng(seed)
+    sample_size = min(matrix.shape[0], sample_size or 64 * n_clusters)
+    sample = matrix[np.sort(rng.choice(matrix.shape[0], sample_size, replace=False))]
+    centroids = sample[rng.choice(sample_size, n_clusters, replace=False)].copy()
+
+    for _ in range(n_iter):
+        assignment = _assign_to_centroids(sample, centroids)
+        sums = np.zeros_like(centroids)
+        np.add.at(sums, assignment, sample)
+        counts = np.bincount(assignment, minlength=n_clusters)
+        # Re-seed empty clusters with random sample rows
+        empty = np.flatnonzero(counts == 0)
+        sums[empty] = sample[rng.choice(sample_size, len(empty), replace=False)]
+        norms = np.linalg.norm(sums, axis=1, keepdims=True)
+        norms[norms == 0] = 1.0
+        centroids = (sums / norms).astype(np.float32)
+    return centroids
+
+
+def assign_lists(matrix, centroids):
+    """
+    Assigns every normalized row to its nearest centroid.
+
+    Returns:
+        tuple: (row_ids, list_ptr): the row ids grouped by list, and the start of every
+        list in row_ids (list i is row_ids[list_ptr[i]:list_ptr[i + 1]]).
+    """
+    assignment = _assign_to_centroids(matrix, centroids)
+    row_ids = np.argsort(assignment, kind="stable")
+    list_ptr = np.zeros(len(centroids) + 1, dtype=np.int64)
+    np.cumsum(np.bincount(assignment, minlength=len(centroids)), out=list_ptr[1:])
+    return row_ids, list_ptr
+
+def train_ivf(matrix, n_lists=ANN_NLIST, n_iter=10, seed=0):
+    """
+    Clusters normalized rows (e.g. a memory-mapped store, read in blocks) into IVF lists.
+
+    Returns:
+        tuple: (centroids, row_ids, list_ptr) as taken by IVFIndex.
+    """
+    n_lists = n_lists or max(1, int(np.sqrt(matrix.shape[0])))
+    centroids = train_kmeans(matrix, min(n_lists, matrix.shape[0]), n_iter=n_iter, seed=seed)
+    return (centroids,) + assign_lists(matrix, centroids)
+
+
+class IVFIndex(DenseIndex):
+    """
+    Approximate cosine-similarity index (inverted file). Chunks are clustered around
+    k-means centroids and stored contiguously per cluster; a query only scores the rows of
+    its `nprobe` closest clusters. Raising nprobe trades latency for recall, and
+    nprobe >= n_lists is an exact search.
+
+    With list_ordered, matrix is already normalized and in list order (row i is chunk
+    row_ids[i]), e.g. a read-only memory-mapped file, and is used without a copy.
+    measured_recall is the recall@10 at nprobe measured when the index was built (see
+    recall), kept with the stored index so it is not measured again on every load.
+    """
+
+    def __init__(self, matrix, n_lists=ANN_NLIST, nprobe=ANN_NPROBE, centroids=None, row_ids=None,
+                 list_ptr=None, n_iter=10, seed=0, list_ordered=False, measured_recall=None):
+        if list_ordered and (centroids is None or row_ids is None):
+            raise ValueError("A list-ordered matrix needs its centroids, row_ids and list_ptr")
+        super().__init__(matrix, normalized=list_ordered)
+        if centroids is None:
+            n_lists = n_lists or max(1, int(np.sqrt(len(self))))
+            centroids = train_kmeans(self.matrix, min(n_lists, len(self)), n_iter=n_iter, seed=seed)
+        self.centroids = np.ascontiguousarray(centroids, dtype=np.float32)
+        if row_ids is None:
+            row_ids, list_ptr = assign_lists(self.matrix, self.centroids)
+        self.row_ids = np.asarray(row_ids, dtype=np.int64)
+        self.list_ptr = np.asarray(list_ptr, dtype=np.int64)
+        self.nprobe = nprobe
+        self.measured_recall = measured_recall
+        if not list_ordered:
+            # Rows are kept in list order so every probed list is a contiguous slice
+            self.matrix = np.ascontiguousarray(self.matrix[self.row_ids])
+
+    @property
+    def n_lists(self):
+        return len(self.centroids)
+
+    def score(self, query_embedding):
+        """
+        Returns the exact cosine similarity between the query and every chunk.
+        """
+        scores = np.empty(len(self), dtype=np.float32)
+        scores[self.row_ids] = self.matrix @ self.normalize_query(query_embedding)
+        return scores
+
+    def search(self, query_embedding, top_k=None, min_score=None, nprobe=None):
+        """
+        Returns (ids, scores) of the best matching chunks among the probed lists, best first.
+        """
+        nprobe = min(nprobe or self.nprobe, self.n_lists)
+        if nprobe >= self.n_lists:
+            return super().search(query_embedding, top_k, min_score)
+
+        query = self.normalize_query(query_embedding)
+        probes = np.argpartition(-(self.centroids @ query), nprobe - 1)[:nprobe]
+        positions, scores = [], []
+        for probe in probes:
+            start, end = self.list_ptr[probe], self.list_ptr[probe + 1]
+            if start < end:
+                positions.append(np.arange(start, end))
+                scores.append(self.matrix[start:end] @ query)
+        if not positions:
+            return np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.float32)
+        positions, scores = np.concatenate(positions), np.concatenate(scores)
+        best = top_k_indices(scores, top_k, min_score)
+        return self.row_ids[positions[best]], scores[best]
+
+    def recall(self, queries=None, top_k=10, nprobe=None, n_queries=100, seed=0):
+        """
+        Measures recall@top_k of the approximate search against exact search.
+
+        Args:
+            queries (np.ndarray): Query vectors, defaults to n_queries sampled corpus rows.
+
+        Returns:
+            float: Mean fraction of the exact top_k found by the approximate search.
+        """
+        if queries is None:
+            rng = np.random.default_rng(seed)
+            queries = self.matrix[rng.choice(len(self), min(n_queries, len(self)), replace=False)]
+        found = 0
+        for query in queries:
+            exact_ids, _ = DenseIndex.search(self, query, top_k)
+            approx_ids, _ = self.search(query, top_k, nprobe=nprobe)
+            found += len(np.intersect1d(exact_ids, approx_ids))
+        return found / (len(queries) * min(top_k, len(self)))
+
+
+def _normalize_rows(matrix):
+    matrix = np.asarray(matrix, dtype=np.float32)
+    norms = np.linalg.norm(matrix, axis=1, keepdims=True)
+    norms[norms == 0] = 1.0
+    return matrix / norms
+
+# Number of set bits of every byte value, for Hamming distances on packed codes
+_POPCOUNT = np.array([bin(i).count("1") for i in range(256)], dtype=np.uint8)
+
+
+class QuantizedIndex:
+    """
+    Cosine-similarity index over quantized vectors with exact rescoring.
+
+    Phase 1 scores every chunk on compact codes: "int8" keeps one byte per dimension
+    (per-dimension symmetric scale), "binary" keeps one sign bit per dimension and turns the
+    Hamming distance into a cosine estimate. Phase 2 reads the full-precision vectors of
+    the shortlist through fetch_rows (e.g. from the HDF5 store) and rescores them exactly.
+    """
+
+    # Phase-1 scores may underestimate the true cosine by about this much
+    MARGINS = {"int8": 0.02, "binary": 0.15}
+
+    def __init__(self, codes, mode, dimension, fetch_rows, scale=None,
+                 rescore_factor=QUANT_RESCORE_FACTOR, max_shortlist=QUANT_MAX_SHORTLIST, block_size=65536):
+        if mode not in self.MARGINS:
+            raise ValueError(f"Unknown quantization mode {mode!r}, expected one of {list(self.MARGINS)}")
+        self.codes = codes
+        self.mode = mode
+        self.dimension = int(dimension)
+        self.fetch_rows = fetch_rows
+        self.scale = scale
+        self.rescore_factor = rescore_factor
+        self.max_shortlist = max_shortlist
+        self.block_size = block_size
+
+    @classmethod
+    def from_blocks(cls, iter_blocks, mode, fetch_rows, **kwargs):
+        """
+        Quantizes a corpus streamed in blocks.
+
+        Args:
+            iter_blocks: Callable returning an iterator of float32 (rows x dim) blocks; it is
+                called twice for int8 (scale, then codes).
+            mode (str): "int8" or "binary".
+            fetch_rows: Callable mapping row ids to their full-precision vectors.
+        """
+        scale = None
+        if mode == "int8":
+            max_abs = None
+            for block in iter_blocks():
+                block_max = np.abs(_normalize_rows(block)).max(axis=0)
+                max_abs = block_max if max_abs is None else np.maximum(max_abs, block_max)
+            scale = np.where(max_abs > 0, max_abs / 127.0, 1.0).astype(np.float32)
+
+        codes, dimension = [], 0
+        for block in iter_blocks():
+            block = _normalize_rows(block)
+            dimension = block.shape[1]
+            if mode == "int8":
+                codes.append(np.clip(np.rint(block / scale), -127, 127).astype(np.int8))
+            else:
+                codes.append(np.packbits(block > 0, axis=1))
+        codes = np.ascontiguousarray(np.concatenate(codes))
+        return cls(codes, mode, dimension, fetch_rows, scale=scale, **kwargs)
+
+    def __len__(self):
+        return self.codes.shape[0]
+
+    @property
+    def nbytes(self):
+        return self.codes.nbytes
+
+    def score(self, query_embedding):
+        """
+        Returns the phase-1 (approximate) cosine similarity between the query and every chunk.
+        """
+        query = DenseIndex.normalize_query(query_embedding)
+        scores = np.empty(len(self), dtype=np.float32)
+        if self.mode == "int8":
+            scaled_query = query * self.scale
+            for start in range(0, len(self), self.block_size):
+                block = self.codes[start:start + self.block_size]
+                scores[start:start + self.block_size] = block.astype(np.float32) @ scaled_query
+        else:
+            query_bits = np.packbits(query > 0)
+            for start in range(0, len(self), self.block_size):
+                block = self.codes[start:start + self.block_size]
+                hamming = _POPCOUNT[np.bitwise_xor(block, query_bits)].sum(axis=1, dtype=np.int32)
+                scores[start:start + self.block_size] = np.cos(np.pi * hamming / self.dimension)
+        return scores
+
+    def search(self, query_embedding, top_k=None, min_score=None):
+        """
+        Returns (ids, scores) of the best matching chunks, best first, with exact scores.
+        """
+        query = DenseIndex.normalize_query(query_embedding)
+        approx = self.score(query)
+        shortlist_size = self.max_shortlist if top_k is None else max(top_k, top_k * self.rescore_factor)
+        shortlist_min = None if min_score is None else min_score - self.MARGINS[self.mode]
+        candidates = top_k_indices(approx, shortlist_size, shortlist_min)
+
+        exact = _normalize_rows(self.fetch_rows(candidates)) @ query if len(candidates) else approx[:0]
+        best = top_k_indices(exact, top_k, min_score)
+        return candidates[best], exact[best]
+
+
+def sparse_vectors_to_csr(vectors):
+    """
+    Concatenates SparseVectors into CSR arrays.
+
+    Returns:
+        tuple: (indptr, indices, data, dimension)
+    """
+    vectors = list(vectors)
+    indptr = np.zeros(len(vectors) + 1, dtype=np.int64)
+    np.cumsum([len(v) for v in vectors], out=indptr[1:])
+    if vectors:
+        indices = np.concatenate([v.indices for v in vectors]).astype(np.int32, copy=False)
+        data = np.concatenate([v.data for v in vectors]).astype(np.float32, copy=False)
+        dimension = vectors[0].dimension
+    else:
+        indices, data, dimension = np.zeros(0, np.int32), np.zeros(0, np.float32), 0
+    return indptr, indices, data, dimension
+
+def select_csr_rows(indptr, indices, data, rows):
+    """
+    Keeps the given rows of CSR arrays, in the order of rows.
+
+    Returns:
+        tuple: (indptr, indices, data)
+    """
+    rows = np.asarray(rows, dtype=np.int64)
+    lengths = indptr[rows + 1] - indptr[rows]
+    new_indptr = np.zeros(len(rows) + 1, dtype=np.int64)
+    np.cumsum(lengths, out=new_indptr[1:])
+    # Position of every kept entry in the source arrays
+    positions = np.repeat(indptr[rows] - new_indptr[:-1], lengths) + np.arange(new_indptr[-1])
+    return new_indptr, indices[positions], data[positions]
+
+def csr_to_sparse_vectors(indptr, indices, data, dimension):
+    """
+    Splits CSR arrays into per-row SparseVectors (views, no copy).
+    """
+    return [SparseVector(indices[indptr[i]:indptr[i + 1]], data[indptr[i]:indptr[i + 1]], dimension)
+            for i in range(len(indptr) - 1)]
+
+
+class SparseIndex:
+    """
+    Inverted index (token id -> posting list) for sparse vectors, scored with cosine similarity.
+    A query only visits the posting lists of its own non-zero tokens.
+    """
+
+    def __init__(self, indptr, indices, data, dimension):
+        indptr = np.asarray(indptr, dtype=np.int64)
+        indices = np.asarray(indices, dtype=np.int64)
+        data = np.asarray(data, dtype=np.float32)
+        self.n_rows = len(indptr) - 1
+        self.dimension = int(dimension)
+
+        # Pre-normalize every row so a sparse dot product is the cosine similarity
+        row_ids = np.repeat(np.arange(self.n_rows, dtype=np.int32), np.diff(indptr))
+        norms = np.sqrt(np.bincount(row_ids, weights=data.astype(np.float64) ** 2, minlength=self.n_rows))
+        norms[norms == 0] = 1.0
+        values = data / norms[row_ids].astype(np.float32)
+
+        # Transpose CSR rows into posting lists ordered by token id
+        order = np.argsort(indices, kind="stable")
+        self.posting_rows = row_ids[order]
+        self.posting_values = values[order]
+        self.term_ptr = np.zeros(self.dimension + 1, dtype=np.int64)
+        np.cumsum(np.bincount(indices, minlength=self.dimension), out=self.term_ptr[1:])
+
+    @classmethod
+    def from_vectors(cls, vectors):
+        return cls(*sparse_vectors_to_csr(vectors))
+
+    def __len__(self):
+        return self.n_rows
+
+    def score(self, query_embedding):
+        """
+        Returns the cosine similarity between the query and every row.
+        """
+        if not isinstance(query_embedding, SparseVector):
+            query_embedding = SparseVector.from_dense(to_float32_vector(query_embedding))
+        norm = np.linalg.norm(query_embedding.data)
+        if norm == 0:
+            return np.zeros(self.n_rows, dtype=np.float32)
+
+        rows, weights = [], []
+        for term, weight in zip(query_embedding.indices, query_embedding.data / norm):
+            start, end = self.term_ptr[term], self.term_ptr[term + 1]
+            if start < end:
+                rows.append(self.posting_rows[start:end])
+                weights.append(self.posting_values[start:end] * weight)
+        if not rows:
+            return np.zeros(self.n_rows, dtype=np.float32)
+        scores = np.bincount(np.concatenate(rows), weights=np.concatenate(weights), minlength=self.n_rows)
+        return scores.astype(np.float32)
+
+    def search(self, query_embedding, top_k=None, min_score=None):
+        """
+        Returns (ids, scores) of the best matching rows, best first.
+        """
+        scores = self.score(query_embedding)
+        ids = top_k_indices(scores, top_k, min_score)
+        return ids, scores[ids]
+
+
+def search_batch(index, query_embeddings, top_k=None, min_score=None):
+    """
+    Searches several queries at once. An exact DenseIndex scores them all with one
+    matrix-matrix product; other indexes search each query in turn.
+
+    Returns:
+        list: (ids, scores) of every query, as returned by index.search.
+    """
+    if type(index) is not DenseIndex or not len(query_embeddings):
+        return [index.search(q, top_k, min_score) for q in query_embeddings]
+    queries = np.stack([DenseIndex.normalize_query(q) for q in query_embeddings])
+    scores = queries @ index.matrix.T  # (n_queries x n_chunks)
+    results = []
+    for row in scores:
+        ids = top_k_indices(row, top_k, min_score)
+        results.append((ids, row[ids]))
+    return results
+
+
+def build_index(embeddings):
+    """
+    Builds a SparseIndex for SparseVector rows, an IVFIndex for dense corpora of at least
+    ANN_MIN_ROWS chunks and an exact DenseIndex otherwise.
+    """
+    embeddings = list(embeddings)
+    if embeddings and isinstance(embeddings[0], SparseVector):
+        return SparseIndex.from_vectors(embeddings)
+    if len(embeddings) >= ANN_MIN_ROWS:
+        return IVFIndex.from_embeddings(embeddings)
+    return DenseIndex.from_embeddings(embeddings)
+
+
+# Indexes are built once per corpus. DataFrames tagged with a corpus_version (see
+# setup_process) share the index of that version, so copies of the Gradio state reuse it;
+# untagged DataFrames get their own index, dropped with them.
+_indexes = {}
+_versioned_indexes = OrderedDict()
+MAX_VERSIONED_INDEXES = 4
+
+def set_index(df, index, kind="vector"):
+    """
+    Registers a prebuilt index (e.g. loaded from disk or quantized) for the corpus in df.
+    kind tells apart the indexes of one corpus (e.g. "vector" and "bm25").
+    """
+    corpus_version = df.attrs.get("corpus_version")
+    if corpus_version is not None:
+        _versioned_indexes.setdefault(corpus_version, {})[kind] = index
+        _versioned_indexes.move_to_end(corpus_version)
+        while len(_versioned_indexes) > MAX_VERSIONED_INDEXES:
+            _versioned_indexes.popitem(last=False)
+        return
+    key = id(df)
+    if key not in _indexes:
+        weakref.finalize(df, _indexes.pop, key, None)
+    _indexes.setdefault(key, {})[kind] = index
+
+def get_registered_index(df, kind="vector"):
+    # The index registered for the corpus in df, or None
+    corpus_version = df.attrs.get("corpus_version")
+    if corpus_version is not None:
+        return _versioned_indexes.get(corpus_version, {}).get(kind)
+    return _indexes.get(id(df), {}).get(kind)
+
+def get_index(df):
+    """
+    Returns the index for the corpus in df, building it from the 'embedded' column on first use.
+    """
+    index = get_registered_index(df)
+    if index is None or len(index) != len(df):
+        if "embedded" not in df:
+            raise ValueError("No search index is registered for this corpus, run Set Up again")
+        index = build_index(df["embedded"])
+        set_index(df, index)
+    return index
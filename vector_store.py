@@ -0,0 +1,150 @@
+#################################################################
+####---------Shared, memory-mapped corpus store----------------####
+#################################################################
+# setup_process used to put a full DataFrame (text and embeddings) into every Gradio
+# session. The dense embeddings are now exported once per corpus version to a .npy file
+# that every session and worker process memory-maps read-only, so the OS page cache
+# holds a single copy. The chunk table is registered once per corpus version in this
+# process and sessions only keep a CorpusHandle to it.
+import hashlib
+import os
+import threading
+from collections import OrderedDict
+import numpy as np
+
+from vector_index import MAX_VERSIONED_INDEXES
+from hdf5_file_constructor import delete_ann_index_from_hdf5, ANN_INDEX_HDF5
+
+VECTOR_STORE_DIR = os.environ.get("VECTOR_STORE_DIR", "vector_store")
+
+
+def vector_file_path(corpus_version, kind="", directory=VECTOR_STORE_DIR):
+    # kind tells apart the files of one version, e.g. "ivf" for the rows in IVF list order
+    digest = hashlib.sha256(corpus_version.encode("utf-8")).hexdigest()[:32]
+    return os.path.join(directory, f"{digest}.{kind}.npy" if kind else f"{digest}.npy")
+
+def export_vectors(blocks, n_rows, path):
+    """
+    Writes L2-normalized float32 embeddings to a .npy file, block by block, so the full
+    matrix is never held in memory. The file is written under a temporary name and then
+    renamed, so other processes never map a partial file.
+
+    Args:
+        blocks: Iterator of (rows x dim) blocks, n_rows rows in total.
+        n_rows (int): Number of rows.
+        path (str): Destination .npy file.
+    """
+    os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    matrix, start = None, 0
+    try:
+        for block in blocks:
+            block = np.asarray(block, dtype=np.float32)
+            if matrix is None:
+                matrix = np.lib.format.open_memmap(tmp_path, mode="w+", dtype=np.float32,
+                                                   shape=(n_rows, block.shape[1]))
+            norms = np.linalg.norm(block, axis=1, keepdims=True)
+            norms[norms == 0] = 1.0
+            matrix[start:start + len(block)] = block / norms
+            start += len(block)
+        if matrix is None:
+            raise ValueError("No embeddings to export")
+        matrix.flush()
+        del matrix
+        os.replace(tmp_path, path)
+    finally:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+    print(f"Exported {n_rows} embeddings to {path}")
+
+def open_vectors(path):
+    # Read-only mapping: pages are loaded on demand and shared between processes
+    return np.load(path, mmap_mode="r")
+
+def remove_vector_files(corpus_version, kinds=("", "ivf"), directory=VECTOR_STORE_DIR):
+    """
+    Deletes the exported vector files of a corpus version. Processes that still map a
+    file keep their mapping; the disk space is freed once they unmap it.
+    """
+    for kind in kinds:
+        path = vector_file_path(corpus_version, kind, directory)
+        try:
+            if os.path.exists(path):
+                os.remove(path)
+        except OSError as e:
+            print(f"Error removing {path}: {str(e)}")
+
+
+class CorpusHandle:
+    """
+    What a Gradio session keeps in gr.State: the corpus version and its size. The chunk
+    table and the vectors are looked up in the process-wide registry. Copies of a
+    handle (Gradio deep-copies session state) are the handle itself.
+    """
+    __slots__ = ("corpus_version", "n_chunks")
+
+    def __init__(self, corpus_version, n_chunks):
+        self.corpus_version = corpus_version
+        self.n_chunks = int(n_chunks)
+
+    def __len__(self):
+        return self.n_chunks
+
+    def __copy__(self):
+        return self
+
+    def __deepcopy__(self, memo):
+        return self
+
+    def __repr__(self):
+        return f"CorpusHandle({self.corpus_version!r}, n_chunks={self.n_chunks})"
+
+
+# corpus_version -> chunk table shared by all sessions, the least recently set up last out
+_corpora = OrderedDict()
+_corpora_lock = threading.Lock()
+
+def register_corpus(df):
+    """
+    Shares the ChunkTable df (tagged with df.attrs["corpus_version"]) between sessions.
+    A table already registered for the same version is kept, so repeated set-ups of the
+    same corpus do not add copies. The least recently set-up versions beyond
+    MAX_VERSIONED_INDEXES are evicted, with their vector files, stored ANN index and
+    cached answers.
+
+    Returns:
+        CorpusHandle: Handle to store in the session state.
+    """
+    corpus_version = df.attrs["corpus_version"]
+    evicted = []
+    with _corpora_lock:
+        shared = _corpora.setdefault(corpus_version, df)
+        _corpora.move_to_end(corpus_version)
+        while len(_corpora) > MAX_VERSIONED_INDEXES:
+            evicted.append(_corpora.popitem(last=False)[0])
+    for version in evicted:
+        release_corpus_files(version)
+    return CorpusHandle(corpus_version, len(shared))
+
+def release_corpus_files(corpus_version):
+    # Every incremental set-up makes a new version: superseded ones must not pile up on disk,
+    # nor keep taking slots of the answer cache
+    from azure_gpt import get_answer_cache
+    get_answer_cache().invalidate(corpus_version)
+    remove_vector_files(corpus_version)
+    try:
+        delete_ann_index_from_hdf5(ANN_INDEX_HDF5, corpus_version)
+    except OSError as e:
+        print(f"Error pruning the ANN index of {corpus_version}: {str(e)}")
+
+def get_corpus(corpus):
+    """
+    Returns the ChunkTable of a CorpusHandle (tables are returned unchanged).
+    """
+    if not isinstance(corpus, CorpusHandle):
+        return corpus
+    with _corpora_lock:
+        df = _corpora.get(corpus.corpus_version)
+    if df is None:
+        raise ValueError("This corpus is no longer loaded, run Set Up again")
+    return df